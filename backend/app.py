@@ -7,9 +7,11 @@ os.environ['CURL_CA_BUNDLE'] = ''
 os.environ['REQUESTS_CA_BUNDLE'] = ''
 os.environ['HF_HUB_OFFLINE'] = '1'
 
-# 设置transformers库的离线模式
-import transformers
-transformers.utils.offline_mode = True
+# 最先导入，用于记录启动各阶段耗时（GET /health/startup）
+import readiness
+# 日志经队列由后台线程输出，见 log_config.py
+import log_config
+log_config.setup_logging()
 
 from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
@@ -17,20 +19,57 @@ import sqlite3
 from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.exc import SQLAlchemyError
-import pandas as pd
 import re
-import requests
+import time
+import uuid
 import json
+import logging
+readiness.mark('third_party_imports')
 from models import DatabaseConnection, create_tables, User, Role, UserRole
-from nlp_enhanced import enhanced_nlp
+from nlp_enhanced import get_enhanced_nlp
 from auth import init_auth_service
+from engine_registry import engine_registry
+from ollama_client import (
+    MODEL_LIST_PATHS, NDJSON_HEADERS, OLLAMA_MODEL, generation_payload, model_warmer,
+    normalize_model_list, ollama_client,
+)
+from chat_prompt import build_chat_prompt, valid_context
+import chat_sessions
+from chat_sessions import init_chat_sessions
+from chat_stream import ChatStreamTranslator, sse
+from pagination import (
+    SORT_ORDERS, build_order_clause, build_seek_clause, choose_pagination_mode,
+    can_seek, decode_cursor, encode_cursor, key_column_cache, qualified_table_name, seek_columns,
+)
+import schema_catalog
+from schema_catalog import init_schema_catalog
+from table_counts import COUNT_STRATEGIES, table_counter
+from query_control import STATEMENT_TIMEOUT, QueryCancelled, effective_timeout, init_query_registry, is_timeout_error, query_registry
+import metrics
+from metrics import db_engine_seconds, db_query_errors, db_query_seconds, serialize_seconds
+from query_cache import QUERY_CACHE_TTL, is_cacheable, modifies_data, query_cache, referenced_tables
+import connection_options
+from connection_options import init_connection_options
+from result_stream import STREAM_FORMATS, iter_connection_batches, stream_limits, stream_rows
+from result_format import (
+    BINARY_FORMATS, RESULT_FORMATS, columns_to_records, columns_to_rows, encode_binary, frame_columns,
+    negotiate_result_format, pyarrow_available,
+)
 import auth
 # 导入embeddings模块
-from embeddings.model import EmbeddingsModel
+from embeddings import manager as embeddings_manager
+from embeddings.schema_index import schema_indexes
+from schema_prompt import context_schema_tables, schema_prompts
 import secrets
+readiness.mark('app_modules')
+
+logger = logging.getLogger(__name__)
+# 流式对话逐行日志的抽样器
+sample_token = log_config.EventSampler()
 
 app = Flask(__name__)
 CORS(app)
+metrics.init_app(app)
 DB_PATH = os.environ.get('CHAT2DB_DB', '/data/chat2db.sqlite')
 
 # Initialize the database
@@ -41,34 +80,51 @@ def init_db():
     return engine
 
 # Get database engine based on connection type
+# 引擎由进程级注册表按连接缓存并复用连接池，而不是每个请求新建
 def get_db_engine(connection):
     try:
-        if connection.type == 'sqlite':
-            return create_engine(f'sqlite:///{connection.database}')
-        elif connection.type == 'mysql':
-            return create_engine(f'mysql+pymysql://{connection.username}:{connection.password}@{connection.host}:{connection.port}/{connection.database}')
-        elif connection.type == 'postgresql':
-            return create_engine(f'postgresql://{connection.username}:{connection.password}@{connection.host}:{connection.port}/{connection.database}')
-        else:
-            raise ValueError(f"Unsupported database type: {connection.type}")
+        with db_engine_seconds.time(connection=connection.id):
+            return engine_registry.get_engine(connection)
     except Exception as e:
         raise ValueError(f"Failed to create engine for {connection.type}: {str(e)}")
 
+def table_keys_for(connection, engine, table_name):
+    """Primary key and column nullability of a table, cached until the connection's schema catalog is refreshed"""
+    catalog = schema_catalog.schema_catalog.cached(connection.id)
+    if catalog is None:
+        # 先建立目录条目，键列缓存随它的刷新或清除失效
+        schema_catalog.schema_catalog.get_tables(connection, engine)
+        catalog = schema_catalog.schema_catalog.cached(connection.id)
+    return key_column_cache.get(engine, connection.id, table_name, connection.type, catalog)
+
+# Drop every per-connection cache after a connection row changes
+def invalidate_connection_caches(conn_id):
+    engine_registry.invalidate(conn_id)
+    key_column_cache.invalidate(conn_id)
+    table_counter.invalidate(conn_id)
+    schema_catalog.schema_catalog.invalidate(conn_id)
+    schema_indexes.invalidate(conn_id)
+    schema_prompts.invalidate(conn_id)
+    query_cache.invalidate(conn_id)
+
 # Create a session for the main app database
 app_engine = init_db()
 Session = sessionmaker(bind=app_engine)
 
 # Initialize auth service
-print("Before calling init_auth_service")
 init_auth_service(app_engine)
-print("After calling init_auth_service")
 
 # Check if auth_service is properly initialized
-print("Checking auth_service...")
-print(f"auth.auth_service = {auth.auth_service}")
 if auth.auth_service is None:
     raise RuntimeError("Failed to initialize auth service")
-print("auth_service is properly initialized")
+logger.debug("auth_service is properly initialized")
+
+# Initialize schema metadata cache
+init_schema_catalog(Session)
+init_connection_options(Session)
+init_chat_sessions(Session)
+init_query_registry(Session)
+readiness.mark('app_database')
 
 # Authentication decorator
 def require_auth(f):
@@ -102,12 +158,12 @@ def require_admin(f):
         try:
             # Extract token from "Bearer <token>" format
             token = auth_header.split(' ')[1]
-            user = auth.auth_service.get_user_by_token(token)
+            user, roles = auth.auth_service.verify_token(token)
             if not user:
                 return jsonify({'error': 'Invalid token'}), 401
             
-            # Check if user has admin role
-            if not auth.auth_service.check_permission(user['id'], 'Administrator'):
+            # Check if user has admin role (from the token claims / verification cache)
+            if 'Administrator' not in roles:
                 return jsonify({'error': 'Insufficient permissions'}), 403
                 
             # Add user to request context
@@ -119,6 +175,22 @@ def require_admin(f):
     wrapper.__name__ = f.__name__
     return wrapper
 
+# Verify the bearer token of the current request for endpoints where auth is optional;
+# returns an error response tuple, or None when the user was authenticated
+def authenticate_request():
+    auth_header = request.headers.get('Authorization')
+    if not auth_header:
+        return jsonify({'error': 'Missing authorization header'}), 401
+    try:
+        token = auth_header.split(' ')[1]
+        user = auth.auth_service.get_user_by_token(token)
+        if not user:
+            return jsonify({'error': 'Invalid token'}), 401
+        request.user = user
+    except Exception as e:
+        return jsonify({'error': str(e)}), 401
+    return None
+
 # very small NL->SQL converter: handles simple "show/count/list" intents for a single table 'employees'
 def nl_to_sql(nl_text):
     text = nl_text.strip().lower()
@@ -266,6 +338,8 @@ def update_connection(conn_id):
                 
         session.commit()
         session.refresh(connection)
+        # 连接配置已变化，释放旧的连接池和缓存
+        invalidate_connection_caches(conn_id)
         return jsonify(connection.to_dict())
     except Exception as e:
         session.rollback()
@@ -284,6 +358,8 @@ def delete_connection(conn_id):
             
         session.delete(connection)
         session.commit()
+        invalidate_connection_caches(conn_id)
+        connection_options.connection_options.delete(conn_id)
         return jsonify({'message': 'connection deleted'})
     except Exception as e:
         session.rollback()
@@ -324,6 +400,7 @@ def test_connection(conn_id):
                 session.close()
                 return jsonify({'error': f'Unsupported database type: {connection.type}'}), 400
                 
+            import pandas as pd  # 导入较慢，只在执行查询时加载
             df = pd.read_sql_query(query, engine)
             table_count = len(df)
             session.close()
@@ -346,6 +423,9 @@ def query_with_connection(conn_id):
     
     nl = data['query']
     sql = nl_to_sql(nl)
+    fmt, format_error = request_result_format(data)
+    if format_error:
+        return format_error
     
     try:
         # Get the database connection
@@ -358,13 +438,66 @@ def query_with_connection(conn_id):
         # Create engine for the target database
         engine = get_db_engine(connection)
         
-        # Execute query
-        df = pd.read_sql_query(sql, engine)
-        rows = df.to_dict(orient='records')
-        return jsonify({'sql': sql, 'rows': rows})
+        # Stream rows with a server-side cursor instead of building a DataFrame
+        if data.get('stream'):
+            timeout = statement_timeout_for(conn_id, data)
+            return stream_query_response(engine, conn_id, connection.type, sql, timeout, data)
+        
+        # Serve repeated read-only queries from the result cache
+        cacheable = is_cacheable(sql)
+        ttl = query_cache_ttl(conn_id, data) if cacheable else 0
+        cache_key = query_cache.make_key(conn_id, sql, variant=fmt)
+        if ttl > 0:
+            cached = cached_response(cache_key)
+            if cached is not None:
+                return cached
+        
+        # Execute query under the statement timeout; it can be cancelled through /api/queries/<id>/cancel
+        timeout = statement_timeout_for(conn_id, data)
+        try:
+            with query_registry.run(engine, conn_id, connection.type, sql, timeout, current_user_id(), data.get('queryId')) as (conn, running):
+                df = read_sql(sql, conn, conn_id, running)
+        finally:
+            if modifies_data(sql):
+                # 数据可能已变化，丢弃该连接的缓存结果
+                query_cache.invalidate(conn_id)
+        with serialize_seconds.time(endpoint=request.endpoint, format=fmt):
+            response = result_response(fmt, df, {'sql': sql})
+        response.headers['X-Query-Id'] = running.id
+        return cache_response(cache_key, response, ttl, referenced_tables(sql))
+    except QueryCancelled as e:
+        return query_cancelled_response(e, sql=sql)
     except Exception as e:
         return jsonify({'error': str(e), 'sql': sql}), 500
 
+def stream_query_response(engine, conn_id, db_type, sql, timeout, data):
+    """Build a chunked response for a streaming query request.
+
+    Request options: format ('ndjson' or 'json'), maxRows, maxBytes. The query is
+    registered like a buffered one, so the statement timeout bounds the whole
+    stream and it can be cancelled with the id in the X-Query-Id header (from any
+    worker when the client chose the queryId or the query has a timeout).
+    """
+    fmt = data.get('format', 'ndjson')
+    if fmt not in STREAM_FORMATS:
+        return jsonify({'error': f'unsupported stream format: {fmt}', 'sql': sql}), 400
+    try:
+        max_rows, max_bytes = stream_limits(data.get('maxRows'), data.get('maxBytes'))
+    except ValueError as e:
+        return jsonify({'error': str(e), 'sql': sql}), 400
+    # 生成器在请求上下文之外执行，用户与查询 ID 需要提前确定
+    query_id = data.get('queryId') or uuid.uuid4().hex
+    shared = bool(data.get('queryId')) or bool(timeout)
+    user_id = current_user_id()
+
+    def batches():
+        with query_registry.run(engine, conn_id, db_type, sql, timeout, user_id, query_id, shared) as (conn, running):
+            yield from iter_connection_batches(conn, sql)
+
+    body = stream_rows(batches(), fmt, sql=sql, max_rows=max_rows, max_bytes=max_bytes)
+    # 禁止反向代理缓冲，保证前端能立即收到第一批数据
+    return Response(body, mimetype=STREAM_FORMATS[fmt], headers={'X-Accel-Buffering': 'no', 'X-Query-Id': query_id})
+
 @app.route('/api/query', methods=['POST'])
 def query():
     data = request.get_json()
@@ -372,11 +505,16 @@ def query():
         return jsonify({'error': 'missing query'}), 400
     nl = data['query']
     sql = nl_to_sql(nl)
+    if data.get('stream'):
+        return stream_query_response(app_engine, 'app', 'sqlite', sql, effective_timeout(STATEMENT_TIMEOUT, data.get('timeout')), data)
+    fmt, format_error = request_result_format(data)
+    if format_error:
+        return format_error
     try:
         conn = sqlite3.connect(DB_PATH)
-        df = pd.read_sql_query(sql, conn)
-        rows = df.to_dict(orient='records')
-        return jsonify({'sql': sql, 'rows': rows})
+        df = read_sql(sql, conn, 'app')
+        with serialize_seconds.time(endpoint=request.endpoint, format=fmt):
+            return result_response(fmt, df, {'sql': sql})
     except Exception as e:
         return jsonify({'error': str(e), 'sql': sql}), 500
     finally:
@@ -389,19 +527,153 @@ def query():
 @app.route('/api/nl2sql', methods=['POST'])
 def nl2sql():
     data = request.get_json()
-    if not data or 'query' not in data:
+    if not data or ('query' not in data and 'queries' not in data):
         return jsonify({'error': 'missing query'}), 400
     
-    nl = data['query']
     table = data.get('table')  # 可选的表名
+    conn_id = data.get('connection_id')  # 可选：按该连接的模式解析表名和列名
     
     try:
+        nlp = get_enhanced_nlp()
+        schema_index = None
+        if conn_id:
+            auth_error = authenticate_request()
+            if auth_error:
+                return auth_error
+            resolved = resolve_connection(conn_id)
+            if resolved is None:
+                return jsonify({'error': 'connection not found'}), 404
+            catalog = schema_catalog.schema_catalog.get_catalog(*resolved)
+            schema_index = schema_indexes.get(conn_id, catalog, nlp.embeddings_model)
+        
+        # 批量模式：一次编码并分类多个问题
+        if 'queries' in data:
+            if not isinstance(data['queries'], list):
+                return jsonify({'error': 'queries must be a list'}), 400
+            return jsonify({'sql': nlp.parse_many(data['queries'], table, schema_index)})
+        
         # 使用增强的NLP模块
-        sql = enhanced_nlp.parse_nl_to_sql(nl, table)
+        sql = nlp.parse_nl_to_sql(data['query'], table, schema_index)
         return jsonify({'sql': sql})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# Look up a connection and its pooled engine; returns (connection, engine) or None
+def resolve_connection(conn_id):
+    session = Session()
+    try:
+        connection = session.query(DatabaseConnection).filter_by(id=conn_id).first()
+    finally:
+        session.close()
+    if not connection:
+        return None
+    return connection, get_db_engine(connection)
+
+# Schema context for a chat question: the most relevant tables of the connection within the schema token budget.
+# Only cached metadata and an already built index are used; on a cold cache they are loaded in the
+# background and the turn goes without a schema block
+def chat_schema_context(conn_id, resolved, question):
+    catalog = schema_catalog.schema_catalog.cached(conn_id)
+    schema_index = None
+    if catalog is not None and catalog.get('details') is not None:
+        schema_index = schema_indexes.peek(conn_id, catalog.get('version'))
+    if schema_index is None:
+        schema_prompts.warm(conn_id, lambda: warm_schema_context(conn_id, resolved))
+        return None
+    return schema_prompts.build(conn_id, catalog, schema_index, question)
+
+def warm_schema_context(conn_id, resolved):
+    catalog = schema_catalog.schema_catalog.get_catalog(*resolved)
+    schema_indexes.get(conn_id, catalog, embeddings_manager.get_embeddings_model())
+
+# Result cache TTL for a request: the request's cache/cacheTtl fields, then the
+# connection's query_cache_ttl option, then CHAT2DB_QUERY_CACHE_TTL
+def query_cache_ttl(conn_id, data):
+    if data.get('cache') is False or 'no-cache' in request.headers.get('Cache-Control', ''):
+        return 0
+    if data.get('cacheTtl') is not None:
+        return max(0.0, float(data['cacheTtl']))
+    ttl = connection_options.connection_options.get(conn_id).get('query_cache_ttl')
+    return QUERY_CACHE_TTL if ttl is None else ttl
+
+# Build a response from the result cache, or None on a miss
+def cached_response(key):
+    hit = query_cache.get(key)
+    if hit is None:
+        return None
+    body, age, mimetype = hit
+    return Response(body, mimetype=mimetype, headers={'X-Cache': 'HIT', 'Age': str(int(age))})
+
+# Store a serialized response in the result cache when ttl > 0 and report MISS/BYPASS
+def cache_response(key, response, ttl, tables=()):
+    if ttl > 0:
+        query_cache.put(key, response.get_data(), ttl, tables, response.mimetype)
+        response.headers['X-Cache'] = 'MISS'
+    else:
+        query_cache.record_bypass()
+        response.headers['X-Cache'] = 'BYPASS'
+    return response
+
+# pd.read_sql_query timed per connection and endpoint; running is the registered query, if any
+def read_sql(sql, conn, conn_id, running=None, **kwargs):
+    import pandas as pd  # 导入较慢，只在执行查询时加载
+    labels = {'connection': conn_id, 'endpoint': request.endpoint}
+    try:
+        with db_query_seconds.time(**labels):
+            return pd.read_sql_query(sql, conn, **kwargs)
+    except Exception as e:
+        reason = running and running.cancel_reason or ('timeout' if is_timeout_error(e) else 'error')
+        db_query_errors.inc(reason=reason, **labels)
+        raise
+
+# Statement timeout for a request: the connection's statement_timeout option or
+# CHAT2DB_STATEMENT_TIMEOUT, which the request's timeout field can only shorten
+def statement_timeout_for(conn_id, data):
+    configured = connection_options.connection_options.get(conn_id).get('statement_timeout')
+    if configured is None:
+        configured = STATEMENT_TIMEOUT
+    return effective_timeout(configured, data.get('timeout'))
+
+def current_user_id():
+    user = getattr(request, 'user', None)
+    return user.get('id') if isinstance(user, dict) else None
+
+# 504 when the statement timeout stopped the query, 409 when it was cancelled
+def query_cancelled_response(error, **extra):
+    status = 504 if error.reason == 'timeout' else 409
+    return jsonify(dict(extra, error=str(error), reason=error.reason, queryId=error.query_id)), status
+
+# Result encoding from resultFormat or the Accept header; returns (format, error response)
+def request_result_format(data):
+    try:
+        fmt = negotiate_result_format(data, request.accept_mimetypes)
+    except ValueError as e:
+        return None, (jsonify({'error': str(e)}), 400)
+    if fmt in BINARY_FORMATS and not pyarrow_available():
+        return None, (jsonify({'error': f'result format {fmt} requires pyarrow'}), 406)
+    return fmt, None
+
+# Encode a query result; meta holds the non-row fields of the response.
+# columns/values may carry the already converted frame_columns(df).
+def result_response(fmt, df, meta, records_key='rows', columns=None, values=None):
+    if fmt in BINARY_FORMATS:
+        return Response(encode_binary(df, fmt, meta), mimetype=RESULT_FORMATS[fmt])
+    if columns is None:
+        columns, values = frame_columns(df)
+    if fmt == 'columnar':
+        response = jsonify(dict(meta, columns=columns, rows=columns_to_rows(values)))
+        response.mimetype = RESULT_FORMATS['columnar']
+        return response
+    payload = dict(meta)
+    payload[records_key] = columns_to_records(columns, values)
+    return jsonify(payload)
+
+# Return a cached JSON payload with an ETag, or 304 when If-None-Match matches
+def conditional_json(payload, etag):
+    response = jsonify(payload)
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
 # Get tables for a specific connection
 @app.route('/api/connections/<conn_id>/tables', methods=['GET'])
 @require_auth
@@ -410,51 +682,29 @@ def get_tables(conn_id):
         # Validate conn_id parameter
         if not conn_id or conn_id.strip() == '':
             return jsonify({'error': 'connection id is required'}), 400
-            
-        # Get the database connection
-        session = Session()
-        connection = session.query(DatabaseConnection).filter_by(id=conn_id).first()
-        if not connection:
-            session.close()
-            return jsonify({'error': 'connection not found'}), 404
-        session.close()
         
-        # Log the connection details for debugging (without sensitive info)
-        app.logger.info(f"Getting tables for connection {conn_id} of type {connection.type}")
+        # Unchanged schema: answer from the catalog without touching the target database
+        cached = schema_catalog.schema_catalog.cached(conn_id)
+        if cached and cached.get('tables') is not None:
+            return conditional_json(cached['tables'], cached['tables_etag'])
         
-        # Create engine for the target database
+        # Get the database connection
+        app.logger.info(f"Getting tables for connection {conn_id}")
         try:
-            engine = get_db_engine(connection)
+            resolved = resolve_connection(conn_id)
         except Exception as e:
             app.logger.error(f"Failed to create engine for connection {conn_id}: {str(e)}")
             return jsonify({'error': f'Failed to connect to database: {str(e)}'}), 500
-        
-        # Get table names
-        query = None
-        if connection.type == 'sqlite':
-            query = "SELECT name FROM sqlite_master WHERE type='table';"
-        elif connection.type == 'mysql':
-            query = f"SELECT table_name as name FROM information_schema.tables WHERE table_schema = '{connection.database}';"
-        elif connection.type == 'postgresql':
-            # 查询所有有权限访问的模式中的表，排除系统模式
-            query = """
-            SELECT CONCAT(schemaname, '.', tablename) as name 
-            FROM pg_tables 
-            WHERE schemaname NOT IN ('information_schema', 'pg_catalog', 'pg_toast')
-            AND schemaname NOT LIKE 'pg_temp_%'
-            AND schemaname NOT LIKE 'pg_toast_temp_%'
-            ORDER BY schemaname, tablename
-            """
-        else:
-            return jsonify({'error': f'Unsupported database type: {connection.type}'}), 400
-            
-        app.logger.info(f"Executing table query: {query}")
+        if resolved is None:
+            return jsonify({'error': 'connection not found'}), 404
+        connection, engine = resolved
         
         try:
-            df = pd.read_sql_query(query, engine)
-            tables = df['name'].tolist()
+            tables, etag = schema_catalog.schema_catalog.get_tables(connection, engine)
             app.logger.info(f"Found {len(tables)} tables for connection {conn_id}")
-            return jsonify(tables)
+            return conditional_json(tables, etag)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         except Exception as e:
             app.logger.error(f"Failed to execute table query for connection {conn_id}: {str(e)}")
             return jsonify({'error': f'Failed to query tables: {str(e)}'}), 500
@@ -468,35 +718,64 @@ def get_tables(conn_id):
 @require_auth
 def get_table_schema(conn_id, table_name):
     try:
+        cached = schema_catalog.schema_catalog.cached(conn_id)
+        if cached and table_name in cached.get('columns', {}):
+            return conditional_json(cached['columns'][table_name], cached['columns_etag'][table_name])
+        
         # Get the database connection
-        session = Session()
-        connection = session.query(DatabaseConnection).filter_by(id=conn_id).first()
-        if not connection:
+        resolved = resolve_connection(conn_id)
+        if resolved is None:
             return jsonify({'error': 'connection not found'}), 404
-        session.close()
-        
-        # Create engine for the target database
-        engine = get_db_engine(connection)
+        connection, engine = resolved
         
-        # Get table schema
-        if connection.type == 'sqlite':
-            query = f"PRAGMA table_info({table_name});"
-        elif connection.type == 'mysql':
-            query = f"DESCRIBE {table_name};"
-        elif connection.type == 'postgresql':
-            # 处理包含模式名的表名 (schema.table)
-            if '.' in table_name:
-                schema_name, table_name_only = table_name.split('.', 1)
-                query = f"SELECT column_name, data_type FROM information_schema.columns WHERE table_name = '{table_name_only}' AND table_schema = '{schema_name}';"
-            else:
-                # 如果只有表名，在所有模式中查找
-                query = f"SELECT column_name, data_type FROM information_schema.columns WHERE table_name = '{table_name}' AND table_schema NOT IN ('information_schema', 'pg_catalog', 'pg_toast');"
-        else:
-            return jsonify({'error': f'Unsupported database type: {connection.type}'}), 400
-            
-        df = pd.read_sql_query(query, engine)
-        schema = df.to_dict(orient='records')
-        return jsonify(schema)
+        try:
+            schema, etag = schema_catalog.schema_catalog.get_table_columns(connection, engine, table_name)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return conditional_json(schema, etag)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Full schema catalog (tables, columns, keys, indexes, row estimates)
+@app.route('/api/connections/<conn_id>/schema', methods=['GET'])
+@require_auth
+def get_schema_catalog(conn_id):
+    try:
+        cached = schema_catalog.schema_catalog.cached(conn_id)
+        if not cached or cached.get('details') is None:
+            resolved = resolve_connection(conn_id)
+            if resolved is None:
+                return jsonify({'error': 'connection not found'}), 404
+            cached = schema_catalog.schema_catalog.get_catalog(*resolved)
+        payload = {
+            'tables': cached['tables'],
+            'details': cached['details'],
+            'version': cached['version'],
+            'refreshedAt': cached['refreshed_at']
+        }
+        return conditional_json(payload, cached['version'])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Refresh the schema catalog on demand
+@app.route('/api/connections/<conn_id>/schema/refresh', methods=['POST'])
+@require_auth
+def refresh_schema_catalog(conn_id):
+    try:
+        resolved = resolve_connection(conn_id)
+        if resolved is None:
+            return jsonify({'error': 'connection not found'}), 404
+        data = request.get_json(silent=True) or {}
+        entry = schema_catalog.schema_catalog.refresh(*resolved, full=data.get('full'))
+        return jsonify({
+            'version': entry['version'],
+            'tables': len(entry['tables']),
+            'refreshedAt': entry['refreshed_at']
+        })
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -507,6 +786,9 @@ def query_table_data(conn_id, table_name):
     try:
         # Get request data
         data = request.get_json() or {}
+        fmt, format_error = request_result_format(data)
+        if format_error:
+            return format_error
         
         # Get the database connection
         session = Session()
@@ -519,210 +801,379 @@ def query_table_data(conn_id, table_name):
         engine = get_db_engine(connection)
         
         # Build query with optional filters, sorting, and pagination
-        # 对于PostgreSQL，如果表名包含模式名，直接使用；否则添加public模式
-        if connection.type == 'postgresql' and '.' not in table_name:
-            # 如果没有指定模式，默认使用public模式
-            query = f"SELECT * FROM public.{table_name}"
-        else:
-            query = f"SELECT * FROM {table_name}"
+        table_ref = qualified_table_name(table_name, connection.type)
         
-        # Add filtering
+        # Primary key and columns; column names from the request are checked against them
+        # because they are interpolated into the SQL
+        try:
+            table_keys = table_keys_for(connection, engine, table_name)
+        except Exception as e:
+            app.logger.warning(f"Failed to read columns of {table_name}: {str(e)}")
+            table_keys = None
         filter_column = data.get('filterColumn')
+        sort_by = data.get('sortBy')
+        for column in (filter_column, sort_by):
+            if column and (table_keys is None or column not in table_keys.columns):
+                return jsonify({'error': f'unknown column: {column}'}), 400
+        
+        # Add filtering (the filter value is bound as a parameter)
+        conditions = []
+        params = {}
         filter_value = data.get('filterValue')
         if filter_column and filter_value:
-            query += f" WHERE {filter_column} LIKE '%{filter_value}%'"
+            conditions.append(f"{filter_column} LIKE :filter_value")
+            params['filter_value'] = f"%{filter_value}%"
         
-        # Add sorting
-        sort_by = data.get('sortBy')
-        sort_order = data.get('sortOrder', 'asc')
-        if sort_by:
-            query += f" ORDER BY {sort_by} {sort_order.upper()}"
+        # Sorting
+        sort_order = str(data.get('sortOrder', 'asc')).lower()
+        if sort_order not in SORT_ORDERS:
+            return jsonify({'error': f'invalid sortOrder: {sort_order}'}), 400
         
-        # Add pagination
-        page = data.get('page', 1)
-        page_size = data.get('pageSize', 50)
-        offset = (page - 1) * page_size
-        query += f" LIMIT {page_size} OFFSET {offset}"
+        page = int(data.get('page', 1) or 1)
+        page_size = int(data.get('pageSize', 50))
+        
+        # Total count strategy: auto (cached/exact, estimate when slow), exact or estimate;
+        # filtered pages have no catalog estimate and report totalCount null instead
+        count_strategy = data.get('count', 'auto')
+        if count_strategy not in COUNT_STRATEGIES:
+            return jsonify({'error': f'invalid count strategy: {count_strategy}'}), 400
+        
+        # Keyset pagination needs a primary key to build a total order, and NOT NULL
+        # sort columns: rows with a NULL sort value would never satisfy the seek condition
+        mode = choose_pagination_mode(data)
+        key_columns = seek_columns(table_keys.primary_key if table_keys else [], sort_by)
+        seekable = can_seek(key_columns, table_keys) if table_keys else False
+        if not seekable:
+            if data.get('cursor'):
+                return jsonify({'error': 'cursor pagination is not available for this sort column'}), 400
+            mode = 'offset'
+        
+        direction = data.get('direction', 'next')
+        query_params = dict(params)
+        query_conditions = list(conditions)
+        if mode == 'keyset':
+            cursor = data.get('cursor')
+            if cursor:
+                try:
+                    cursor_values = decode_cursor(cursor, key_columns, sort_order)
+                except ValueError as e:
+                    return jsonify({'error': str(e)}), 400
+                seek_clause, seek_params = build_seek_clause(key_columns, cursor_values, sort_order, direction)
+                query_conditions.append(seek_clause)
+                query_params.update(seek_params)
+            else:
+                direction = 'next'
+        
+        query = f"SELECT * FROM {table_ref}"
+        if query_conditions:
+            query += " WHERE " + " AND ".join(query_conditions)
+        
+        if mode == 'keyset':
+            # Seek: fetch one extra row to know whether another page exists
+            query += f" ORDER BY {build_order_clause(key_columns, sort_order, direction)}"
+            query += f" LIMIT {page_size + 1}"
+        else:
+            if key_columns:
+                query += f" ORDER BY {build_order_clause(key_columns, sort_order)}"
+            elif sort_by:
+                query += f" ORDER BY {sort_by} {sort_order.upper()}"
+            offset = (page - 1) * page_size
+            query += f" LIMIT {page_size} OFFSET {offset}"
+        
+        # The same page (query, filter values, count strategy) within the TTL comes from the result cache
+        ttl = query_cache_ttl(conn_id, data)
+        cache_key = query_cache.make_key(conn_id, query, query_params, [fmt, count_strategy, page, mode, direction, bool(data.get('cursor'))])
+        if ttl > 0:
+            cached = cached_response(cache_key)
+            if cached is not None:
+                return cached
+        
+        # Start the total count so it runs concurrently with the page fetch
+        timeout = statement_timeout_for(conn_id, data)
+        count_job = table_counter.start(engine, conn_id, connection.type, table_name, conditions, params, count_strategy, timeout)
         
         # Execute query
-        df = pd.read_sql_query(query, engine)
-        # Convert int64 to int for JSON serialization
-        rows = df.to_dict(orient='records')
-        for row in rows:
-            for key, value in row.items():
-                if isinstance(value, (int, float)) and not isinstance(value, bool):
-                    if pd.isna(value):
-                        row[key] = None
-                    else:
-                        row[key] = int(value) if value == int(value) else float(value)
+        with query_registry.run(engine, conn_id, connection.type, query, timeout, current_user_id(), data.get('queryId')) as (conn, running):
+            df = read_sql(text(query), conn, conn_id, running, params=query_params)
         
         # Get total count for pagination
-        # 对于PostgreSQL，如果表名包含模式名，直接使用；否则添加public模式
-        if connection.type == 'postgresql' and '.' not in table_name:
-            count_query = f"SELECT COUNT(*) as count FROM public.{table_name}"
-        else:
-            count_query = f"SELECT COUNT(*) as count FROM {table_name}"
-        if filter_column and filter_value:
-            count_query += f" WHERE {filter_column} LIKE '%{filter_value}%'"
+        total_count, total_count_exact = count_job.result()
         
-        count_df = pd.read_sql_query(count_query, engine)
-        total_count = int(count_df['count'].iloc[0]) if not count_df.empty else 0
+        serialize_started = time.perf_counter()
+        has_more = False
+        if mode == 'keyset':
+            has_more = len(df) > page_size
+            df = df.iloc[:page_size]
+            if direction == 'prev':
+                df = df.iloc[::-1]
+            df = df.reset_index(drop=True)
+        # Column-wise conversion of numpy / driver values to JSON types
+        columns, values = frame_columns(df)
         
-        return jsonify({
-            'data': rows,
+        # Continuation tokens for next/previous navigation
+        def key_at(i):
+            return [values[columns.index(c)][i] for c in key_columns]
+        
+        next_cursor = None
+        prev_cursor = None
+        if mode == 'keyset':
+            if len(df):
+                first_key = key_at(0)
+                last_key = key_at(-1)
+                if direction == 'prev':
+                    next_cursor = encode_cursor(key_columns, last_key, sort_order)
+                    prev_cursor = encode_cursor(key_columns, first_key, sort_order) if has_more else None
+                else:
+                    next_cursor = encode_cursor(key_columns, last_key, sort_order) if has_more else None
+                    prev_cursor = encode_cursor(key_columns, first_key, sort_order) if data.get('cursor') else None
+        elif seekable and len(df):
+            # OFFSET pages also hand out cursors so the next step can seek
+            next_cursor = encode_cursor(key_columns, key_at(-1), sort_order)
+            if page > 1:
+                prev_cursor = encode_cursor(key_columns, key_at(0), sort_order)
+        
+        meta = {
             'totalCount': total_count,
+            'totalCountExact': total_count_exact,
             'page': page,
-            'pageSize': page_size
-        })
+            'pageSize': page_size,
+            'mode': mode,
+            'nextCursor': next_cursor,
+            'prevCursor': prev_cursor
+        }
+        response = result_response(fmt, df, meta, 'data', columns, values)
+        serialize_seconds.observe(time.perf_counter() - serialize_started, endpoint=request.endpoint, format=fmt)
+        response.headers['X-Query-Id'] = running.id
+        return cache_response(cache_key, response, ttl, referenced_tables(query) | {table_name.lower()})
+    except QueryCancelled as e:
+        return query_cancelled_response(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/connections/<conn_id>/options', methods=['GET'])
+@require_auth
+def get_connection_options(conn_id):
+    if resolve_connection(conn_id) is None:
+        return jsonify({'error': 'connection not found'}), 404
+    return jsonify({'options': connection_options.connection_options.get(conn_id)})
+
+@app.route('/api/connections/<conn_id>/options', methods=['PUT'])
+@require_auth
+def update_connection_options(conn_id):
+    data = request.get_json()
+    if not isinstance(data, dict):
+        return jsonify({'error': 'no data provided'}), 400
+    if resolve_connection(conn_id) is None:
+        return jsonify({'error': 'connection not found'}), 404
+    try:
+        options = connection_options.connection_options.update(conn_id, data)
+        # 缓存时间变化后旧条目不再适用
+        query_cache.invalidate(conn_id)
+        return jsonify({'options': options})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Drop cached query results for a connection, or only those reading one table
+@app.route('/api/connections/<conn_id>/cache/invalidate', methods=['POST'])
+@require_auth
+def invalidate_query_cache(conn_id):
+    data = request.get_json(silent=True) or {}
+    removed = query_cache.invalidate(conn_id, data.get('table'))
+    return jsonify({'invalidated': removed})
+
+# Target-database queries currently running for the calling user, in any worker process
+@app.route('/api/queries', methods=['GET'])
+@require_auth
+def list_running_queries():
+    return jsonify({'queries': query_registry.list(request.args.get('connection_id'), current_user_id())})
+
+@app.route('/api/queries/<query_id>/cancel', methods=['POST'])
+@require_auth
+def cancel_query(query_id):
+    running = query_registry.get(query_id)
+    if running is None or running.user_id != current_user_id():
+        return jsonify({'error': 'query not found'}), 404
+    try:
+        if not query_registry.cancel(query_id):
+            return jsonify({'error': 'query already finished'}), 404
+        return jsonify({'message': 'cancel requested', 'queryId': query_id})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/query-cache/stats', methods=['GET'])
+@require_admin
+def query_cache_stats():
+    return jsonify(query_cache.stats())
+
+@app.route('/api/engines/stats', methods=['GET'])
+@require_admin
+def engine_stats():
+    try:
+        return jsonify({'engines': engine_registry.stats()})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Prometheus text format, merged across worker processes (see metrics.py);
+# scrapers send CHAT2DB_METRICS_TOKEN, otherwise an administrator's token is required
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    if not metrics.ENABLED:
+        return jsonify({'error': 'metrics are disabled'}), 404
+    if metrics.scrape_authorized(request.headers.get('Authorization')):
+        return render_metrics()
+    return require_admin(render_metrics)()
+
+def render_metrics():
+    return Response(metrics.registry.render(), mimetype=metrics.CONTENT_TYPE)
+
 @app.route('/health', methods=['GET'])
 def health():
-    return jsonify({'status':'ok'})
+    # 存活检查：模型仍在后台加载时也立即返回
+    return jsonify({'status':'ok', 'ready': readiness.is_ready()})
+
+@app.route('/health/ready', methods=['GET'])
+def health_ready():
+    """Readiness probe: 503 until the embedding model and intent matrix are loaded"""
+    status = readiness.status()
+    return jsonify(status), (200 if status['ready'] else 503)
+
+@app.route('/health/startup', methods=['GET'])
+def health_startup():
+    """Startup profile: import-time phases, warm-up steps and which heavy modules are loaded"""
+    return jsonify(readiness.startup_profile())
 
 
-# Simple helper to call local Ollama HTTP API
-OLLAMA_URL = os.environ.get('OLLAMA_URL', 'http://localhost:11434')
-OLLAMA_MODEL = os.environ.get('OLLAMA_MODEL', 'llama2')
+# Simple helper to call local Ollama HTTP API (pooled client, see ollama_client.py)
 
-def call_ollama(prompt, model=None, timeout=30):
+def call_ollama(prompt, model=None, timeout=30, context=None):
+    """
+    调用 Ollama 生成完整回答
+
+    只发送一次流式 /api/generate 请求并逐块累积文本，模型加载中的状态行
+    在同一个流中处理，不会因为冷启动或异常再次发送整个提示词。
+    context 为上一次生成返回的 Ollama context，返回值中带回本次的 context。
+    """
     model = model or OLLAMA_MODEL
-    print(f"Calling Ollama with prompt: {prompt[:100]}... and model: {model}")  # 添加调试信息
-    # Try the official streaming NDJSON endpoint /api/generate
-    gen_url = f"{OLLAMA_URL}/api/generate"
-    try:
-        # Increase read timeout for large-model generation and allow streaming NDJSON
-        headers_stream = {'Accept': 'application/x-ndjson', 'Content-Type': 'application/json'}
-        # use a longer read timeout (connect timeout short, read timeout long)
-        payload = {"model": model, "prompt": prompt, "stream": False}  # 先尝试非流式
-        with requests.post(gen_url, json=payload, headers=headers_stream, timeout=(5, 300)) as resp:
-            print(f"Non-streaming request to {gen_url}, status: {resp.status_code}")  # 添加调试信息
-            if resp.status_code not in (404, 405):
-                resp.raise_for_status()
-                j = resp.json()
-                print(f"Non-streaming response: {j}")  # 添加调试信息
-                # Check if this is a "load" response and try streaming if so
-                if j.get('done_reason') == 'load':
-                    print("Model is loading, trying streaming...")  # 添加调试信息
-                    # Try streaming instead
-                    return call_ollama_streaming(gen_url, model, prompt, headers_stream, timeout)
-                if 'response' in j and isinstance(j['response'], str):
-                    return {'text': j['response']}
-                # fallback: stringify
-                return {'text': json.dumps(j)}
+    logger.debug("Calling Ollama", extra={'model': model, 'prompt': prompt})
+    try:
+        extra = {'context': context} if context else {}
+        result = ollama_client.generate(model, prompt, **extra)
     except Exception as e:
-        print(f"Non-streaming exception: {str(e)}")  # 添加调试信息
-        # If non-streaming failed, try streaming
-        pass
-
-    # Fallback to streaming
-    return call_ollama_streaming(gen_url, model, prompt, headers_stream, timeout)
-
-def call_ollama_streaming(gen_url, model, prompt, headers_stream, timeout):
-    """Handle streaming responses from Ollama"""
-    try:
-        with requests.post(gen_url, json={"model": model, "prompt": prompt, "stream": True}, headers=headers_stream, stream=True, timeout=(5,300)) as resp:
-            print(f"Streaming request to {gen_url}, status: {resp.status_code}")  # 添加调试信息
-            if resp.status_code not in (404, 405):
-                resp.raise_for_status()
-                full_response = ""
-                # read NDJSON lines and parse the first meaningful GenerateResponse
-                for raw in resp.iter_lines(decode_unicode=True):
-                    if not raw:
-                        continue
-                    try:
-                        j = json.loads(raw)
-                        print(f"Streaming response line: {j}")  # 添加调试信息
-                    except Exception as e:
-                        print(f"JSON parsing error: {str(e)}")  # 添加调试信息
-                        # return raw chunk as fallback
-                        return {'text': raw}
-                    # Ollama GenerateResponse uses field 'response'
-                    if isinstance(j, dict):
-                        if 'response' in j and isinstance(j['response'], str):
-                            full_response += j['response']
-                        elif 'message' in j and isinstance(j['message'], dict):
-                            # Chat style response
-                            msg = j['message']
-                            if isinstance(msg, dict) and 'content' in msg:
-                                full_response += msg.get('content', '')
-                        # If we have a done response with content, return it
-                        if j.get('done') and full_response:
-                            return {'text': full_response}
-                # If we've collected a response, return it
-                if full_response:
-                    return {'text': full_response}
-                # fallback: stringify
-                return {'text': 'No response from model'}
+        logger.warning("Ollama generation failed: %s", e, extra={'model': model})
+        return {'error': f'Error in streaming: {str(e)}'}
+    logger.debug("Generation finished", extra={'model': model, 'done_reason': result['done_reason']})
+    if result['text']:
+        return {'text': result['text'], 'context': result['context']}
+    return {'text': 'No response from model'}
+
+# Server-side chat sessions: pass "sessionId" to /api/chat to continue one
+@app.route('/api/chat/sessions', methods=['GET'])
+@require_auth
+def list_chat_sessions():
+    return jsonify({'sessions': chat_sessions.chat_sessions.list(current_user_id())})
+
+@app.route('/api/chat/sessions', methods=['POST'])
+@require_auth
+def create_chat_session():
+    data = request.get_json(silent=True) or {}
+    try:
+        state = chat_sessions.chat_sessions.create(current_user_id(), data.get('model'), data.get('title'))
+        return jsonify(state.to_dict()), 201
     except Exception as e:
-        last_err = str(e)
-        print(f"Streaming exception: {last_err}")  # 添加调试信息
-        return {'error': f'Error in streaming: {last_err}'}
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/chat/sessions/<session_id>', methods=['GET'])
+@require_auth
+def get_chat_session(session_id):
+    state = chat_sessions.chat_sessions.get(session_id, current_user_id())
+    if state is None:
+        return jsonify({'error': 'chat session not found'}), 404
+    return jsonify(state.to_dict())
+
+@app.route('/api/chat/sessions/<session_id>', methods=['DELETE'])
+@require_auth
+def delete_chat_session(session_id):
+    try:
+        if not chat_sessions.chat_sessions.delete(session_id, current_user_id()):
+            return jsonify({'error': 'chat session not found'}), 404
+        return jsonify({'message': 'chat session deleted'})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
 @app.route('/api/chat', methods=['POST'])
 def chat():
     try:
         data = request.get_json() or {}
-        print(f"Received chat request with data: {data}")  # 添加调试信息
         
         message = data.get('message')
         model = data.get('model')
         history = data.get('history', [])
         stream = data.get('stream', False)  # 添加stream参数
         
+        context = data.get('context')
+        # 上一次返回的 contextTables：context 中已经包含模式的表
+        context_tables = data.get('contextTables')
+        if not isinstance(context_tables, list) or not all(isinstance(t, str) for t in context_tables):
+            context_tables = []
+        session_id = data.get('sessionId')
+        conn_id = data.get('connection_id')  # 可选：在提示词中加入该连接的相关表结构
+        
         if not message:
-            print("Missing message in request")  # 添加调试信息
             return jsonify({'error': 'missing message'}), 400
+        if context is not None and not valid_context(context):
+            return jsonify({'error': 'context must be the token array returned by a previous response'}), 400
+        if session_id or conn_id:
+            auth_error = authenticate_request()
+            if auth_error:
+                return auth_error
 
-        # Build a simple prompt with optional history
-        prompt_parts = []
-        
-        # Add system instruction for structured output
-        system_instruction = """You are a database assistant. Please structure your responses in the following format:
-[THINKING_PROCESS]
-First, explain your thought process and reasoning steps clearly.
-[/THINKING_PROCESS]
-
-[RESPONSE_CONTENT]
-Then, provide your final response to the user's question.
-[/RESPONSE_CONTENT]
-
-Example:
-[THINKING_PROCESS]
-I need to analyze the user's question and consider relevant database information...
-[/THINKING_PROCESS]
+        schema = None
+        if conn_id:
+            resolved = resolve_connection(conn_id)
+            if resolved is None:
+                return jsonify({'error': 'connection not found'}), 404
+            schema = chat_schema_context(conn_id, resolved, message)
 
-[RESPONSE_CONTENT]
-Based on your question, I recommend...
-[/RESPONSE_CONTENT]
+        # 服务端会话：历史与 context 从会话中读取，客户端只发送新的问题
+        chat_session = None
+        if session_id:
+            chat_session = chat_sessions.chat_sessions.get(session_id, current_user_id())
+            if chat_session is None:
+                return jsonify({'error': 'chat session not found'}), 404
+            model = model or chat_session.model or OLLAMA_MODEL
+            history = chat_session.turns
+            context = chat_session.context_for(model)
+            context_tables = chat_session.context_tables_for(model)
+            revision = chat_session.revision
 
-Always follow this exact format. Do not skip either section."""
-        
-        prompt_parts.append(system_instruction)
-        
-        for turn in history:
-            # expect turns like {"role":"user"/"assistant","text":"..."}
-            role = turn.get('role', 'user')
-            text = turn.get('text', '')
-            prompt_parts.append(f"{role}: {text}")
-        prompt_parts.append(f"user: {message}")
-        prompt = "\n".join(prompt_parts) + "\nassistant:"
-        print(f"Generated prompt: {prompt}")  # 添加调试信息
+        # 在 token 预算内压缩历史，或复用上一次返回的 context（只补充 context 中没有的表）
+        plan = build_chat_prompt(message, history, context, schema=schema.text if schema else None,
+                                 context_schema=schema.without(context_tables) if schema else None)
+        context_tables = context_schema_tables(schema, plan.context is not None, context_tables)
+        logger.debug("Chat request", extra={
+            'model': model, 'stream': bool(stream), 'session': session_id, 'prompt': plan.prompt,
+            'schema_tables': schema.tables if schema else None, **plan.stats(),
+        })
 
         # If streaming is requested, return a streaming response
         if stream:
-            print(f"Streaming chat response for model: {model}")  # 添加调试信息
-            return stream_ollama_response(prompt, model=model)
+            on_result = None
+            result_extra = {'contextTables': context_tables} if conn_id else None
+            if chat_session is not None:
+                result_extra = None
+                def on_result(reply, new_context):
+                    chat_sessions.chat_sessions.record_turn(chat_session, message, reply, new_context, model,
+                                                            revision, context_tables)
+            return stream_ollama_response(plan.prompt, model=model, context=plan.context, on_result=on_result,
+                                          result_extra=result_extra)
         
         # Otherwise, use the existing logic for non-streaming
-        print(f"Calling Ollama with model: {model}")  # 添加调试信息
-        resp = call_ollama(prompt, model=model)
-        print(f"Ollama response: {resp}")  # 添加调试信息
+        resp = call_ollama(plan.prompt, model=model, context=plan.context)
         
         # If Ollama returned error, pass back
         if resp and 'error' in resp:
-            print(f"Ollama returned error: {resp['error']}")  # 添加调试信息
             return jsonify({'error': resp['error']}), 500
 
         # Ollama's response shape may vary; return raw content when possible
@@ -741,102 +1192,87 @@ Always follow this exact format. Do not skip either section."""
         else:
             result_text = str(resp)
         
-        print(f"Returning result: {result_text}")  # 添加调试信息
-        return jsonify({'message': result_text, 'raw': resp})
+        logger.debug("Chat response", extra={'model': model, 'response': result_text})
+        body = {
+            'message': result_text,
+            'raw': {'text': resp.get('text')},
+            'context': resp.get('context'),
+            'prompt': plan.stats(),
+        }
+        if schema is not None:
+            body['schema'] = schema.stats()
+        if chat_session is not None:
+            chat_sessions.chat_sessions.record_turn(chat_session, message, result_text, resp.get('context'), model,
+                                                    revision, context_tables)
+            # 会话的 context 保存在服务端
+            body['sessionId'] = chat_session.id
+            body.pop('context')
+        elif body['context'] and conn_id:
+            body['contextTables'] = context_tables
+        return jsonify(body)
     except Exception as e:
-        print(f"Exception in chat endpoint: {str(e)}")  # 添加调试信息
-        import traceback
-        traceback.print_exc()  # 打印完整的错误堆栈
+        logger.exception("Exception in chat endpoint")
         return jsonify({'error': str(e)}), 500
 
-def stream_ollama_response(prompt, model=None, timeout=30):
-    """Stream responses from Ollama"""
+def stream_ollama_response(prompt, model=None, timeout=30, context=None, on_result=None, result_extra=None):
+    """
+    Stream responses from Ollama; the final result event carries the new context
+
+    on_result(reply, context) is called once the generation has finished, before the
+    result event and [DONE]; if it fails, the error is reported in the result event.
+    result_extra is added to the result event along with the context.
+    """
     model = model or OLLAMA_MODEL
-    gen_url = f"{OLLAMA_URL}/api/generate"
+    gen_url = "/api/generate"
     
+    debug_stream = logger.isEnabledFor(logging.DEBUG)
+
     # Define a generator function for streaming
     def generate():
         try:
-            headers = {'Accept': 'application/x-ndjson', 'Content-Type': 'application/json'}
-            payload = {"model": model, "prompt": prompt, "stream": True}
-            
-            print(f"Starting streaming request to {gen_url}")  # 添加调试信息
+            extra = {'context': context} if context else {}
+            payload = generation_payload(model, prompt, **extra)
             
-            with requests.post(gen_url, json=payload, headers=headers, stream=True, timeout=(5, 300)) as resp:
-                print(f"Streaming response status: {resp.status_code}")  # 添加调试信息
+            started = time.perf_counter()
+            with ollama_client.post(gen_url, json=payload, headers=NDJSON_HEADERS, stream=True, metric='chat_stream') as resp:
+                logger.debug("Streaming chat response", extra={'model': model, 'status': resp.status_code})
                 
                 if resp.status_code not in (404, 405):
                     resp.raise_for_status()
                     
-                    # Send the initial SSE message
-                    yield f"data: {json.dumps({'status': 'connected'})}\n\n"
-                    
-                    # Send thinking status to indicate the model is processing
-                    yield f"data: {json.dumps({'status': 'thinking', 'message': 'AI正在思考中...'})}\n\n"
-                    
-                    full_response = ""
-                    response_started = False
+                    translator = ChatStreamTranslator(result_extra)
+                    yield from translator.opening()
                     
                     # Stream the response
-                    for raw in resp.iter_lines(decode_unicode=True):
-                        if not raw:
-                            continue
+                    for j in ollama_client.iter_stream(resp, metric='chat_stream', started=started):
                         try:
-                            j = json.loads(raw)
-                            print(f"Streaming response line: {j}")  # 添加调试信息
-                            
-                            # Handle different types of responses
-                            if isinstance(j, dict):
-                                # Check if this is a done message
-                                if j.get('done', False):
-                                    # Send final result
-                                    if full_response:
-                                        yield f"data: {json.dumps({'status': 'result', 'response': full_response})}\n\n"
-                                    yield "data: [DONE]\n\n"
-                                    break
-                                # Collect response content
-                                elif 'response' in j and isinstance(j['response'], str):
-                                    # Start collecting actual response
-                                    if not response_started:
-                                        response_started = True
-                                        yield f"data: {json.dumps({'status': 'responding', 'message': 'AI正在回答中...'})}\n\n"
-                                    
-                                    full_response += j['response']
-                                    # Send incremental response
-                                    yield f"data: {json.dumps({'status': 'chunk', 'response': j['response']})}\n\n"
-                                elif 'message' in j and isinstance(j['message'], dict):
-                                    # Chat style response
-                                    msg = j['message']
-                                    if isinstance(msg, dict) and 'content' in msg:
-                                        content = msg.get('content', '')
-                                        if content:
-                                            # Start collecting actual response
-                                            if not response_started:
-                                                response_started = True
-                                                yield f"data: {json.dumps({'status': 'responding', 'message': 'AI正在回答中...'})}\n\n"
-                                            
-                                            full_response += content
-                                            # Send incremental response
-                                            yield f"data: {json.dumps({'status': 'chunk', 'response': content})}\n\n"
-                                else:
-                                    # Send other status messages as-is
-                                    yield f"data: {json.dumps(j)}\n\n"
-                            else:
-                                # Send non-dict responses as-is
-                                yield f"data: {json.dumps({'raw': str(j)})}\n\n"
-                                
+                            # 逐 token 的日志只抽样记录
+                            if debug_stream and sample_token():
+                                logger.debug("Streaming response line", extra={'model': model, 'done': j.get('done'), 'response': j.get('response')})
+                            yield from translator.feed(j)
+                            if translator.finished:
+                                break
                         except Exception as e:
-                            print(f"Error processing streaming response: {str(e)}")  # 添加调试信息
-                            yield f"data: {json.dumps({'error': f'Error processing response: {str(e)}'})}\n\n"
+                            logger.warning("Error processing streaming response: %s", e, extra={'model': model})
+                            yield sse({'error': f'Error processing response: {str(e)}'})
                             break
+                    if translator.finished:
+                        error = None
+                        if on_result and translator.full_response:
+                            try:
+                                on_result(translator.full_response, translator.context)
+                            except Exception as e:
+                                logger.warning("Failed to record chat turn: %s", e, extra={'model': model})
+                                error = f'Failed to save chat session: {str(e)}'
+                        yield from translator.closing(error)
                 else:
                     error_msg = f"Error connecting to Ollama: {resp.status_code}"
-                    print(error_msg)  # 添加调试信息
-                    yield f"data: {json.dumps({'error': error_msg})}\n\n"
+                    logger.warning(error_msg, extra={'model': model})
+                    yield sse({'error': error_msg})
         except Exception as e:
             error_msg = f"Error in streaming: {str(e)}"
-            print(error_msg)  # 添加调试信息
-            yield f"data: {json.dumps({'error': error_msg})}\n\n"
+            logger.warning(error_msg, extra={'model': model})
+            yield sse({'error': error_msg})
     
     # Return a Response object with the generator, setting the proper content type for SSE
     return Response(generate(), mimetype='text/event-stream')
@@ -847,12 +1283,11 @@ def models():
     Returns JSON list or an error object when Ollama is unreachable.
     """
     # Some Ollama instances expose available models/tags at /api/tags
-    candidates = ['/api/tags', '/api/models', '/v1/models']
     last_err = None
-    for c in candidates:
+    for c in MODEL_LIST_PATHS:
         try:
-            url = f"{OLLAMA_URL}{c}"
-            r = requests.get(url, timeout=10)
+            url = ollama_client.url(c)
+            r = ollama_client.get(c, timeout=10, metric='models')
             if r.status_code == 404:
                 last_err = f'404 from {url}'
                 continue
@@ -862,34 +1297,18 @@ def models():
                 j = r.json()
             except Exception:
                 return jsonify({'raw': r.text})
-
-            # Ollama /api/tags often returns {"models": [{"name":..., "model":...}, ...]}
-            models_out = []
-            if isinstance(j, dict) and 'models' in j and isinstance(j['models'], list):
-                for item in j['models']:
-                    if isinstance(item, dict):
-                        name = item.get('model') or item.get('name')
-                        if name:
-                            models_out.append(name)
-            elif isinstance(j, list):
-                # could be list of strings or dicts
-                for item in j:
-                    if isinstance(item, str):
-                        models_out.append(item)
-                    elif isinstance(item, dict):
-                        name = item.get('model') or item.get('name')
-                        if name:
-                            models_out.append(name)
-            elif isinstance(j, dict):
-                # maybe dict keyed by name
-                models_out = list(j.keys())
-
-            return jsonify({'models': models_out})
+            return jsonify({'models': normalize_model_list(j)})
         except Exception as e:
             last_err = str(e)
             continue
     return jsonify({'error': f'no models endpoint found: {last_err}'}), 500
 
+@app.route('/api/ollama/stats', methods=['GET'])
+@require_admin
+def ollama_stats():
+    """Connection pool settings and per-call latency / TTFT / tokens-per-second for Ollama"""
+    return jsonify(dict(ollama_client.stats(), warmup=model_warmer.stats()))
+
 # Embeddings相关的API端点
 @app.route('/api/embeddings/encode', methods=['POST'])
 def encode_text():
@@ -911,14 +1330,40 @@ def encode_text():
         return jsonify({'error': 'missing text'}), 400
     
     try:
-        # 初始化 Embeddings 模型
-        embeddings_model = EmbeddingsModel()
-        # 编码文本
-        embedding = embeddings_model.encode(data['text'])
-        # 确保返回的是列表而不是numpy数组
-        if hasattr(embedding, 'tolist'):
-            embedding = embedding.tolist()
-        return jsonify({'embedding': embedding})
+        if isinstance(data['text'], list):
+            embedding = embeddings_manager.get_embeddings_model().encode_batch(data['text'])
+        else:
+            # 单条请求交给微批处理器，与并发请求合并成一次模型调用
+            embedding = embeddings_manager.get_batcher().encode(data['text'])
+        # 只在 JSON 边界把numpy数组转换为列表
+        return jsonify({'embedding': embedding.tolist()})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/embeddings/encode_batch', methods=['POST'])
+def encode_text_batch():
+    """
+    批量将文本编码为向量
+    
+    请求体:
+    {
+        "texts": ["文本1", "文本2", ...]
+    }
+    
+    返回:
+    {
+        "embeddings": [[0.1, 0.2, ...], ...]  # 与输入顺序一致
+    }
+    """
+    data = request.get_json()
+    if not data or not isinstance(data.get('texts'), list):
+        return jsonify({'error': 'missing texts'}), 400
+    if not all(isinstance(t, str) for t in data['texts']):
+        return jsonify({'error': 'texts must be a list of strings'}), 400
+    
+    try:
+        embeddings = embeddings_manager.get_embeddings_model().encode_batch(data['texts'])
+        return jsonify({'embeddings': embeddings.tolist()})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -943,14 +1388,54 @@ def calculate_similarity():
         return jsonify({'error': 'missing text1 or text2'}), 400
     
     try:
-        # 初始化 Embeddings 模型
-        embeddings_model = EmbeddingsModel()
+        # 使用共享的 Embeddings 模型
+        embeddings_model = embeddings_manager.get_embeddings_model()
         # 计算相似度
         similarity = embeddings_model.similarity(data['text1'], data['text2'])
         return jsonify({'similarity': float(similarity)})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/embeddings/status', methods=['GET'])
+def embeddings_status():
+    """
+    返回共享 Embeddings 模型的加载状态
+    
+    返回:
+    {
+        "loaded": true,
+        "backend": "sentence-transformers",
+        "load_time": 1.234,          # 加载耗时（秒）
+        "parameter_bytes": 470000000, # 模型权重大小
+        "rss_delta_bytes": ...,       # 加载前后进程内存增量
+        ...
+    }
+    """
+    return jsonify(embeddings_manager.get_status())
+
+def start_background_tasks():
+    """Start this process's background threads; threads do not survive fork"""
+    # Load the embedding model and intent matrix without blocking startup
+    readiness.start_background_warm_up()
+    # Keep cached schemas fresh in the background
+    schema_catalog.schema_catalog.start_background_refresh(resolve_connection)
+    # Keep OLLAMA_WARM_MODELS resident in Ollama
+    model_warmer.start()
+
+def after_fork():
+    """Called in each pre-forked worker (see gunicorn.conf.py)"""
+    # 日志写线程不会随 fork 复制
+    log_config.after_fork()
+    # 不复用 master 进程中打开的数据库连接
+    app_engine.dispose(close=False)
+    engine_registry.dispose_all(close=False)
+    start_background_tasks()
+
+# 预加载模式下由 worker 在 fork 之后启动后台线程
+if os.environ.get('CHAT2DB_DEFER_BACKGROUND_TASKS') != '1':
+    start_background_tasks()
+readiness.mark('routes')
+
 if __name__ == '__main__':
     # bind to 0.0.0.0 so container exposes it
     app.run(debug=True, host='0.0.0.0', port=5001)
\ No newline at end of file
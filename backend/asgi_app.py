@@ -0,0 +1,277 @@
+"""
+ASGI 服务入口
+
+聊天（含 SSE 流式输出）、模型列表与 Embeddings 接口在这里实现为协程，
+使用 httpx 异步访问 Ollama，等待模型生成时不占用线程，单个进程可以同时
+保持大量流式对话；其余接口原样交给 Flask 应用，在线程池中执行。
+
+运行方式:
+    uvicorn asgi_app:app --host 0.0.0.0 --port 5001
+"""
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+import auth
+import chat_sessions
+from app import app as flask_app, chat_schema_context, resolve_connection
+from chat_prompt import build_chat_prompt, valid_context
+from chat_stream import ChatStreamTranslator, sse
+from schema_prompt import context_schema_tables
+from embeddings import manager as embeddings_manager
+from ollama_client import (
+    MODEL_LIST_PATHS, NDJSON_HEADERS, OLLAMA_MODEL, async_ollama_client, generation_payload,
+    normalize_model_list,
+)
+
+# 执行 Flask 接口（数据库查询等）的线程数
+WSGI_THREADS = int(os.environ.get('CHAT2DB_ASGI_WSGI_THREADS', '16'))
+
+# 与 Flask-CORS 的默认配置一致：允许所有来源
+cors = [Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])]
+
+
+async def read_json(request):
+    try:
+        return await request.json()
+    except Exception:
+        return None
+
+
+async def stream_chat(prompt, model, context=None, on_result=None, result_extra=None):
+    """Async version of app.stream_ollama_response, emitting the same SSE events"""
+    gen_url = "/api/generate"
+    try:
+        extra = {'context': context} if context else {}
+        payload = generation_payload(model, prompt, **extra)
+        started = time.perf_counter()
+        async with async_ollama_client.stream('POST', gen_url, json=payload, headers=NDJSON_HEADERS, metric='chat_stream') as resp:
+            if resp.status_code in (404, 405):
+                yield sse({'error': f"Error connecting to Ollama: {resp.status_code}"})
+                return
+            resp.raise_for_status()
+
+            translator = ChatStreamTranslator(result_extra)
+            for event in translator.opening():
+                yield event
+
+            items = async_ollama_client.iter_stream(resp, metric='chat_stream', started=started)
+            try:
+                async for j in items:
+                    try:
+                        events = translator.feed(j)
+                    except Exception as e:
+                        yield sse({'error': f'Error processing response: {str(e)}'})
+                        break
+                    for event in events:
+                        yield event
+                    if translator.finished:
+                        break
+            finally:
+                await items.aclose()
+            if translator.finished:
+                error = None
+                if on_result and translator.full_response:
+                    try:
+                        await run_in_threadpool(on_result, translator.full_response, translator.context)
+                    except Exception as e:
+                        error = f'Failed to save chat session: {str(e)}'
+                for event in translator.closing(error):
+                    yield event
+    except Exception as e:
+        yield sse({'error': f"Error in streaming: {str(e)}"})
+
+
+async def authenticate(request):
+    """Same checks as app.authenticate_request; returns (user, error response)"""
+    auth_header = request.headers.get('authorization')
+    if not auth_header:
+        return None, JSONResponse({'error': 'Missing authorization header'}, status_code=401)
+    try:
+        user = await run_in_threadpool(auth.auth_service.get_user_by_token, auth_header.split(' ')[1])
+    except Exception as e:
+        return None, JSONResponse({'error': str(e)}, status_code=401)
+    if not user:
+        return None, JSONResponse({'error': 'Invalid token'}, status_code=401)
+    return user, None
+
+
+def load_schema_context(conn_id, question):
+    """Runs in the thread pool: the connection lookup and the question embedding are blocking"""
+    resolved = resolve_connection(conn_id)
+    if resolved is None:
+        return None, False
+    return chat_schema_context(conn_id, resolved, question), True
+
+
+async def chat(request):
+    data = await read_json(request) or {}
+    message = data.get('message')
+    model = data.get('model')
+    history = data.get('history', [])
+    context = data.get('context')
+    context_tables = data.get('contextTables')
+    if not isinstance(context_tables, list) or not all(isinstance(t, str) for t in context_tables):
+        context_tables = []
+    session_id = data.get('sessionId')
+    conn_id = data.get('connection_id')
+    if not message:
+        return JSONResponse({'error': 'missing message'}, status_code=400)
+    if context is not None and not valid_context(context):
+        return JSONResponse({'error': 'context must be the token array returned by a previous response'}, status_code=400)
+    user = None
+    if session_id or conn_id:
+        user, error = await authenticate(request)
+        if error:
+            return error
+
+    schema = None
+    if conn_id:
+        try:
+            schema, found = await run_in_threadpool(load_schema_context, conn_id, message)
+        except Exception as e:
+            return JSONResponse({'error': str(e)}, status_code=500)
+        if not found:
+            return JSONResponse({'error': 'connection not found'}, status_code=404)
+
+    chat_session = None
+    if session_id:
+        chat_session = await run_in_threadpool(chat_sessions.chat_sessions.get, session_id, user['id'])
+        if chat_session is None:
+            return JSONResponse({'error': 'chat session not found'}, status_code=404)
+        model = model or chat_session.model
+        history = chat_session.turns
+    model = model or OLLAMA_MODEL
+    if chat_session is not None:
+        context = chat_session.context_for(model)
+        context_tables = chat_session.context_tables_for(model)
+        revision = chat_session.revision
+
+    plan = build_chat_prompt(message, history, context, schema=schema.text if schema else None,
+                             context_schema=schema.without(context_tables) if schema else None)
+    context_tables = context_schema_tables(schema, plan.context is not None, context_tables)
+
+    def record_turn(reply, new_context):
+        chat_sessions.chat_sessions.record_turn(chat_session, message, reply, new_context, model, revision, context_tables)
+
+    if data.get('stream', False):
+        on_result = record_turn if chat_session is not None else None
+        result_extra = {'contextTables': context_tables} if conn_id and chat_session is None else None
+        return StreamingResponse(stream_chat(plan.prompt, model, plan.context, on_result, result_extra),
+                                 media_type='text/event-stream')
+
+    try:
+        extra = {'context': plan.context} if plan.context else {}
+        result = await async_ollama_client.generate(model, plan.prompt, **extra)
+    except Exception as e:
+        return JSONResponse({'error': f'Error in streaming: {str(e)}'}, status_code=500)
+    resp = {'text': result['text'] or 'No response from model'}
+    body = {
+        'message': resp['text'],
+        'raw': resp,
+        'context': result['context'] if result['text'] else None,
+        'prompt': plan.stats(),
+    }
+    if schema is not None:
+        body['schema'] = schema.stats()
+    if chat_session is not None:
+        await run_in_threadpool(record_turn, resp['text'], body.pop('context'))
+        body['sessionId'] = chat_session.id
+    elif body['context'] and conn_id:
+        body['contextTables'] = context_tables
+    return JSONResponse(body)
+
+
+async def models(request):
+    """Async version of the /api/models proxy"""
+    last_err = None
+    for path in MODEL_LIST_PATHS:
+        try:
+            r = await async_ollama_client.request('GET', path, metric='models', timeout=10)
+            if r.status_code == 404:
+                last_err = f'404 from {async_ollama_client.base_url}{path}'
+                continue
+            r.raise_for_status()
+            try:
+                body = r.json()
+            except Exception:
+                return JSONResponse({'raw': r.text})
+            return JSONResponse({'models': normalize_model_list(body)})
+        except Exception as e:
+            last_err = str(e)
+    return JSONResponse({'error': f'no models endpoint found: {last_err}'}, status_code=500)
+
+
+def _encode_batch(texts):
+    return embeddings_manager.get_embeddings_model().encode_batch(texts)
+
+
+def _similarity(text1, text2):
+    return embeddings_manager.get_embeddings_model().similarity(text1, text2)
+
+
+async def encode_text(request):
+    data = await read_json(request)
+    if not data or 'text' not in data:
+        return JSONResponse({'error': 'missing text'}, status_code=400)
+    try:
+        if isinstance(data['text'], list):
+            embedding = await run_in_threadpool(_encode_batch, data['text'])
+        else:
+            # 等待微批处理器的 Future，不占用线程
+            embedding = await asyncio.wrap_future(embeddings_manager.get_batcher().submit(data['text']))
+        return JSONResponse({'embedding': embedding.tolist()})
+    except Exception as e:
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+
+async def encode_text_batch(request):
+    data = await read_json(request)
+    if not data or not isinstance(data.get('texts'), list):
+        return JSONResponse({'error': 'missing texts'}, status_code=400)
+    if not all(isinstance(t, str) for t in data['texts']):
+        return JSONResponse({'error': 'texts must be a list of strings'}, status_code=400)
+    try:
+        embeddings = await run_in_threadpool(_encode_batch, data['texts'])
+        return JSONResponse({'embeddings': embeddings.tolist()})
+    except Exception as e:
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+
+async def calculate_similarity(request):
+    data = await read_json(request)
+    if not data or 'text1' not in data or 'text2' not in data:
+        return JSONResponse({'error': 'missing text1 or text2'}, status_code=400)
+    try:
+        similarity = await run_in_threadpool(_similarity, data['text1'], data['text2'])
+        return JSONResponse({'similarity': float(similarity)})
+    except Exception as e:
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # 模型由 app.start_background_tasks() 在后台加载，/health/ready 报告就绪状态
+    yield
+    await async_ollama_client.aclose()
+
+
+app = Starlette(
+    routes=[
+        Route('/api/chat', chat, methods=['POST', 'OPTIONS'], middleware=cors),
+        Route('/api/models', models, methods=['GET', 'OPTIONS'], middleware=cors),
+        Route('/api/embeddings/encode', encode_text, methods=['POST', 'OPTIONS'], middleware=cors),
+        Route('/api/embeddings/encode_batch', encode_text_batch, methods=['POST', 'OPTIONS'], middleware=cors),
+        Route('/api/embeddings/similarity', calculate_similarity, methods=['POST', 'OPTIONS'], middleware=cors),
+        # 其他接口交给 Flask 应用
+        Mount('/', app=WSGIMiddleware(flask_app, workers=WSGI_THREADS)),
+    ],
+    lifespan=lifespan,
+)
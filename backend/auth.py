@@ -1,37 +1,89 @@
 import hashlib
 import secrets
+import threading
+import time
 import jwt
+import logging
 import os
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import inspect
-from models import User, Role, UserRole
+from models import User, Role, UserRole, UserRoleChange
+from metrics import auth_token_seconds
+
+logger = logging.getLogger(__name__)
 
 # JWT配置
 JWT_SECRET = os.environ.get('JWT_SECRET', 'chat2db_secret_key')
 JWT_ALGORITHM = 'HS256'
 JWT_EXPIRATION_DELTA = timedelta(hours=24)
 
+# 已验证 token 的进程内缓存配置
+TOKEN_CACHE_SIZE = int(os.environ.get('CHAT2DB_TOKEN_CACHE_SIZE', '1024'))
+TOKEN_CACHE_TTL = float(os.environ.get('CHAT2DB_TOKEN_CACHE_TTL', '300'))
+# 用户角色的最后修改时间在每个进程内缓存的秒数；其他 worker 中的修改最多延迟这么久生效
+ROLE_CHANGE_TTL = float(os.environ.get('CHAT2DB_ROLE_CHANGE_TTL', '10'))
+
+class TokenCache:
+    """Bounded LRU of verified token -> (user, role names, time the roles are valid as of), entries expire with the token"""
+    
+    def __init__(self, max_size=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # token -> (expires_at, user, roles, roles_as_of)
+        self._entries = OrderedDict()
+    
+    def get(self, token: str):
+        with self._lock:
+            entry = self._entries.get(token)
+            if not entry:
+                return None
+            if entry[0] <= time.time():
+                del self._entries[token]
+                return None
+            self._entries.move_to_end(token)
+            return entry[1], entry[2], entry[3]
+    
+    def put(self, token: str, user: dict, roles: list, token_exp: float, roles_as_of: float):
+        expires_at = min(time.time() + self.ttl, token_exp)
+        with self._lock:
+            self._entries[token] = (expires_at, user, roles, roles_as_of)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+    
+    def invalidate_user(self, user_id: str):
+        with self._lock:
+            for token in [t for t, e in self._entries.items() if e[1]['id'] == user_id]:
+                del self._entries[token]
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
 class AuthService:
     def __init__(self, engine):
         self.engine = engine
         self.Session = sessionmaker(bind=engine)
+        self.token_cache = TokenCache()
+        # user_id -> (checked_at, changed_at)：user_role_changes 表在本进程内的缓存
+        self._role_changes = {}
         
         # 检查数据库连接和表是否存在
         try:
             inspector = inspect(engine)
             tables = inspector.get_table_names()
-            print(f"Database tables: {tables}")
+            logger.debug("Database tables", extra={'tables': tables})
             
             # 检查必要的表是否存在
             required_tables = ['users', 'roles', 'user_roles']
             missing_tables = [table for table in required_tables if table not in tables]
             if missing_tables:
-                print(f"Warning: Missing tables: {missing_tables}")
+                logger.warning("Missing tables: %s", missing_tables)
         except Exception as e:
-            print(f"Warning: Could not inspect database: {e}")
-        
-        print("AuthService.__init__ completed successfully")
+            logger.warning("Could not inspect database: %s", e)
     
     def hash_password(self, password: str) -> str:
         """Hash a password with a salt"""
@@ -82,6 +134,7 @@ class AuthService:
             
             session.add(user_role)
             session.commit()
+            self.invalidate_user(user.id, session)
             
             return user.to_dict()
         except Exception as e:
@@ -106,10 +159,13 @@ class AuthService:
             if not self.verify_password(password, user.password_hash):
                 raise ValueError("Invalid password")
             
-            # Generate JWT token
+            # Generate JWT token, embedding role names so verification needs no role lookup
+            roles = self._query_role_names(session, user.id)
             payload = {
                 'user_id': user.id,
                 'username': user.username,
+                'roles': roles,
+                'iat': int(time.time()),
                 'exp': datetime.utcnow() + JWT_EXPIRATION_DELTA
             }
             
@@ -122,24 +178,90 @@ class AuthService:
         finally:
             session.close()
     
-    def get_user_by_token(self, token: str) -> dict:
-        """Get user information from JWT token"""
+    def verify_token(self, token: str):
+        """Verify a JWT token and return (user, role names); user is None if it no longer exists"""
+        cached = self.token_cache.get(token)
+        if cached:
+            user_dict, roles, roles_as_of = cached
+            if roles_as_of >= self.roles_changed_at(user_dict['id']):
+                return user_dict, roles
+            self.token_cache.invalidate_user(user_dict['id'])
+        
         try:
             payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-            user_id = payload['user_id']
-            
-            session = self.Session()
-            try:
-                user = session.query(User).filter(User.id == user_id).first()
-                if user:
-                    return user.to_dict()
-                return None
-            finally:
-                session.close()
         except jwt.ExpiredSignatureError:
             raise ValueError("Token has expired")
         except jwt.InvalidTokenError:
             raise ValueError("Invalid token")
+        
+        user_id = payload['user_id']
+        session = self.Session()
+        try:
+            user = session.query(User).filter(User.id == user_id).first()
+            if not user:
+                return None, []
+            # Trust the role claims unless the user's roles changed after the token was issued
+            roles = payload.get('roles')
+            roles_as_of = payload.get('iat', 0)
+            if roles is None or roles_as_of < self.roles_changed_at(user_id, session):
+                roles = self._query_role_names(session, user_id)
+                roles_as_of = time.time()
+            user_dict = user.to_dict()
+        finally:
+            session.close()
+        
+        self.token_cache.put(token, user_dict, roles, payload['exp'], roles_as_of)
+        return user_dict, roles
+    
+    def get_user_by_token(self, token: str) -> dict:
+        """Get user information from JWT token"""
+        started = time.perf_counter()
+        outcome = 'invalid'
+        try:
+            user, _ = self.verify_token(token)
+            outcome = 'ok' if user else 'unknown_user'
+            return user
+        finally:
+            auth_token_seconds.observe(time.perf_counter() - started, outcome=outcome)
+    
+    def roles_changed_at(self, user_id: str, session=None) -> float:
+        """Time of the user's last user/role change, from user_role_changes; cached for ROLE_CHANGE_TTL seconds"""
+        cached = self._role_changes.get(user_id)
+        if cached and time.monotonic() - cached[0] < ROLE_CHANGE_TTL:
+            return cached[1]
+        own_session = session is None
+        session = session or self.Session()
+        try:
+            changed_at = session.query(UserRoleChange.changed_at).filter(UserRoleChange.user_id == user_id).scalar()
+        finally:
+            if own_session:
+                session.close()
+        changed_at = changed_at or 0
+        self._role_changes[user_id] = (time.monotonic(), changed_at)
+        return changed_at
+    
+    def invalidate_user(self, user_id: str, session=None):
+        """Record a user/role change so every worker stops trusting older tokens; call after writing User or UserRole"""
+        changed_at = time.time()
+        own_session = session is None
+        session = session or self.Session()
+        try:
+            session.merge(UserRoleChange(user_id=user_id, changed_at=changed_at))
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            if own_session:
+                session.close()
+        self._role_changes[user_id] = (time.monotonic(), changed_at)
+        self.token_cache.invalidate_user(user_id)
+    
+    def _query_role_names(self, session, user_id: str) -> list:
+        role_ids = [ur.role_id for ur in session.query(UserRole).filter(UserRole.user_id == user_id).all()]
+        if not role_ids:
+            return []
+        return [role.name for role in session.query(Role).filter(Role.id.in_(role_ids)).all()]
     
     def get_user_roles(self, user_id: str) -> list:
         """Get all roles for a user"""
@@ -168,14 +290,10 @@ auth_service = None
 def init_auth_service(engine):
     global auth_service
     try:
-        print("Initializing AuthService...")
         auth_service = AuthService(engine)
-        print("AuthService initialized successfully")
-        print(f"auth_service after initialization: {auth_service}")
+        logger.info("AuthService initialized")
         return auth_service
-    except Exception as e:
-        print(f"Failed to initialize AuthService: {e}")
-        import traceback
-        traceback.print_exc()
+    except Exception:
+        logger.exception("Failed to initialize AuthService")
         auth_service = None
         raise
@@ -0,0 +1,90 @@
+"""
+表数据类型转换的微基准
+
+比较旧实现（df.to_dict 之后逐行逐列 isinstance / pd.isna / int(value) == value）
+与按列转换（result_format.frame_columns）在宽表上的耗时。
+
+用法: python bench_type_coercion.py [行数] [列数] [重复次数]
+"""
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np
+import pandas as pd
+from result_format import columns_to_records, frame_columns
+
+
+def make_frame(rows, cols):
+    """Wide page resembling read_sql_query output: mostly numeric columns, some with NULLs"""
+    rng = np.random.default_rng(0)
+    data = {}
+    for i in range(cols):
+        kind = i % 6
+        if kind == 0:
+            data[f'id_{i}'] = np.arange(rows, dtype=np.int64)
+        elif kind == 1:
+            # 含 NULL 的整数列被 pandas 读成 float64
+            values = rng.integers(0, 1000, rows).astype(np.float64)
+            values[rng.random(rows) < 0.1] = np.nan
+            data[f'nullable_int_{i}'] = values
+        elif kind == 2:
+            data[f'amount_{i}'] = rng.random(rows) * 1000
+        elif kind == 3:
+            data[f'price_{i}'] = [Decimal(int(v)) / 100 for v in rng.integers(0, 100000, rows)]
+        elif kind == 4:
+            start = datetime(2024, 1, 1)
+            data[f'created_{i}'] = pd.to_datetime([start + timedelta(minutes=int(v)) for v in rng.integers(0, 10 ** 6, rows)])
+        else:
+            data[f'name_{i}'] = [f'name-{v}' for v in rng.integers(0, 1000, rows)]
+    return pd.DataFrame(data)
+
+
+def legacy_rows(df):
+    # query_table_data 之前的实现
+    rows = df.to_dict(orient='records')
+    for row in rows:
+        for key, value in row.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                if pd.isna(value):
+                    row[key] = None
+                else:
+                    row[key] = int(value) if value == int(value) else float(value)
+    return rows
+
+
+def columnwise_rows(df):
+    columns, values = frame_columns(df)
+    return columns_to_records(columns, values)
+
+
+def columnwise_values(df):
+    # columnar 格式不需要构造每行的字典
+    return frame_columns(df)
+
+
+def best_of(fn, df, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(df)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run_benchmark(rows=1000, cols=60, repeat=5):
+    df = make_frame(rows, cols)
+    print(f"{rows} rows x {cols} columns, best of {repeat}")
+    legacy = best_of(legacy_rows, df, repeat)
+    print(f"  per-cell loop (records):   {legacy * 1000:8.1f} ms")
+    for name, fn in (('column-wise (records)', columnwise_rows), ('column-wise (columnar)', columnwise_values)):
+        elapsed = best_of(fn, df, repeat)
+        print(f"  {name + ':':26} {elapsed * 1000:8.1f} ms  ({legacy / elapsed:.1f}x)")
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:4]]
+    run_benchmark(*args)
@@ -0,0 +1,172 @@
+"""
+对话提示词的构造与 token 预算
+
+最近几轮对话原样保留，更早的轮次压缩成每轮一行的摘要，预算不够时再丢弃
+最早的摘要。客户端带回上一次生成返回的 Ollama context（已编码的对话前缀）时
+只发送新的一轮，Ollama 不必重新处理整段对话。
+"""
+import os
+import re
+
+# Add system instruction for structured output
+SYSTEM_INSTRUCTION = """You are a database assistant. Please structure your responses in the following format:
+[THINKING_PROCESS]
+First, explain your thought process and reasoning steps clearly.
+[/THINKING_PROCESS]
+
+[RESPONSE_CONTENT]
+Then, provide your final response to the user's question.
+[/RESPONSE_CONTENT]
+
+Example:
+[THINKING_PROCESS]
+I need to analyze the user's question and consider relevant database information...
+[/THINKING_PROCESS]
+
+[RESPONSE_CONTENT]
+Based on your question, I recommend...
+[/RESPONSE_CONTENT]
+
+Always follow this exact format. Do not skip either section."""
+
+SUMMARY_HEADER = "Earlier conversation (summarized):"
+
+# 提示词（或复用的 context）的 token 上限，应小于模型的 num_ctx
+CHAT_TOKEN_BUDGET = int(os.environ.get('CHAT2DB_CHAT_TOKEN_BUDGET', '3072'))
+# 原样保留的最近轮数
+CHAT_RECENT_TURNS = int(os.environ.get('CHAT2DB_CHAT_RECENT_TURNS', '6'))
+# 摘要中每轮保留的字符数
+SUMMARY_TURN_CHARS = 160
+
+_CJK = re.compile('[\u3000-\u9fff\uac00-\ud7af\uff00-\uffef]')
+_SENTENCE_END = re.compile(r'(?<=[.!?。！？])\s')
+# 结构化回答中只有 RESPONSE_CONTENT 部分对后续对话有用
+_RESPONSE_CONTENT = re.compile(r'\[RESPONSE_CONTENT\](.*?)(?:\[/RESPONSE_CONTENT\]|$)', re.S)
+
+
+def estimate_tokens(text):
+    """Rough token count without the model's tokenizer: ~4 characters per token, one token per CJK character"""
+    if not text:
+        return 0
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def format_turn(role, text):
+    return f"{role}: {text}"
+
+
+def summarize_turn(role, text):
+    """One line per turn: the answer part of structured replies, cut at the first sentence"""
+    match = _RESPONSE_CONTENT.search(text)
+    if match and match.group(1).strip():
+        text = match.group(1)
+    text = ' '.join(text.split())
+    text = _SENTENCE_END.split(text, 1)[0]
+    if len(text) > SUMMARY_TURN_CHARS:
+        text = text[:SUMMARY_TURN_CHARS].rstrip() + '...'
+    return f"- {role}: {text}"
+
+
+def valid_context(context):
+    return isinstance(context, list) and all(isinstance(t, int) and not isinstance(t, bool) for t in context)
+
+
+class ChatPrompt:
+    def __init__(self, prompt, context=None, kept=0, summarized=0, dropped=0):
+        self.prompt = prompt
+        # 随请求发送给 Ollama 的 context，None 表示从头处理提示词
+        self.context = context
+        self.kept = kept
+        self.summarized = summarized
+        self.dropped = dropped
+
+    @property
+    def tokens(self):
+        # 复用 context 时 Ollama 只需处理新的一轮
+        return estimate_tokens(self.prompt)
+
+    def stats(self):
+        return {
+            'tokens': self.tokens,
+            'contextReused': self.context is not None,
+            'contextTokens': len(self.context) if self.context else 0,
+            'turnsKept': self.kept,
+            'turnsSummarized': self.summarized,
+            'turnsDropped': self.dropped,
+        }
+
+
+def normalize_history(message, history):
+    # expect turns like {"role":"user"/"assistant","text":"..."}
+    turns = []
+    for turn in history or []:
+        if not isinstance(turn, dict):
+            continue
+        text = turn.get('text') or turn.get('content') or ''
+        if text:
+            turns.append((turn.get('role', 'user'), text))
+    # 前端发送的历史已经包含本次的问题
+    if turns and turns[-1] == ('user', message):
+        turns.pop()
+    return turns
+
+
+def build_chat_prompt(message, history=None, context=None, budget=CHAT_TOKEN_BUDGET,
+                      recent_turns=CHAT_RECENT_TURNS, system=SYSTEM_INSTRUCTION, schema=None,
+                      context_schema=None):
+    """
+    Build the prompt for one chat turn within a token budget
+
+    Args:
+        message: 本次的问题
+        history: 之前的轮次 [{"role", "text"}]
+        context: 上一次生成返回的 Ollama context，长度在预算内时直接复用
+        schema: 与本次问题相关的数据库模式（见 schema_prompt.py），计入预算
+        context_schema: 复用 context 时随新的一轮发送的模式，只包含 context 中还没有的表
+    """
+    current = format_turn('user', message) + "\nassistant:"
+    if context and valid_context(context):
+        # 模式已经编码在 context 中，只发送本次问题新用到的表，context 不会每轮增长一整块模式
+        turn = f"{context_schema}\n{current}" if context_schema else current
+        if len(context) + estimate_tokens(turn) <= budget:
+            return ChatPrompt(turn, context=context)
+
+    if schema:
+        system = f"{system}\n\n{schema}"
+    turns = normalize_history(message, history)
+    remaining = budget - estimate_tokens(system) - estimate_tokens(current)
+
+    # 从最近的轮次向前原样保留
+    kept = []
+    for role, text in reversed(turns[-recent_turns:] if recent_turns > 0 else []):
+        line = format_turn(role, text)
+        cost = estimate_tokens(line)
+        if cost > remaining:
+            break
+        kept.append(line)
+        remaining -= cost
+    kept.reverse()
+
+    # 更早的轮次压缩成摘要，预算不够时丢弃最早的
+    older = turns[:len(turns) - len(kept)]
+    summary = []
+    if older:
+        remaining -= estimate_tokens(SUMMARY_HEADER)
+        for role, text in reversed(older):
+            line = summarize_turn(role, text)
+            cost = estimate_tokens(line)
+            if cost > remaining:
+                break
+            summary.append(line)
+            remaining -= cost
+        summary.reverse()
+
+    prompt_parts = [system]
+    if summary:
+        prompt_parts.append(SUMMARY_HEADER)
+        prompt_parts.extend(summary)
+    prompt_parts.extend(kept)
+    prompt_parts.append(current)
+    return ChatPrompt("\n".join(prompt_parts), kept=len(kept), summarized=len(summary),
+                      dropped=len(older) - len(summary))
@@ -0,0 +1,227 @@
+import json
+import os
+import secrets
+import threading
+from collections import OrderedDict
+from models import ChatSession
+
+# 内存中保留的活跃会话数，超出时淘汰最久未使用的会话（数据已在数据库中）
+CHAT_SESSIONS_ACTIVE = int(os.environ.get('CHAT2DB_CHAT_SESSIONS_ACTIVE', '256'))
+# 每个会话保存的最多轮数，更早的轮次丢弃（提示词只使用最近的轮次与摘要）
+CHAT_SESSION_MAX_TURNS = int(os.environ.get('CHAT2DB_CHAT_SESSION_MAX_TURNS', '200'))
+# 并发写入同一会话时 record_turn 的最多尝试次数
+RECORD_TURN_ATTEMPTS = 5
+
+
+class ChatSessionState:
+    def __init__(self, row):
+        self.id = row.id
+        self.user_id = row.user_id
+        self.title = row.title
+        self.model = row.model
+        self.turns = json.loads(row.turns) if row.turns else []
+        self.context = json.loads(row.context) if row.context else None
+        self.context_model = row.context_model
+        self.context_tables = json.loads(row.context_tables) if row.context_tables else []
+        self.revision = row.revision or 0
+        self.created_at = row.created_at
+        self.updated_at = row.updated_at
+        # 同一会话的多轮并发写入时保持顺序
+        self.lock = threading.Lock()
+
+    def context_for(self, model):
+        """Cached Ollama context, only when it was produced by the same model"""
+        return self.context if self.context and self.context_model == model else None
+
+    def context_tables_for(self, model):
+        """Tables whose schema is in the context returned by context_for(model)"""
+        return self.context_tables if self.context_for(model) else []
+
+    def to_dict(self, include_turns=True):
+        result = {
+            'id': self.id,
+            'title': self.title,
+            'model': self.model,
+            'turn_count': len(self.turns),
+            'context_tokens': len(self.context) if self.context else 0,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None,
+        }
+        if include_turns:
+            result['turns'] = self.turns
+        return result
+
+
+class ChatSessionStore:
+    """
+    服务端保存的对话会话
+
+    轮次与最后一次生成返回的 Ollama context 保存在应用数据库的 chat_sessions 表中，
+    活跃会话解析后缓存在进程内的 LRU 里。每次写入都直接落库并递增 revision，
+    多 worker 部署时其他进程根据 revision 发现缓存已过期并重新加载。
+    """
+
+    def __init__(self, session_factory, max_active=CHAT_SESSIONS_ACTIVE, max_turns=CHAT_SESSION_MAX_TURNS):
+        self.Session = session_factory
+        self.max_active = max_active
+        self.max_turns = max_turns
+        self._lock = threading.Lock()
+        # session_id -> ChatSessionState
+        self._active = OrderedDict()
+        self.hits = 0
+        self.loads = 0
+
+    def _remember(self, state):
+        with self._lock:
+            self._active[state.id] = state
+            self._active.move_to_end(state.id)
+            while len(self._active) > self.max_active:
+                self._active.popitem(last=False)
+
+    def _forget(self, session_id):
+        with self._lock:
+            self._active.pop(session_id, None)
+
+    def create(self, user_id, model=None, title=None):
+        session = self.Session()
+        try:
+            row = ChatSession(id=f"chat-{secrets.token_hex(8)}", user_id=user_id, model=model, title=title,
+                              turns='[]', revision=0)
+            session.add(row)
+            session.commit()
+            state = ChatSessionState(row)
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        self._remember(state)
+        return state
+
+    def get(self, session_id, user_id):
+        """The user's session, from memory when the stored revision is unchanged; None if not found"""
+        with self._lock:
+            state = self._active.get(session_id)
+            if state is not None:
+                self._active.move_to_end(session_id)
+
+        session = self.Session()
+        try:
+            if state is not None:
+                # 只读取 revision，判断其他 worker 是否修改过该会话
+                revision = session.query(ChatSession.revision).filter_by(id=session_id).scalar()
+                if revision is None:
+                    self._forget(session_id)
+                    return None
+                if revision == state.revision:
+                    self.hits += 1
+                    return state if state.user_id == user_id else None
+            row = session.query(ChatSession).filter_by(id=session_id).first()
+            if not row:
+                return None
+            previous = state
+            state = ChatSessionState(row)
+            if previous is not None:
+                # 重新加载的副本沿用原来的锁，本进程内对同一会话的写入仍然串行
+                state.lock = previous.lock
+            self.loads += 1
+        finally:
+            session.close()
+
+        self._remember(state)
+        return state if state.user_id == user_id else None
+
+    def list(self, user_id):
+        session = self.Session()
+        try:
+            rows = session.query(ChatSession).filter_by(user_id=user_id).order_by(ChatSession.updated_at.desc()).all()
+            return [row.to_dict() for row in rows]
+        finally:
+            session.close()
+
+    def record_turn(self, state, message, reply, context=None, model=None, revision=None, context_tables=None):
+        """
+        Append a question and its reply, keep the new context and write the session through
+
+        轮次追加到数据库中的最新轮次之后，UPDATE 只在 revision 未变时生效，冲突时重新读取
+        再追加，其他 worker 同时写入的轮次不会被覆盖。revision 是构造提示词时会话的版本，
+        之后如果有其他轮次写入，新的 context 不包含这些轮次，不再保存。
+        """
+        if revision is None:
+            revision = state.revision
+        with state.lock:
+            for _ in range(RECORD_TURN_ATTEMPTS):
+                session = self.Session()
+                try:
+                    row = session.query(ChatSession).filter_by(id=state.id).first()
+                    if not row:
+                        self._forget(state.id)
+                        return state
+                    current = row.revision or 0
+                    turns = json.loads(row.turns) if row.turns else []
+                    turns.append({'role': 'user', 'text': message})
+                    turns.append({'role': 'assistant', 'text': reply})
+                    if len(turns) > self.max_turns:
+                        del turns[:len(turns) - self.max_turns]
+                    # 没有返回 context 或会话已被其他请求修改时清空，避免下一轮复用不完整的 context
+                    if current != revision:
+                        context = None
+                    values = {
+                        'turns': json.dumps(turns, ensure_ascii=False),
+                        'context': json.dumps(context) if context else None,
+                        'context_model': model if context else None,
+                        'context_tables': json.dumps(context_tables) if context and context_tables else None,
+                        'model': model or row.model,
+                        'title': row.title or message[:80],
+                        'revision': current + 1,
+                    }
+                    updated = session.query(ChatSession).filter_by(id=state.id, revision=row.revision).update(
+                        values, synchronize_session=False)
+                    session.commit()
+                    if not updated:
+                        continue
+                    state.turns = turns
+                    state.context = context or None
+                    state.context_model = values['context_model']
+                    state.context_tables = list(context_tables or []) if context else []
+                    state.model = values['model']
+                    state.title = values['title']
+                    state.revision = current + 1
+                    state.updated_at = session.query(ChatSession.updated_at).filter_by(id=state.id).scalar()
+                    return state
+                except Exception:
+                    session.rollback()
+                    # 内存中的状态与数据库不一致，下次重新加载
+                    self._forget(state.id)
+                    raise
+                finally:
+                    session.close()
+        self._forget(state.id)
+        raise RuntimeError(f'chat session {state.id} is being modified concurrently, turn not saved')
+
+    def delete(self, session_id, user_id):
+        self._forget(session_id)
+        session = self.Session()
+        try:
+            deleted = session.query(ChatSession).filter_by(id=session_id, user_id=user_id).delete()
+            session.commit()
+            return deleted > 0
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def stats(self):
+        with self._lock:
+            active = len(self._active)
+        return {'active': active, 'max_active': self.max_active, 'hits': self.hits, 'loads': self.loads}
+
+
+# Create global chat session store
+chat_sessions = None
+
+def init_chat_sessions(session_factory):
+    global chat_sessions
+    chat_sessions = ChatSessionStore(session_factory)
+    return chat_sessions
@@ -0,0 +1,83 @@
+import json
+
+SSE_DONE = "data: [DONE]\n\n"
+
+
+def sse(payload):
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+class ChatStreamTranslator:
+    """
+    把 Ollama 的流式输出转换为前端使用的 SSE 事件
+
+    Flask 与 ASGI 两种服务方式共用，保证事件格式一致。生成结束后 feed 不再返回事件，
+    调用方完成收尾工作（例如保存会话）后用 closing() 发出 result 事件与 [DONE]，
+    收尾失败时错误放在 result 事件中，只读到 [DONE] 的客户端也能看到。
+    """
+
+    def __init__(self, result_extra=None):
+        self.full_response = ""
+        # 与 context 一起放入 result 事件的字段，例如 contextTables
+        self.result_extra = result_extra or {}
+        self.response_started = False
+        self.finished = False
+        # Ollama context of the finished generation
+        self.context = None
+
+    def opening(self):
+        # Send the initial SSE message, then a thinking status to indicate the model is processing
+        return [
+            sse({'status': 'connected'}),
+            sse({'status': 'thinking', 'message': 'AI正在思考中...'}),
+        ]
+
+    def _content(self, content):
+        events = []
+        # Start collecting actual response
+        if not self.response_started:
+            self.response_started = True
+            events.append(sse({'status': 'responding', 'message': 'AI正在回答中...'}))
+        self.full_response += content
+        # Send incremental response
+        events.append(sse({'status': 'chunk', 'response': content}))
+        return events
+
+    def feed(self, j):
+        """Translate one stream item into a list of SSE events; sets finished at the end"""
+        if not isinstance(j, dict):
+            # Send non-dict responses as-is
+            return [sse({'raw': str(j)})]
+        # 模型加载完成的状态行，继续读取同一个流
+        if j.get('done') and j.get('done_reason') == 'load':
+            return [sse({'status': 'loading', 'message': '模型加载完成'})]
+        # Check if this is a done message
+        if j.get('done', False):
+            self.finished = True
+            self.context = j.get('context')
+            return []
+        if 'response' in j and isinstance(j['response'], str):
+            return self._content(j['response'])
+        if 'message' in j and isinstance(j['message'], dict):
+            # Chat style response
+            content = j['message'].get('content', '')
+            return self._content(content) if content else []
+        # Send other status messages as-is
+        return [sse(j)]
+
+    def closing(self, error=None):
+        """Final result event followed by [DONE]; error is reported in the result event"""
+        events = []
+        # Send final result; context lets the client continue without resending the history
+        if self.full_response:
+            result = {'status': 'result', 'response': self.full_response}
+            if self.context:
+                result['context'] = self.context
+                result.update(self.result_extra)
+            if error:
+                result['error'] = error
+            events.append(sse(result))
+        elif error:
+            events.append(sse({'error': error}))
+        events.append(SSE_DONE)
+        return events
@@ -0,0 +1,114 @@
+import json
+import os
+import threading
+import time
+from models import ConnectionOptions
+
+# 选项在每个进程内缓存的时间（秒）；其他 worker 修改的选项最多延迟这么久生效
+CONNECTION_OPTIONS_TTL = float(os.environ.get('CHAT2DB_CONNECTION_OPTIONS_TTL', '5'))
+
+# 可按连接配置的选项及其校验函数；未配置的选项使用各模块的全局默认值
+OPTION_VALIDATORS = {
+    # 查询结果缓存时间（秒），0 表示该连接不缓存
+    'query_cache_ttl': lambda v: max(0.0, float(v)),
+    # 语句超时（秒），0 表示不限制
+    'statement_timeout': lambda v: max(0.0, float(v)),
+}
+
+
+def validate_options(values):
+    """Return cleaned options; raises ValueError on unknown keys or bad values"""
+    cleaned = {}
+    for key, value in (values or {}).items():
+        if key not in OPTION_VALIDATORS:
+            raise ValueError(f'unknown connection option: {key}')
+        if value is None:
+            cleaned[key] = None
+            continue
+        try:
+            cleaned[key] = OPTION_VALIDATORS[key](value)
+        except (TypeError, ValueError):
+            raise ValueError(f'invalid value for {key}: {value!r}')
+    return cleaned
+
+
+class ConnectionOptionsStore:
+    """
+    连接级别的调优选项
+
+    保存在应用数据库的 connection_options 表中，读取后在进程内缓存 ttl 秒，
+    请求路径上通常不需要查询数据库。多 worker 部署时修改只会立即更新处理该请求
+    的 worker，其他 worker 在缓存过期后重新读取。
+    """
+
+    def __init__(self, session_factory, ttl=CONNECTION_OPTIONS_TTL):
+        self.Session = session_factory
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # conn_id -> (loaded_at, dict)
+        self._cache = {}
+
+    def get(self, conn_id):
+        with self._lock:
+            cached = self._cache.get(conn_id)
+        if cached is not None and time.monotonic() - cached[0] < self.ttl:
+            return cached[1]
+
+        session = self.Session()
+        try:
+            row = session.query(ConnectionOptions).filter_by(connection_id=conn_id).first()
+            options = json.loads(row.options) if row and row.options else {}
+        finally:
+            session.close()
+
+        with self._lock:
+            self._cache[conn_id] = (time.monotonic(), options)
+        return options
+
+    def update(self, conn_id, values):
+        """Merge validated values into the stored options; None removes an option"""
+        cleaned = validate_options(values)
+        session = self.Session()
+        try:
+            row = session.query(ConnectionOptions).filter_by(connection_id=conn_id).first()
+            if not row:
+                row = ConnectionOptions(connection_id=conn_id)
+                session.add(row)
+            options = json.loads(row.options) if row.options else {}
+            for key, value in cleaned.items():
+                if value is None:
+                    options.pop(key, None)
+                else:
+                    options[key] = value
+            row.options = json.dumps(options)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+        with self._lock:
+            self._cache[conn_id] = (time.monotonic(), options)
+        return options
+
+    def delete(self, conn_id):
+        with self._lock:
+            self._cache.pop(conn_id, None)
+        session = self.Session()
+        try:
+            session.query(ConnectionOptions).filter_by(connection_id=conn_id).delete()
+            session.commit()
+        except Exception:
+            session.rollback()
+        finally:
+            session.close()
+
+
+# Create global connection options store
+connection_options = None
+
+def init_connection_options(session_factory):
+    global connection_options
+    connection_options = ConnectionOptionsStore(session_factory)
+    return connection_options
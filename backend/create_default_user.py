@@ -6,7 +6,8 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 import secrets
 import hashlib
-from models import User, UserRole
+import time
+from models import User, UserRole, UserRoleChange
 
 # 数据库路径
 DB_PATH = os.environ.get('CHAT2DB_DB', '/data/chat2db.sqlite')
@@ -54,6 +55,8 @@ def create_default_user():
         )
         
         session.add(user_role)
+        # 运行中的服务据此重新读取该用户的角色
+        session.merge(UserRoleChange(user_id=user.id, changed_at=time.time()))
         session.commit()
         
         print("Default admin user created successfully")
@@ -0,0 +1,140 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+# 磁盘缓存文件位置与内存层大小；CHAT2DB_EMBED_CACHE=0 关闭缓存
+EMBED_CACHE_ENABLED = os.environ.get('CHAT2DB_EMBED_CACHE', '1') not in ('0', 'false', 'no', 'off')
+EMBED_CACHE_PATH = os.environ.get('CHAT2DB_EMBED_CACHE_PATH', '/data/embeddings_cache.sqlite')
+EMBED_CACHE_MEMORY_ITEMS = int(os.environ.get('CHAT2DB_EMBED_CACHE_MEMORY_ITEMS', '10000'))
+
+# SQLite 单条语句的参数个数有上限，分块查询
+_SQL_CHUNK = 500
+
+
+class EmbeddingCache:
+    """
+    以内容哈希为键的向量缓存
+
+    键为 sha256(模型名 + 文本)，值为 float32 向量。内存中保留一个 LRU 层，
+    磁盘层是 SQLite 中的 BLOB 表，进程重启后仍然有效。
+    """
+
+    def __init__(self, path=EMBED_CACHE_PATH, max_memory_items=EMBED_CACHE_MEMORY_ITEMS):
+        self.path = path
+        self.max_memory_items = max_memory_items
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._conn = None
+        self._pid = None
+        self._disk_error = None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(model_name, text):
+        return hashlib.sha256(f"{model_name}\0{text}".encode('utf-8')).hexdigest()
+
+    def _connection(self):
+        """Open the SQLite store lazily (and again after fork); None when disabled"""
+        if not self.path:
+            return None
+        if self._conn is not None and self._pid == os.getpid():
+            return self._conn
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS embeddings ('
+                'key TEXT PRIMARY KEY, model TEXT, dim INTEGER, vector BLOB, created_at REAL)'
+            )
+            conn.commit()
+        except Exception as e:
+            # 磁盘不可用时只使用内存层
+            self._disk_error = str(e)
+            self.path = None
+            return None
+        self._conn = conn
+        self._pid = os.getpid()
+        return conn
+
+    def _remember(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def get_many(self, model_name, texts):
+        """Return a list aligned with texts: cached vector or None"""
+        keys = [self.make_key(model_name, t) for t in texts]
+        result = [None] * len(texts)
+        missing = {}
+
+        with self._lock:
+            for i, key in enumerate(keys):
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                    result[i] = vector
+                    self.memory_hits += 1
+                else:
+                    missing.setdefault(key, []).append(i)
+
+            conn = self._connection() if missing else None
+            if conn is not None:
+                pending = list(missing)
+                for start in range(0, len(pending), _SQL_CHUNK):
+                    chunk = pending[start:start + _SQL_CHUNK]
+                    placeholders = ','.join('?' * len(chunk))
+                    rows = conn.execute(
+                        f'SELECT key, vector FROM embeddings WHERE key IN ({placeholders})', chunk
+                    ).fetchall()
+                    for key, blob in rows:
+                        vector = np.frombuffer(blob, dtype=np.float32)
+                        self._remember(key, vector)
+                        for i in missing.pop(key):
+                            result[i] = vector
+                            self.disk_hits += 1
+
+            self.misses += sum(len(v) for v in missing.values())
+        return result
+
+    def put_many(self, model_name, texts, vectors):
+        rows = []
+        with self._lock:
+            for text, vector in zip(texts, vectors):
+                key = self.make_key(model_name, text)
+                vector = np.asarray(vector, dtype=np.float32)
+                # 缓存中的向量被多个调用方共享，设为只读
+                vector.setflags(write=False)
+                self._remember(key, vector)
+                rows.append((key, model_name, int(vector.shape[0]), vector.tobytes(), time.time()))
+
+            conn = self._connection()
+            if conn is None:
+                return
+            try:
+                conn.executemany('INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?)', rows)
+                conn.commit()
+            except Exception as e:
+                self._disk_error = str(e)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                'memory_items': len(self._memory),
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+                'path': self.path,
+                'disk_error': self._disk_error,
+            }
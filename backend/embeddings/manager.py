@@ -0,0 +1,113 @@
+import os
+import threading
+import time
+from embeddings.batcher import MicroBatcher
+from embeddings.cache import EMBED_CACHE_ENABLED, EmbeddingCache
+from embeddings.model import EmbeddingsModel
+
+# 微批处理参数：单批最大条数与收集请求的最长等待时间（毫秒）
+EMBED_BATCH_SIZE = int(os.environ.get('CHAT2DB_EMBED_BATCH_SIZE', '64'))
+EMBED_BATCH_WAIT_MS = float(os.environ.get('CHAT2DB_EMBED_BATCH_WAIT_MS', '5'))
+
+# 以文本哈希为键的向量缓存（内存 LRU + 磁盘 SQLite）
+_cache = EmbeddingCache() if EMBED_CACHE_ENABLED else None
+
+# 进程内共享的 EmbeddingsModel 实例，避免每个请求重新探测 Ollama 并重新加载模型权重
+_model = None
+_lock = threading.Lock()
+_status = {
+    'loaded': False,
+    'loading': False,
+    'backend': None,
+    'load_time': None,
+    'loaded_at': None,
+    'parameter_bytes': None,
+    'rss_delta_bytes': None,
+    'error': None,
+}
+
+
+def _current_rss():
+    """Resident set size of this process in bytes, or None when unavailable"""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except Exception:
+        return None
+
+
+def _parameter_bytes(model):
+    """Size of the model weights when the backend is a torch module"""
+    inner = getattr(model, 'model', None)
+    parameters = getattr(inner, 'parameters', None)
+    if not callable(parameters):
+        return None
+    try:
+        return sum(p.numel() * p.element_size() for p in parameters())
+    except Exception:
+        return None
+
+
+def get_embeddings_model():
+    """
+    获取共享的 Embeddings 模型，首次调用时加载
+
+    多个 Flask 请求线程并发调用时只会加载一次。
+    """
+    global _model
+    if _model is not None:
+        return _model
+
+    with _lock:
+        if _model is not None:
+            return _model
+
+        _status['loading'] = True
+        rss_before = _current_rss()
+        start = time.perf_counter()
+        try:
+            model = EmbeddingsModel(cache=_cache)
+        except Exception as e:
+            _status['error'] = str(e)
+            raise
+        finally:
+            _status['loading'] = False
+
+        rss_after = _current_rss()
+        _status.update({
+            'loaded': True,
+            'backend': getattr(model, 'backend', None),
+            'load_time': round(time.perf_counter() - start, 3),
+            'loaded_at': time.time(),
+            'parameter_bytes': _parameter_bytes(model),
+            'rss_delta_bytes': rss_after - rss_before if rss_before is not None and rss_after is not None else None,
+            'error': None,
+        })
+        _model = model
+        return _model
+
+
+# 合并并发单条编码请求的微批处理器
+_batcher = MicroBatcher(
+    lambda texts: get_embeddings_model().encode_batch(texts),
+    max_batch_size=EMBED_BATCH_SIZE,
+    max_wait_ms=EMBED_BATCH_WAIT_MS,
+)
+
+
+def get_batcher():
+    return _batcher
+
+
+def is_loaded():
+    return _model is not None
+
+
+def get_status():
+    """Load status of the shared model; never triggers a load"""
+    status = dict(_status)
+    status['rss_bytes'] = _current_rss()
+    status['batcher'] = _batcher.stats()
+    status['cache'] = _cache.stats() if _cache is not None else None
+    return status
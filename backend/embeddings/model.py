@@ -1,17 +1,22 @@
-from sentence_transformers import SentenceTransformer
+import logging
 import numpy as np
 import os
-import requests
-import json
+from ollama_client import ollama_client
+from metrics import embedding_encode_seconds
+from embeddings.similarity import cosine_similarity
+
+logger = logging.getLogger(__name__)
 
 class EmbeddingsModel:
-    def __init__(self, model_name='sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2'):
+    def __init__(self, model_name='sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2', cache=None):
         """
         初始化Embeddings模型
         
         Args:
             model_name: 模型名称，默认使用多语言的MiniLM模型
+            cache: 可选的 EmbeddingCache，命中时跳过模型计算
         """
+        self.cache = cache
         # 设置环境变量以解决SSL问题
         os.environ['CURL_CA_BUNDLE'] = ''
         os.environ['REQUESTS_CA_BUNDLE'] = ''
@@ -21,14 +26,24 @@ class EmbeddingsModel:
         self.use_ollama = self._check_ollama_available()
         if self.use_ollama:
             self.ollama_model = "all-minilm"  # Ollama中的模型名称
-            print("使用本地Ollama模型")
+            self.backend = 'ollama'
+            self.model_name = f"ollama:{self.ollama_model}"
+            logger.info("使用本地Ollama模型", extra={'model': self.ollama_model})
         else:
             # 使用本地模型或默认模型，避免网络连接
             try:
+                # sentence-transformers（连带 torch/transformers）导入很慢，只在需要时导入
+                import transformers
+                transformers.utils.offline_mode = True
+                from sentence_transformers import SentenceTransformer
                 # 尝试使用本地模型
                 self.model = SentenceTransformer('all-MiniLM-L6-v2', trust_remote_code=True)
+                self.backend = 'sentence-transformers'
+                self.model_name = 'sentence-transformers:all-MiniLM-L6-v2'
             except Exception as e:
-                print(f"加载本地模型失败: {e}")
+                logger.warning("加载本地模型失败: %s", e)
+                self.backend = 'random'
+                self.model_name = None
                 # 创建一个简单的随机模型作为后备方案
                 class SimpleModel:
                     def encode(self, texts):
@@ -36,61 +51,117 @@ class EmbeddingsModel:
                         if isinstance(texts, str):
                             texts = [texts]
                         # 为每个文本返回随机向量
-                        return np.random.rand(len(texts), 384).tolist()
+                        return np.random.rand(len(texts), 384).astype(np.float32)
                 
                 self.model = SimpleModel()
     
     def _check_ollama_available(self):
         """检查Ollama服务是否可用"""
         try:
-            response = requests.get("http://localhost:11434/api/tags", timeout=5)
+            # 启动探测不重试，Ollama 不可用时尽快回退到本地模型
+            response = ollama_client.get('/api/tags', timeout=5, retries=0, metric='tags')
             return response.status_code == 200
         except:
             return False
     
     def _get_ollama_embedding(self, text):
         """使用Ollama获取文本嵌入"""
-        try:
-            response = requests.post(
-                "http://localhost:11434/api/embeddings",
-                json={
-                    "model": self.ollama_model,
-                    "prompt": text
-                },
-                timeout=30
-            )
-            if response.status_code == 200:
-                return response.json()["embedding"]
-            else:
-                raise Exception(f"Ollama API error: {response.status_code}")
-        except Exception as e:
-            print(f"获取Ollama嵌入失败: {e}")
-            # 返回随机向量作为后备
-            return np.random.rand(384).tolist()
+        response = ollama_client.post(
+            '/api/embeddings',
+            json={
+                "model": self.ollama_model,
+                "prompt": text
+            },
+            timeout=30,
+            metric='embeddings'
+        )
+        if response.status_code == 200:
+            return response.json()["embedding"]
+        raise Exception(f"Ollama API error: {response.status_code}")
+    
+    def _get_ollama_embeddings(self, texts):
+        """使用Ollama的 /api/embed 接口一次获取多个文本的嵌入"""
+        response = ollama_client.post(
+            '/api/embed',
+            json={
+                "model": self.ollama_model,
+                "input": texts
+            },
+            timeout=30,
+            metric='embed'
+        )
+        if response.status_code == 404:
+            # 旧版本 Ollama 没有批量接口，逐条请求
+            return [self._get_ollama_embedding(t) for t in texts]
+        if response.status_code == 200:
+            return response.json()["embeddings"]
+        raise Exception(f"Ollama API error: {response.status_code}")
+    
+    def _compute(self, texts):
+        """
+        调用模型编码文本
+        
+        Returns:
+            (float32 数组, 结果是否可以缓存)；随机后备向量不可缓存
+        """
+        with embedding_encode_seconds.time(backend=self.backend, call='model'):
+            if self.use_ollama:
+                try:
+                    result = self._get_ollama_embeddings(texts)
+                except Exception as e:
+                    logger.warning("获取Ollama嵌入失败: %s", e)
+                    # 返回随机向量作为后备
+                    return np.random.rand(len(texts), 384).astype(np.float32), False
+                return np.asarray(result, dtype=np.float32).reshape(len(texts), -1), True
+            # SentenceTransformer 对整个批次做一次前向计算
+            result = self.model.encode(texts)
+            return np.asarray(result, dtype=np.float32).reshape(len(texts), -1), self.backend != 'random'
+    
+    def encode_batch(self, texts):
+        """
+        批量编码文本
+        
+        Args:
+            texts: 文本列表
+            
+        Returns:
+            形状为 (len(texts), dim) 的 float32 numpy 数组
+        """
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, 384), dtype=np.float32)
+        # 包括缓存查询在内的总耗时；模型本身的耗时记录为 call="model"
+        with embedding_encode_seconds.time(backend=self.backend, call='encode_batch'):
+            return self._encode_batch(texts)
+    
+    def _encode_batch(self, texts):
+        if self.cache is None or not self.model_name:
+            return self._compute(texts)[0]
+        
+        # 先查缓存，只对未命中的文本（去重后）调用模型
+        cached = self.cache.get_many(self.model_name, texts)
+        missing = list(dict.fromkeys(t for t, v in zip(texts, cached) if v is None))
+        computed = {}
+        if missing:
+            vectors, cacheable = self._compute(missing)
+            if cacheable:
+                self.cache.put_many(self.model_name, missing, vectors)
+            computed = dict(zip(missing, vectors))
+        return np.stack([v if v is not None else computed[t] for t, v in zip(texts, cached)]).astype(np.float32, copy=False)
     
     def encode(self, text):
         """
         将文本编码为向量
         
         Args:
-            text: 输入文本
+            text: 输入文本（字符串或字符串列表）
             
         Returns:
-            文本的向量表示
+            文本的向量表示（float32 numpy 数组；输入为列表时为二维数组）
         """
-        if self.use_ollama:
-            # 使用Ollama获取嵌入
-            if isinstance(text, str):
-                return self._get_ollama_embedding(text)
-            elif isinstance(text, list):
-                return [self._get_ollama_embedding(t) for t in text]
-        else:
-            # 使用原有的SentenceTransformer模型
-            result = self.model.encode(text)
-            # 如果结果是numpy数组，转换为列表
-            if isinstance(result, np.ndarray):
-                return result.tolist()
-            return result
+        if isinstance(text, str):
+            return self.encode_batch([text])[0]
+        return self.encode_batch(text)
     
     def similarity(self, text1, text2):
         """
@@ -103,43 +174,5 @@ class EmbeddingsModel:
         Returns:
             两个文本的余弦相似度
         """
-        if self.use_ollama:
-            # 使用Ollama模型计算相似度
-            embedding1 = self.encode(text1)
-            embedding2 = self.encode(text2)
-            
-            # 转换为numpy数组
-            if isinstance(embedding1, list) and not isinstance(embedding1, np.ndarray):
-                embedding1 = np.array(embedding1)
-            if isinstance(embedding2, list) and not isinstance(embedding2, np.ndarray):
-                embedding2 = np.array(embedding2)
-                
-            # 确保是1D向量
-            if embedding1.ndim > 1:
-                embedding1 = embedding1[0]
-            if embedding2.ndim > 1:
-                embedding2 = embedding2[0]
-                
-            return float(np.dot(embedding1, embedding2) / (np.linalg.norm(embedding1) * np.linalg.norm(embedding2)))
-        else:
-            # 如果模型是简单模型，直接返回随机相似度
-            if hasattr(self.model, 'encode') and callable(self.model.encode):
-                embedding1 = self.encode(text1)
-                embedding2 = self.encode(text2)
-                
-                # 如果返回的是列表，转换为numpy数组
-                if isinstance(embedding1, list) and not isinstance(embedding1, np.ndarray):
-                    embedding1 = np.array(embedding1)
-                if isinstance(embedding2, list) and not isinstance(embedding2, np.ndarray):
-                    embedding2 = np.array(embedding2)
-                    
-                # 确保是1D向量
-                if embedding1.ndim > 1:
-                    embedding1 = embedding1[0]
-                if embedding2.ndim > 1:
-                    embedding2 = embedding2[0]
-                    
-                return float(np.dot(embedding1, embedding2) / (np.linalg.norm(embedding1) * np.linalg.norm(embedding2)))
-            else:
-                # 简单模型返回随机相似度
-                return float(np.random.rand())
\ No newline at end of file
+        embeddings = self.encode_batch([text1, text2])
+        return float(cosine_similarity(embeddings[0], embeddings[1]))
@@ -0,0 +1,189 @@
+import os
+import re
+import threading
+import numpy as np
+from embeddings.similarity import normalize_rows
+
+# 表数量超过该值时默认启用近似最近邻（IVF）检索
+ANN_MIN_ITEMS = int(os.environ.get('CHAT2DB_SCHEMA_ANN_MIN_ITEMS', '2000'))
+ANN_PROBES = int(os.environ.get('CHAT2DB_SCHEMA_ANN_PROBES', '8'))
+# 表文档中最多列出的列数，避免超长文本
+MAX_COLUMNS_PER_TABLE_DOC = 40
+
+
+def humanize(identifier):
+    """order_items / OrderItems -> "order items" """
+    identifier = re.sub(r'([a-z0-9])([A-Z])', r'\1 \2', identifier or '')
+    return re.sub(r'[_\-.]+', ' ', identifier).strip().lower()
+
+
+def top_k(scores, k):
+    """Indices of the k highest scores, best first"""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.array([], dtype=np.int64)
+    idx = np.argpartition(-scores, k - 1)[:k]
+    return idx[np.argsort(-scores[idx])]
+
+
+class IVFIndex:
+    """
+    简单的倒排文件（IVF）近似最近邻索引
+
+    用球面 k-means 把单位向量分成 n_lists 个簇，查询时只在与查询最接近的
+    n_probe 个簇内做精确点积。
+    """
+
+    def __init__(self, matrix, n_lists=None, n_probe=ANN_PROBES, iterations=10, seed=0):
+        self.matrix = matrix
+        n = len(matrix)
+        self.n_lists = max(1, min(n, n_lists or int(np.sqrt(n))))
+        self.n_probe = max(1, min(n_probe, self.n_lists))
+
+        rng = np.random.default_rng(seed)
+        centroids = matrix[rng.choice(n, self.n_lists, replace=False)]
+        for _ in range(iterations):
+            assign = np.argmax(matrix @ centroids.T, axis=1)
+            for i in range(self.n_lists):
+                members = matrix[assign == i]
+                # 空簇保留原中心
+                if len(members):
+                    centroids[i] = members.sum(axis=0)
+            centroids = normalize_rows(centroids)
+        self.centroids = centroids
+        assign = np.argmax(matrix @ centroids.T, axis=1)
+        self.lists = [np.flatnonzero(assign == i) for i in range(self.n_lists)]
+
+    def search(self, query, k):
+        probes = top_k(self.centroids @ query, self.n_probe)
+        candidates = np.concatenate([self.lists[i] for i in probes])
+        if not len(candidates):
+            return candidates, np.array([], dtype=np.float32)
+        scores = self.matrix[candidates] @ query
+        best = top_k(scores, k)
+        return candidates[best], scores[best]
+
+
+class SchemaIndex:
+    """
+    连接的表/列语义检索索引
+
+    根据模式缓存中的表名、列名与注释生成文本，编码为归一化的 float32 矩阵；
+    查询向量与矩阵做一次点积即可得到最相关的表和列。
+    """
+
+    def __init__(self, embeddings_model, catalog, ann=None):
+        self.embeddings_model = embeddings_model
+        self.version = catalog.get('version')
+        details = catalog.get('details') or {}
+        self.table_names = list(catalog.get('tables') or details.keys())
+
+        table_docs = []
+        self.column_refs = []
+        column_docs = []
+        for name in self.table_names:
+            info = details.get(name) or {}
+            columns = info.get('columns') or []
+            short_name = name.split('.', 1)[-1]
+            doc = humanize(short_name)
+            if info.get('comment'):
+                doc += f" ({info['comment']})"
+            if columns:
+                doc += ': ' + ', '.join(humanize(c['name']) for c in columns[:MAX_COLUMNS_PER_TABLE_DOC])
+            table_docs.append(doc)
+            for col in columns:
+                col_doc = f"{humanize(short_name)} {humanize(col['name'])}"
+                if col.get('comment'):
+                    col_doc += f" ({col['comment']})"
+                self.column_refs.append((name, col['name']))
+                column_docs.append(col_doc)
+
+        self.table_matrix = self._embed(table_docs)
+        self.column_matrix = self._embed(column_docs)
+        self.column_tables = np.array([t for t, _ in self.column_refs], dtype=object)
+
+        use_ann = ann if ann is not None else len(self.table_names) >= ANN_MIN_ITEMS
+        self.table_ann = IVFIndex(self.table_matrix) if use_ann and len(self.table_names) > 1 else None
+
+        # 精确匹配表名（忽略大小写与模式前缀）
+        self._names = {}
+        for name in self.table_names:
+            self._names.setdefault(name.lower(), name)
+            self._names.setdefault(name.split('.', 1)[-1].lower(), name)
+
+    def _embed(self, docs):
+        if not docs:
+            return np.zeros((0, 1), dtype=np.float32)
+        return normalize_rows(self.embeddings_model.encode_batch(docs))
+
+    def _query_vector(self, query):
+        if isinstance(query, str):
+            query = self.embeddings_model.encode(query)
+        return normalize_rows(query)
+
+    def lookup_table(self, name):
+        """Return the real table name for an exact (case-insensitive) mention, else None"""
+        if not name:
+            return None
+        return self._names.get(name.lower())
+
+    def search_tables(self, query, k=5):
+        """Return [(table_name, score)] for the k most similar tables"""
+        if not self.table_names:
+            return []
+        q = self._query_vector(query)
+        if self.table_ann is not None:
+            idx, scores = self.table_ann.search(q, k)
+        else:
+            scores = self.table_matrix @ q
+            idx = top_k(scores, k)
+            scores = scores[idx]
+        return [(self.table_names[i], float(s)) for i, s in zip(idx, scores)]
+
+    def search_columns(self, query, table_name=None, k=5):
+        """Return [(table_name, column_name, score)], optionally within one table"""
+        if not self.column_refs:
+            return []
+        q = self._query_vector(query)
+        if table_name is not None:
+            rows = np.flatnonzero(self.column_tables == table_name)
+            if not len(rows):
+                return []
+            scores = self.column_matrix[rows] @ q
+            best = top_k(scores, k)
+            return [(*self.column_refs[rows[i]], float(scores[i])) for i in best]
+        scores = self.column_matrix @ q
+        best = top_k(scores, k)
+        return [(*self.column_refs[i], float(scores[i])) for i in best]
+
+
+class SchemaIndexRegistry:
+    """One SchemaIndex per connection, rebuilt when the catalog version changes"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._indexes = {}
+
+    def get(self, conn_id, catalog, embeddings_model):
+        with self._lock:
+            index = self._indexes.get(conn_id)
+        if index is not None and index.version == catalog.get('version'):
+            return index
+        index = SchemaIndex(embeddings_model, catalog)
+        with self._lock:
+            self._indexes[conn_id] = index
+        return index
+
+    def peek(self, conn_id, version):
+        """The index for this catalog version if it is already built, else None"""
+        with self._lock:
+            index = self._indexes.get(conn_id)
+        return index if index is not None and index.version == version else None
+
+    def invalidate(self, conn_id):
+        with self._lock:
+            self._indexes.pop(conn_id, None)
+
+
+# Create global schema index registry
+schema_indexes = SchemaIndexRegistry()
@@ -11,4 +11,15 @@ def cosine_similarity(vec1, vec2):
     Returns:
         两个向量的余弦相似度
     """
-    return np.dot(vec1, vec2) / (np.linalg.norm(vec1) * np.linalg.norm(vec2))
\ No newline at end of file
+    return np.dot(vec1, vec2) / (np.linalg.norm(vec1) * np.linalg.norm(vec2))
+
+def normalize_rows(matrix):
+    """
+    把向量（或矩阵的每一行）归一化为单位长度的 float32 数组
+
+    预先归一化后，余弦相似度就是一次点积。
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
@@ -0,0 +1,179 @@
+import hashlib
+import os
+import threading
+import time
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+
+
+def _env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value not in (None, '') else default
+
+
+def _env_bool(name, default):
+    value = os.environ.get(name)
+    if value in (None, ''):
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+# 每种数据库类型的连接池默认配置，可通过环境变量覆盖，例如:
+#   CHAT2DB_POOL_MYSQL_SIZE=10
+#   CHAT2DB_POOL_POSTGRESQL_MAX_OVERFLOW=20
+#   CHAT2DB_POOL_MYSQL_RECYCLE=1800
+#   CHAT2DB_POOL_POSTGRESQL_PRE_PING=0
+#   CHAT2DB_POOL_MYSQL_TIMEOUT=30
+DEFAULT_POOL_CONFIG = {
+    'mysql': {'pool_size': 5, 'max_overflow': 10, 'pool_recycle': 1800, 'pool_pre_ping': True, 'pool_timeout': 30},
+    'postgresql': {'pool_size': 5, 'max_overflow': 10, 'pool_recycle': 1800, 'pool_pre_ping': True, 'pool_timeout': 30},
+    # SQLite 由 SQLAlchemy 自行选择连接池实现，只允许配置 pre-ping / recycle
+    'sqlite': {'pool_recycle': -1, 'pool_pre_ping': False},
+}
+
+
+def get_pool_config(db_type):
+    """Return the pool configuration for a connection type, applying env overrides"""
+    config = dict(DEFAULT_POOL_CONFIG.get(db_type, {}))
+    prefix = f"CHAT2DB_POOL_{db_type.upper()}_"
+    for key in ('pool_size', 'max_overflow', 'pool_recycle', 'pool_timeout'):
+        if key in config:
+            env_name = prefix + key.replace('pool_', '').upper()
+            config[key] = _env_int(env_name, config[key])
+    config['pool_pre_ping'] = _env_bool(prefix + 'PRE_PING', config.get('pool_pre_ping', False))
+    return config
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long callers wait for a connection"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._wait_lock = threading.Lock()
+        self.wait_count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - start
+            with self._wait_lock:
+                self.wait_count += 1
+                self.wait_total += waited
+                if waited > self.wait_max:
+                    self.wait_max = waited
+
+
+def connection_fingerprint(connection):
+    """Hash of the settings that affect how an engine connects"""
+    parts = [
+        connection.type, connection.host, connection.port,
+        connection.username, connection.password, connection.database,
+    ]
+    raw = '\x1f'.join('' if p is None else str(p) for p in parts)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()[:16]
+
+
+def build_engine_url(connection):
+    if connection.type == 'sqlite':
+        return f'sqlite:///{connection.database}'
+    elif connection.type == 'mysql':
+        return f'mysql+pymysql://{connection.username}:{connection.password}@{connection.host}:{connection.port}/{connection.database}'
+    elif connection.type == 'postgresql':
+        return f'postgresql://{connection.username}:{connection.password}@{connection.host}:{connection.port}/{connection.database}'
+    else:
+        raise ValueError(f"Unsupported database type: {connection.type}")
+
+
+class EngineRegistry:
+    """
+    进程级的目标数据库引擎注册表
+
+    每个连接只创建一个带连接池的 SQLAlchemy 引擎，按 (连接ID, 配置指纹) 缓存；
+    连接配置变化或连接被删除时，旧引擎会被释放。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # conn_id -> (fingerprint, engine, created_at)
+        self._engines = {}
+
+    def get_engine(self, connection):
+        """Return the pooled engine for a connection, creating it on first use"""
+        fingerprint = connection_fingerprint(connection)
+        with self._lock:
+            entry = self._engines.get(connection.id)
+            if entry and entry[0] == fingerprint:
+                return entry[1]
+
+            engine = self._create_engine(connection)
+            self._engines[connection.id] = (fingerprint, engine, time.time())
+        # 配置已变化，释放旧引擎的连接池
+        if entry:
+            entry[1].dispose()
+        return engine
+
+    def _create_engine(self, connection):
+        url = build_engine_url(connection)
+        config = get_pool_config(connection.type)
+        if connection.type == 'sqlite':
+            return create_engine(url, **config)
+        return create_engine(url, poolclass=TimedQueuePool, **config)
+
+    def invalidate(self, conn_id):
+        """Dispose and forget the engine for a connection"""
+        with self._lock:
+            entry = self._engines.pop(conn_id, None)
+        if entry:
+            entry[1].dispose()
+            return True
+        return False
+
+    def dispose_all(self, close=True):
+        """Forget every engine; after fork pass close=False to leave the parent's sockets alone"""
+        with self._lock:
+            entries = list(self._engines.values())
+            self._engines.clear()
+        for entry in entries:
+            entry[1].dispose(close=close)
+
+    def stats(self):
+        """Pool statistics for every registered engine"""
+        with self._lock:
+            items = list(self._engines.items())
+
+        result = []
+        for conn_id, (fingerprint, engine, created_at) in items:
+            pool = engine.pool
+            info = {
+                'connection_id': conn_id,
+                'fingerprint': fingerprint,
+                'dialect': engine.dialect.name,
+                'pool_class': type(pool).__name__,
+                'created_at': created_at,
+            }
+            if isinstance(pool, QueuePool):
+                info.update({
+                    'size': pool.size(),
+                    'checked_in': pool.checkedin(),
+                    'checked_out': pool.checkedout(),
+                    'overflow': pool.overflow(),
+                })
+            if isinstance(pool, TimedQueuePool):
+                with pool._wait_lock:
+                    count, total, wait_max = pool.wait_count, pool.wait_total, pool.wait_max
+                info.update({
+                    'checkouts': count,
+                    'wait_time_total': round(total, 6),
+                    'wait_time_avg': round(total / count, 6) if count else 0.0,
+                    'wait_time_max': round(wait_max, 6),
+                })
+            result.append(info)
+        return result
+
+
+# Create global engine registry instance
+engine_registry = EngineRegistry()
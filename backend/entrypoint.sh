@@ -11,24 +11,26 @@ if [ ! -f /data/chat2db.sqlite ]; then
   python3 /app/init_db.py
 fi
 
-# 预加载模型以避免在运行时出现网络问题
-echo "Preloading embedding model..."
-python3 -c "
-import os
-os.environ['CURL_CA_BUNDLE'] = ''
-os.environ['REQUESTS_CA_BUNDLE'] = ''
-os.environ['HF_HUB_OFFLINE'] = '1'
-try:
-    from embeddings.model import EmbeddingsModel
-    model = EmbeddingsModel()
-    # 预加载模型
-    model.encode('test')
-    print('Model preloaded successfully')
-except Exception as e:
-    print(f'Error preloading model: {e}')
-    print('Continuing with default model...')
-"
+cd /app
 
-echo "Starting Flask..."
-# 以可被外部访问的地址启动
-exec python3 /app/app.py
\ No newline at end of file
+# 服务方式：gunicorn（默认，多 worker 预加载模型）、asgi（uvicorn，异步聊天接口）、dev（Flask 开发服务器）
+# 模型在服务进程内加载，不再单独启动预加载进程
+case "${CHAT2DB_SERVER:-gunicorn}" in
+  gunicorn)
+    echo "Starting gunicorn..."
+    exec gunicorn -c /app/gunicorn.conf.py app:app
+    ;;
+  asgi)
+    echo "Starting uvicorn (ASGI)..."
+    exec uvicorn asgi_app:app --host 0.0.0.0 --port "${CHAT2DB_PORT:-5001}"
+    ;;
+  dev)
+    echo "Starting Flask..."
+    # 以可被外部访问的地址启动
+    exec python3 /app/app.py
+    ;;
+  *)
+    echo "Unknown CHAT2DB_SERVER: ${CHAT2DB_SERVER}" >&2
+    exit 1
+    ;;
+esac
@@ -0,0 +1,62 @@
+# gunicorn 生产环境配置
+#
+# 用法: gunicorn -c gunicorn.conf.py app:app
+#
+# preload_app 让 master 进程只导入一次 app.py，并在 fork 之前加载 Embeddings
+# 模型与意图向量矩阵（when_ready），所有 worker 以写时复制的方式共享这些内存。
+# kill -HUP <master pid> 会平滑地重启全部 worker（预加载的代码不会重新导入，
+# 代码更新需要重启容器）。
+import multiprocessing
+import os
+import tempfile
+import uuid
+
+bind = f"0.0.0.0:{os.environ.get('CHAT2DB_PORT', '5001')}"
+
+workers = int(os.environ.get('CHAT2DB_WORKERS', str(min(4, multiprocessing.cpu_count()))))
+threads = int(os.environ.get('CHAT2DB_THREADS', '8'))
+worker_class = 'gthread'
+
+preload_app = True
+# 后台线程（模式刷新、模型预热）在每个 worker fork 之后再启动；
+# 本次启动的标识在加载应用之前设置，master 与所有 worker 相同
+raw_env = ['CHAT2DB_DEFER_BACKGROUND_TASKS=1', f'CHAT2DB_BOOT_ID={uuid.uuid4().hex}']
+
+# 指标使用 prometheus_client 多进程模式，各 worker 写入同一目录，/metrics 合并导出。
+# 必须在加载应用（导入 prometheus_client）之前设置；HUP 重新加载配置时沿用原目录，
+# 已退出 worker 的计数保留，计数器不会回退
+if not os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = tempfile.mkdtemp(prefix='chat2db-metrics-')
+
+# 流式对话可能持续数分钟；gthread worker 的 timeout 只用于心跳检测
+timeout = int(os.environ.get('CHAT2DB_WORKER_TIMEOUT', '120'))
+graceful_timeout = int(os.environ.get('CHAT2DB_GRACEFUL_TIMEOUT', '30'))
+keepalive = 5
+
+# 定期回收 worker，0 表示不回收
+max_requests = int(os.environ.get('CHAT2DB_MAX_REQUESTS', '0'))
+max_requests_jitter = max_requests // 10
+
+accesslog = '-'
+errorlog = '-'
+loglevel = os.environ.get('CHAT2DB_LOG_LEVEL', 'info')
+
+
+def when_ready(server):
+    # master 进程中执行，早于第一个 worker 的 fork
+    import readiness
+    server.log.info("Warming up models before forking workers")
+    readiness.warm_up()
+    server.log.info(f"Warm-up finished: {readiness.status()['steps']}")
+
+
+def post_fork(server, worker):
+    import app
+    app.after_fork()
+
+
+def child_exit(server, worker):
+    # worker 异常退出时，清理它登记在应用数据库中的正在执行的查询
+    import app
+    app.query_registry.forget_process(worker.pid)
+    app.metrics.mark_process_dead(worker.pid)
@@ -0,0 +1,150 @@
+"""
+请求与热点路径指标，以 Prometheus 文本格式在 /metrics 导出
+
+基于 prometheus_client。设置了 PROMETHEUS_MULTIPROC_DIR 时使用多进程模式：
+每个 worker 把计数写入该目录下的文件，/metrics 合并所有 worker（包括已退出的
+worker）的数据，抓取落到哪个 worker 结果都相同，worker 重启也不会让计数器回退。
+gunicorn.conf.py 在加载应用之前设置该目录。未设置时只导出本进程的指标。
+CHAT2DB_METRICS=0 时所有记录操作直接返回。
+"""
+import hmac
+import os
+import time
+from contextlib import contextmanager
+import prometheus_client
+from prometheus_client import CollectorRegistry, generate_latest, multiprocess
+
+ENABLED = os.environ.get('CHAT2DB_METRICS', '1') != '0'
+# 多进程模式的数据目录；必须在导入 prometheus_client 之前设置
+MULTIPROCESS_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+# Prometheus 抓取 /metrics 时使用的 Bearer 令牌；未设置时只有管理员可以读取
+SCRAPE_TOKEN = os.environ.get('CHAT2DB_METRICS_TOKEN')
+
+# 秒
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# tokens/s
+RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500)
+
+CONTENT_TYPE = prometheus_client.CONTENT_TYPE_LATEST
+
+
+class Metric:
+    def __init__(self, metric, labelnames):
+        self._metric = metric
+        self.labelnames = tuple(labelnames)
+
+    def _child(self, labels):
+        if not self.labelnames:
+            return self._metric
+        return self._metric.labels(*[str(labels.get(name, '')) for name in self.labelnames])
+
+
+class Counter(Metric):
+    def inc(self, amount=1, **labels):
+        if not ENABLED:
+            return
+        self._child(labels).inc(amount)
+
+
+class Histogram(Metric):
+    def observe(self, value, **labels):
+        if not ENABLED:
+            return
+        self._child(labels).observe(value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the with-block, including when it raises"""
+        if not ENABLED:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+
+class Registry:
+    def __init__(self):
+        self._registry = CollectorRegistry()
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = prometheus_client.Counter(name, documentation, labelnames, registry=self._registry)
+        return Counter(metric, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = prometheus_client.Histogram(name, documentation, labelnames, buckets=buckets, registry=self._registry)
+        return Histogram(metric, labelnames)
+
+    def render(self):
+        """Prometheus text exposition format (version 0.0.4)"""
+        if MULTIPROCESS_DIR:
+            # 每次抓取都重新合并各 worker 的数据文件
+            merged = CollectorRegistry()
+            multiprocess.MultiProcessCollector(merged)
+            return generate_latest(merged)
+        return generate_latest(self._registry)
+
+
+def scrape_authorized(auth_header):
+    """True when the Authorization header carries CHAT2DB_METRICS_TOKEN"""
+    if not SCRAPE_TOKEN or not auth_header:
+        return False
+    return hmac.compare_digest(auth_header.encode('utf-8'), f'Bearer {SCRAPE_TOKEN}'.encode('utf-8'))
+
+
+def mark_process_dead(pid):
+    """Called by the gunicorn master when a worker exits (see gunicorn.conf.py)"""
+    if MULTIPROCESS_DIR:
+        multiprocess.mark_process_dead(pid)
+
+
+registry = Registry()
+
+http_requests = registry.counter(
+    'chat2db_http_requests_total', 'HTTP requests by route, method and status', ('method', 'route', 'status'))
+http_request_seconds = registry.histogram(
+    'chat2db_http_request_duration_seconds', 'Time until the response headers are ready', ('method', 'route'))
+
+db_engine_seconds = registry.histogram(
+    'chat2db_db_engine_seconds', 'Looking up or creating the pooled engine for a connection', ('connection',))
+db_query_seconds = registry.histogram(
+    'chat2db_db_query_seconds', 'Target database query time (pd.read_sql_query)', ('connection', 'endpoint'))
+db_query_errors = registry.counter(
+    'chat2db_db_query_errors_total', 'Failed, timed out or cancelled target database queries', ('connection', 'endpoint', 'reason'))
+serialize_seconds = registry.histogram(
+    'chat2db_serialize_seconds', 'Converting query results to the response body', ('endpoint', 'format'))
+
+llm_request_seconds = registry.histogram(
+    'chat2db_llm_request_seconds', 'Ollama request latency by call type', ('call', 'outcome'))
+llm_ttft_seconds = registry.histogram(
+    'chat2db_llm_time_to_first_token_seconds', 'Time to the first generated token', ('call',))
+llm_tokens_per_second = registry.histogram(
+    'chat2db_llm_tokens_per_second', 'Decode rate reported by Ollama', ('call',), buckets=RATE_BUCKETS)
+
+embedding_encode_seconds = registry.histogram(
+    'chat2db_embedding_encode_seconds', 'EmbeddingsModel encode time by backend and call', ('backend', 'call'))
+auth_token_seconds = registry.histogram(
+    'chat2db_auth_token_seconds', 'Resolving the user of a bearer token', ('outcome',))
+
+
+def init_app(app):
+    """Record latency and status of every Flask route"""
+    if not ENABLED:
+        return
+    from flask import g, request
+
+    @app.before_request
+    def _start_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def _record_request(response):
+        started = g.pop('metrics_started', None)
+        if started is not None:
+            # 未匹配的路径归为一类，避免标签数量无限增长
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            http_request_seconds.observe(time.perf_counter() - started, method=request.method, route=route)
+            http_requests.inc(method=request.method, route=route, status=response.status_code)
+        return response
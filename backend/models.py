@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, Column, String, Integer, DateTime, ForeignKey, Table
+from sqlalchemy import create_engine, Column, String, Integer, Float, DateTime, ForeignKey, Table, Text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from sqlalchemy.sql import func
@@ -106,6 +106,102 @@ class UserRole(Base):
             'role_id': self.role_id
         }
 
+class UserRoleChange(Base):
+    __tablename__ = 'user_role_changes'
+    
+    user_id = Column(String, primary_key=True)
+    changed_at = Column(Float)  # epoch seconds of the last user/role change; role claims in older tokens are ignored
+    
+    def to_dict(self):
+        return {
+            'user_id': self.user_id,
+            'changed_at': self.changed_at
+        }
+
+class SchemaCatalogSnapshot(Base):
+    __tablename__ = 'schema_catalogs'
+    
+    connection_id = Column(String, primary_key=True)
+    version = Column(String)  # hash of the catalog payload
+    payload = Column(Text)  # JSON: tables, columns, keys, indexes, row estimates
+    refreshed_at = Column(DateTime, default=func.now())
+    
+    def to_dict(self):
+        return {
+            'connection_id': self.connection_id,
+            'version': self.version,
+            'payload': json.loads(self.payload) if self.payload else None,
+            'refreshed_at': self.refreshed_at.isoformat() if self.refreshed_at else None
+        }
+
+class ConnectionOptions(Base):
+    __tablename__ = 'connection_options'
+    
+    connection_id = Column(String, primary_key=True)
+    options = Column(Text)  # JSON: per-connection tuning such as query_cache_ttl
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+    
+    def to_dict(self):
+        return {
+            'connection_id': self.connection_id,
+            'options': json.loads(self.options) if self.options else {},
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
+
+class ChatSession(Base):
+    __tablename__ = 'chat_sessions'
+    
+    id = Column(String, primary_key=True)
+    user_id = Column(String, index=True)
+    title = Column(String)
+    model = Column(String)
+    turns = Column(Text)  # JSON: [{"role", "text"}]
+    context = Column(Text)  # JSON: Ollama context returned with the last reply
+    context_model = Column(String)  # model that produced the context
+    context_tables = Column(Text)  # JSON: tables whose schema is already encoded in the context
+    revision = Column(Integer, default=0)  # bumped on every change, lets other workers detect stale copies
+    created_at = Column(DateTime, default=func.now())
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'title': self.title,
+            'model': self.model,
+            'turn_count': len(json.loads(self.turns)) if self.turns else 0,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
+
+class RunningQueryEntry(Base):
+    __tablename__ = 'running_queries'
+    
+    id = Column(String, primary_key=True)
+    user_id = Column(String, index=True)
+    connection_id = Column(String)
+    db_type = Column(String)
+    sql = Column(Text)
+    timeout = Column(Float)
+    pid = Column(Integer)  # worker process that runs the query
+    boot_id = Column(String, index=True)  # server boot the worker belongs to; pids repeat across restarts
+    backend_id = Column(Integer)  # pg_backend_pid / CONNECTION_ID on the target database
+    cancel_reason = Column(String)  # requested by any worker, applied by the owning worker
+    started = Column(Float)  # epoch seconds
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'connection_id': self.connection_id,
+            'sql': self.sql,
+            'user_id': self.user_id,
+            'started': self.started,
+            'elapsed': round(datetime.now().timestamp() - self.started, 3) if self.started else None,
+            'timeout': self.timeout or None,
+            'cancelling': self.cancel_reason is not None,
+            'worker': self.pid
+        }
+
 # Create tables function
 def create_tables(engine):
     Base.metadata.create_all(engine)
\ No newline at end of file
@@ -1,9 +1,10 @@
 import re
+import threading
 from typing import Dict, List, Tuple
 import numpy as np
 # 导入embeddings模块
-from embeddings.model import EmbeddingsModel
-from embeddings.similarity import cosine_similarity
+from embeddings.manager import get_embeddings_model
+from embeddings.similarity import normalize_rows
 
 class EnhancedNLP:
     """
@@ -11,8 +12,8 @@ class EnhancedNLP:
     """
     
     def __init__(self, embeddings_model=None):
-        # 初始化 Embeddings 模型
-        self.embeddings_model = embeddings_model or EmbeddingsModel()
+        # 使用进程内共享的 Embeddings 模型
+        self.embeddings_model = embeddings_model or get_embeddings_model()
         
         # 定义关键词映射
         self.select_keywords = ['show', 'list', 'get', 'find', 'retrieve', 'display', 'select']
@@ -21,15 +22,25 @@ class EnhancedNLP:
         self.update_keywords = ['update', 'modify', 'change', 'edit']
         self.delete_keywords = ['delete', 'remove', 'drop']
         
-        # 预先计算各类意图的向量表示
-        self.count_intent_embeddings = self._precompute_intent_embeddings(self.count_keywords)
-        self.select_intent_embeddings = self._precompute_intent_embeddings(self.select_keywords)
-        self.insert_intent_embeddings = self._precompute_intent_embeddings(self.insert_keywords)
-        self.update_intent_embeddings = self._precompute_intent_embeddings(self.update_keywords)
-        self.delete_intent_embeddings = self._precompute_intent_embeddings(self.delete_keywords)
+        # 预先计算各类意图的向量表示：所有关键词组成一个归一化的 float32 矩阵，
+        # intent_labels[i] 是第 i 行对应的意图
+        intent_keywords = [
+            ('count', self.count_keywords),
+            ('select', self.select_keywords),
+            ('insert', self.insert_keywords),
+            ('update', self.update_keywords),
+            ('delete', self.delete_keywords),
+        ]
+        self.intent_labels = np.array([intent for intent, keywords in intent_keywords for _ in keywords])
+        self.intent_matrix = self._precompute_intent_embeddings(
+            [keyword for _, keywords in intent_keywords for keyword in keywords]
+        )
         
         # 相似度阈值
         self.intent_threshold = 0.7
+        # 语义匹配表名/列名的最低相似度
+        self.table_threshold = 0.35
+        self.column_threshold = 0.45
         
         # 定义操作符映射
         self.operators = {
@@ -50,74 +61,111 @@ class EnhancedNLP:
             'or': 'OR'
         }
     
-    def parse_nl_to_sql(self, nl_text: str, table_name: str = None) -> str:
+    def parse_nl_to_sql(self, nl_text: str, table_name: str = None, schema_index=None) -> str:
         """
         将自然语言转换为SQL查询
         
         Args:
             nl_text: 自然语言文本
             table_name: 表名（可选）
+            schema_index: 连接的 SchemaIndex（可选），用于按语义解析表名和列名
             
         Returns:
             SQL查询语句
         """
-        text = nl_text.strip().lower()
-        
-        # 使用 Embeddings 模型计算查询的语义向量
+        # 使用 Embeddings 模型计算查询的语义向量并确定意图
         query_embedding = self.embeddings_model.encode(nl_text)
+        intent, similarity = self.classify_intent(query_embedding)
+        return self._build_query(nl_text, intent, similarity, table_name, schema_index, query_embedding)
+    
+    def parse_many(self, nl_texts: List[str], table_name: str = None, schema_index=None) -> List[str]:
+        """
+        批量将自然语言转换为SQL查询（用于离线评估）
         
-        # 计算与各类操作关键词的相似度
-        count_similarity = self._calculate_similarity(query_embedding, self.count_intent_embeddings)
-        select_similarity = self._calculate_similarity(query_embedding, self.select_intent_embeddings)
-        insert_similarity = self._calculate_similarity(query_embedding, self.insert_intent_embeddings)
-        update_similarity = self._calculate_similarity(query_embedding, self.update_intent_embeddings)
-        delete_similarity = self._calculate_similarity(query_embedding, self.delete_intent_embeddings)
-        
-        # 根据相似度确定意图
-        intent_similarities = [
-            (count_similarity, 'count'),
-            (select_similarity, 'select'),
-            (insert_similarity, 'insert'),
-            (update_similarity, 'update'),
-            (delete_similarity, 'delete')
+        所有问题一次批量编码，并用一次矩阵乘法完成意图分类。
+        """
+        if not nl_texts:
+            return []
+        query_embeddings = self.embeddings_model.encode_batch(nl_texts)
+        return [
+            self._build_query(nl_text, intent, similarity, table_name, schema_index, query_embedding)
+            for nl_text, query_embedding, (intent, similarity)
+            in zip(nl_texts, query_embeddings, self.classify_intents(query_embeddings))
         ]
+    
+    def classify_intent(self, query_embedding) -> Tuple[str, float]:
+        """返回与查询最相似的意图及其余弦相似度"""
+        scores = self.intent_matrix @ normalize_rows(query_embedding)
+        best = int(np.argmax(scores))
+        return str(self.intent_labels[best]), float(scores[best])
+    
+    def classify_intents(self, query_embeddings) -> List[Tuple[str, float]]:
+        """classify_intent 的批量版本，query_embeddings 形状为 (n, dim)"""
+        scores = normalize_rows(query_embeddings) @ self.intent_matrix.T
+        best = np.argmax(scores, axis=1)
+        best_scores = scores[np.arange(len(best)), best]
+        return [(str(self.intent_labels[i]), float(score)) for i, score in zip(best, best_scores)]
+    
+    def _build_query(self, nl_text: str, intent: str, similarity: float, table_name: str = None,
+                     schema_index=None, query_embedding=None) -> str:
+        """根据意图生成SQL"""
+        text = nl_text.strip().lower()
         
-        # 按相似度排序
-        intent_similarities.sort(key=lambda x: x[0], reverse=True)
-        best_similarity, best_intent = intent_similarities[0]
+        # 有模式索引时，先把问题解析到真实存在的表
+        if schema_index is not None and not table_name:
+            table_name = self._resolve_table(text, query_embedding, schema_index)
         
         # 根据相似度确定意图
-        if best_similarity > self.intent_threshold:
-            if best_intent == 'count':
+        if similarity > self.intent_threshold:
+            if intent == 'count':
                 return self._parse_count_query(text, table_name)
-            elif best_intent == 'select':
-                return self._parse_select_query(text, table_name)
-            elif best_intent == 'insert':
+            elif intent == 'select':
+                return self._parse_select_query(text, table_name, schema_index)
+            elif intent == 'insert':
                 return self._parse_insert_query(text, table_name)
-            elif best_intent == 'update':
+            elif intent == 'update':
                 return self._parse_update_query(text, table_name)
-            elif best_intent == 'delete':
+            elif intent == 'delete':
                 return self._parse_delete_query(text, table_name)
-        else:
-            # 默认返回简单的SELECT查询
-            return self._parse_select_query(text, table_name)
+        # 默认返回简单的SELECT查询
+        return self._parse_select_query(text, table_name, schema_index)
     
-    def _precompute_intent_embeddings(self, keywords):
-        """预先计算意图关键词的向量表示"""
-        embeddings = []
-        for keyword in keywords:
-            embedding = self.embeddings_model.encode(keyword)
-            embeddings.append(embedding)
-        return embeddings
+    def _resolve_table(self, text: str, query_embedding, schema_index) -> str:
+        """
+        使用模式索引解析问题涉及的表
+        
+        先查找问题中直接提到的表名（含单复数变化），再按语义相似度检索。
+        """
+        candidates = [m.group(1) for p in (r"from\s+(\w+)", r"in\s+(\w+)", r"table\s+(\w+)") for m in re.finditer(p, text)]
+        candidates += re.findall(r"\w+", text)
+        for word in candidates:
+            for variant in (word, word + 's', word[:-1] if word.endswith('s') else None):
+                table = schema_index.lookup_table(variant)
+                if table:
+                    return table
+        
+        if query_embedding is None:
+            query_embedding = text
+        matches = schema_index.search_tables(query_embedding, k=1)
+        if matches and matches[0][1] >= self.table_threshold:
+            return matches[0][0]
+        return None
+    
+    def _resolve_columns(self, columns: List[str], table: str, schema_index) -> List[str]:
+        """把问题中的列描述映射到表中最相近的真实列名"""
+        resolved = []
+        for column in columns:
+            matches = schema_index.search_columns(column, table_name=table, k=1)
+            if matches and (matches[0][1].lower() == column.lower() or matches[0][2] >= self.column_threshold):
+                resolved.append(matches[0][1])
+            else:
+                resolved.append(column)
+        return resolved
     
-    def _calculate_similarity(self, query_embedding, intent_embeddings):
-        """计算查询与意图向量的相似度"""
-        max_similarity = 0
-        for intent_embedding in intent_embeddings:
-            similarity = cosine_similarity(query_embedding, intent_embedding)
-            if similarity > max_similarity:
-                max_similarity = similarity
-        return max_similarity
+    def _precompute_intent_embeddings(self, keywords):
+        """预先计算意图关键词的向量表示（归一化后的矩阵）"""
+        # 一次批量编码所有关键词
+        return normalize_rows(self.embeddings_model.encode_batch(keywords))
     
     def _parse_count_query(self, text: str, table_name: str = None) -> str:
         """解析COUNT查询"""
@@ -132,13 +180,15 @@ class EnhancedNLP:
         else:
             return f"SELECT COUNT(*) as count FROM {table}"
     
-    def _parse_select_query(self, text: str, table_name: str = None) -> str:
+    def _parse_select_query(self, text: str, table_name: str = None, schema_index=None) -> str:
         """解析SELECT查询"""
         # 提取表名
         table = table_name or self._extract_table_name(text) or 'employees'
         
         # 提取列名（如果有的话）
         columns = self._extract_columns(text)
+        if columns and schema_index is not None:
+            columns = self._resolve_columns(columns, table, schema_index)
         
         # 检查是否有WHERE条件
         where_clause = self._extract_where_clause(text)
@@ -268,5 +318,15 @@ class EnhancedNLP:
         
         return condition_text
 
-# 创建全局实例
-enhanced_nlp = EnhancedNLP()
\ No newline at end of file
+# 全局实例在第一次使用时创建（加载模型并计算意图矩阵），导入本模块不做任何计算
+_enhanced_nlp = None
+_lock = threading.Lock()
+
+
+def get_enhanced_nlp():
+    global _enhanced_nlp
+    if _enhanced_nlp is None:
+        with _lock:
+            if _enhanced_nlp is None:
+                _enhanced_nlp = EnhancedNLP()
+    return _enhanced_nlp
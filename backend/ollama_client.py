@@ -0,0 +1,538 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import asynccontextmanager
+import requests
+from requests.adapters import HTTPAdapter
+from metrics import llm_request_seconds, llm_tokens_per_second, llm_ttft_seconds
+
+logger = logging.getLogger(__name__)
+
+OLLAMA_URL = os.environ.get('OLLAMA_URL', 'http://localhost:11434')
+OLLAMA_MODEL = os.environ.get('OLLAMA_MODEL', 'llama2')
+
+# 连接池大小、连接/读取超时（秒）以及连接失败时的重试次数与退避基数（秒）
+OLLAMA_POOL_SIZE = int(os.environ.get('CHAT2DB_OLLAMA_POOL_SIZE', '10'))
+OLLAMA_CONNECT_TIMEOUT = float(os.environ.get('CHAT2DB_OLLAMA_CONNECT_TIMEOUT', '5'))
+OLLAMA_READ_TIMEOUT = float(os.environ.get('CHAT2DB_OLLAMA_READ_TIMEOUT', '300'))
+OLLAMA_RETRIES = int(os.environ.get('CHAT2DB_OLLAMA_RETRIES', '2'))
+OLLAMA_BACKOFF = float(os.environ.get('CHAT2DB_OLLAMA_BACKOFF', '0.5'))
+# ASGI 模式下每个 SSE 流占用一个到 Ollama 的连接，连接上限需要更大
+OLLAMA_ASYNC_POOL_SIZE = int(os.environ.get('CHAT2DB_OLLAMA_ASYNC_POOL_SIZE', '256'))
+
+# 生成请求附带的 keep_alive（如 "30m"、"-1"），未设置时使用 Ollama 默认值
+OLLAMA_KEEP_ALIVE = os.environ.get('OLLAMA_KEEP_ALIVE') or None
+# 需要常驻内存的模型（逗号分隔）与预热间隔（秒），应小于 keep_alive
+OLLAMA_WARM_MODELS = [m.strip() for m in os.environ.get('OLLAMA_WARM_MODELS', '').split(',') if m.strip()]
+OLLAMA_WARM_INTERVAL = float(os.environ.get('CHAT2DB_OLLAMA_WARM_INTERVAL', '240'))
+
+# 不同版本的 Ollama / 兼容服务列出模型的接口
+MODEL_LIST_PATHS = ('/api/tags', '/api/models', '/v1/models')
+
+NDJSON_HEADERS = {'Accept': 'application/x-ndjson', 'Content-Type': 'application/json'}
+
+
+class OllamaError(Exception):
+    """Error reported by Ollama inside a generation stream"""
+
+
+class CallStats:
+    """Latency counters for one kind of Ollama call"""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.ttft_count = 0
+        self.ttft_total = 0.0
+        self.ttft_last = None
+        self.tps_count = 0
+        self.tps_total = 0.0
+        self.tps_last = None
+
+    def as_dict(self):
+        ms = lambda seconds: round(seconds * 1000, 1)
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'latency_avg_ms': ms(self.latency_total / self.requests) if self.requests else None,
+            'latency_max_ms': ms(self.latency_max),
+            'ttft_avg_ms': ms(self.ttft_total / self.ttft_count) if self.ttft_count else None,
+            'ttft_last_ms': ms(self.ttft_last) if self.ttft_last is not None else None,
+            'tokens_per_second_avg': round(self.tps_total / self.tps_count, 2) if self.tps_count else None,
+            'tokens_per_second_last': round(self.tps_last, 2) if self.tps_last is not None else None,
+        }
+
+
+class OllamaMetrics:
+    """Per-call-type counters shared by the sync and async clients"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> CallStats
+        self._stats = {}
+
+    def _entry(self, metric):
+        entry = self._stats.get(metric)
+        if entry is None:
+            entry = self._stats[metric] = CallStats()
+        return entry
+
+    def record(self, metric, latency, error=False):
+        llm_request_seconds.observe(latency, call=metric, outcome='error' if error else 'ok')
+        with self._lock:
+            entry = self._entry(metric)
+            entry.requests += 1
+            entry.latency_total += latency
+            entry.latency_max = max(entry.latency_max, latency)
+            if error:
+                entry.errors += 1
+
+    def record_generation(self, metric, ttft, rate):
+        if ttft is not None:
+            llm_ttft_seconds.observe(ttft, call=metric)
+        if rate is not None:
+            llm_tokens_per_second.observe(rate, call=metric)
+        with self._lock:
+            entry = self._entry(metric)
+            if ttft is not None:
+                entry.ttft_count += 1
+                entry.ttft_total += ttft
+                entry.ttft_last = ttft
+            if rate is not None:
+                entry.tps_count += 1
+                entry.tps_total += rate
+                entry.tps_last = rate
+        if ttft is not None or rate is not None:
+            logger.debug(f"Ollama {metric}: ttft={ttft}, tokens/s={rate}")
+
+    def as_dict(self):
+        with self._lock:
+            return {name: entry.as_dict() for name, entry in self._stats.items()}
+
+
+def tokens_per_second(body):
+    """Decode rate reported by Ollama in a final (done) response, or None"""
+    if not isinstance(body, dict):
+        return None
+    count = body.get('eval_count')
+    duration = body.get('eval_duration')
+    if not count or not duration:
+        return None
+    return count / (duration / 1e9)
+
+
+def parse_stream_line(raw):
+    """Parse one NDJSON line; lines that are not JSON are returned unchanged"""
+    try:
+        return json.loads(raw)
+    except ValueError:
+        return raw
+
+
+def item_content(item):
+    """Text carried by a generate (response) or chat (message.content) stream item"""
+    if not isinstance(item, dict):
+        return None
+    if isinstance(item.get('response'), str):
+        return item['response']
+    if isinstance(item.get('message'), dict):
+        return item['message'].get('content') or ''
+    return None
+
+
+def normalize_model_list(body):
+    """Reduce the various model-list response shapes to a list of model names"""
+    models_out = []
+    # Ollama /api/tags often returns {"models": [{"name":..., "model":...}, ...]}
+    if isinstance(body, dict) and 'models' in body and isinstance(body['models'], list):
+        for item in body['models']:
+            if isinstance(item, dict):
+                name = item.get('model') or item.get('name')
+                if name:
+                    models_out.append(name)
+    elif isinstance(body, list):
+        # could be list of strings or dicts
+        for item in body:
+            if isinstance(item, str):
+                models_out.append(item)
+            elif isinstance(item, dict):
+                name = item.get('model') or item.get('name')
+                if name:
+                    models_out.append(name)
+    elif isinstance(body, dict):
+        # maybe dict keyed by name
+        models_out = list(body.keys())
+    return models_out
+
+
+def generation_payload(model, prompt, keep_alive=OLLAMA_KEEP_ALIVE, **extra):
+    payload = {'model': model, 'prompt': prompt, 'stream': True, **extra}
+    if keep_alive is not None:
+        payload['keep_alive'] = keep_alive
+    return payload
+
+
+class StreamMeter:
+    """
+    统计一次流式生成的首 token 时间与生成速度
+
+    Ollama 在最后一行给出 eval_count/eval_duration 时以其为准，否则按收到的
+    内容块数估算。
+    """
+
+    def __init__(self, metrics, metric, started=None):
+        self.metrics = metrics
+        self.metric = metric
+        self.started = started or time.perf_counter()
+        self.first_token_at = None
+        self.chunks = 0
+        self.rate = None
+
+    def observe(self, item):
+        if not isinstance(item, dict):
+            return
+        if item_content(item):
+            self.chunks += 1
+            if self.first_token_at is None:
+                self.first_token_at = time.perf_counter()
+        if item.get('done'):
+            self.rate = tokens_per_second(item)
+
+    def finish(self):
+        if self.first_token_at is None:
+            return
+        rate = self.rate
+        if rate is None and self.chunks > 1:
+            elapsed = time.perf_counter() - self.first_token_at
+            rate = (self.chunks - 1) / elapsed if elapsed > 0 else None
+        self.metrics.record_generation(self.metric, self.first_token_at - self.started, rate)
+
+
+class GenerationCollector:
+    """
+    把流式生成的各行累积成完整结果
+
+    模型冷启动时 Ollama 先返回 done_reason 为 load 的状态行，这里直接跳过并
+    继续读取同一个流，不会重新发送提示词。
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.final = {}
+
+    def feed(self, item):
+        """Add one stream item; returns True once generation is finished"""
+        if not isinstance(item, dict):
+            self.parts.append(item)
+            return False
+        if item.get('error'):
+            raise OllamaError(item['error'])
+        content = item_content(item)
+        if content:
+            self.parts.append(content)
+        if item.get('done'):
+            if item.get('done_reason') == 'load':
+                return False
+            self.final = item
+            return True
+        return False
+
+    def result(self):
+        return {
+            'text': ''.join(self.parts),
+            'done_reason': self.final.get('done_reason'),
+            'context': self.final.get('context'),
+            'eval_count': self.final.get('eval_count'),
+        }
+
+
+class OllamaClient:
+    """
+    所有 Ollama 请求共用的 HTTP 客户端
+
+    使用带连接池的 requests.Session 保持长连接，避免每次调用都新建 TCP 连接；
+    连接失败时按指数退避重试，并按调用类型记录延迟、首 token 时间与生成速度。
+    """
+
+    def __init__(self, base_url=OLLAMA_URL, pool_size=OLLAMA_POOL_SIZE,
+                 connect_timeout=OLLAMA_CONNECT_TIMEOUT, read_timeout=OLLAMA_READ_TIMEOUT,
+                 retries=OLLAMA_RETRIES, backoff=OLLAMA_BACKOFF, metrics=None):
+        self.base_url = base_url.rstrip('/')
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.metrics = metrics or OllamaMetrics()
+        self._lock = threading.Lock()
+        self._session = None
+        self._pid = None
+
+    @property
+    def session(self):
+        """Pooled session, recreated after fork so workers never share sockets"""
+        if self._session is not None and self._pid == os.getpid():
+            return self._session
+        with self._lock:
+            if self._session is None or self._pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._session = session
+                self._pid = os.getpid()
+        return self._session
+
+    def url(self, path):
+        return f"{self.base_url}{path}"
+
+    def request(self, method, path, metric=None, retries=None, timeout=None, **kwargs):
+        """
+        发送请求并返回 Response
+
+        只在连接阶段失败（服务未就绪、连接被拒绝）时重试；流式请求的延迟
+        记录到收到响应头为止。
+        """
+        metric = metric or path
+        retries = self.retries if retries is None else retries
+        attempt = 0
+        start = time.perf_counter()
+        while True:
+            try:
+                resp = self.session.request(method, self.url(path), timeout=timeout or self.timeout, **kwargs)
+                break
+            except requests.ConnectionError as e:
+                if attempt >= retries:
+                    self.metrics.record(metric, time.perf_counter() - start, error=True)
+                    raise
+                delay = self.backoff * (2 ** attempt)
+                attempt += 1
+                logger.warning(f"Ollama {method} {path} failed ({e}); retry {attempt}/{retries} in {delay:.1f}s")
+                time.sleep(delay)
+            except Exception:
+                self.metrics.record(metric, time.perf_counter() - start, error=True)
+                raise
+        self.metrics.record(metric, time.perf_counter() - start, error=resp.status_code >= 500)
+        return resp
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def iter_stream(self, resp, metric='generate', started=None):
+        """
+        逐行读取 NDJSON 流式响应
+
+        产出解析后的对象（无法解析的行原样产出字符串），并记录首 token 时间与
+        生成速度。
+        """
+        meter = StreamMeter(self.metrics, metric, started)
+        try:
+            for raw in resp.iter_lines(decode_unicode=True):
+                if not raw:
+                    continue
+                item = parse_stream_line(raw)
+                meter.observe(item)
+                yield item
+        finally:
+            # 调用方可能在读到 done 后提前结束迭代，统计仍要记录
+            meter.finish()
+
+    def generate(self, model, prompt, keep_alive=OLLAMA_KEEP_ALIVE, metric='generate', **extra):
+        """
+        通过一次流式 /api/generate 请求完成生成
+
+        Returns:
+            {'text', 'done_reason', 'context', 'eval_count'}
+        """
+        payload = generation_payload(model, prompt, keep_alive, **extra)
+        collector = GenerationCollector()
+        started = time.perf_counter()
+        with self.post('/api/generate', json=payload, headers=NDJSON_HEADERS, stream=True, metric=metric) as resp:
+            resp.raise_for_status()
+            for item in self.iter_stream(resp, metric=metric, started=started):
+                if collector.feed(item):
+                    break
+        return collector.result()
+
+    def stats(self):
+        return {
+            'base_url': self.base_url,
+            'pool_size': self.pool_size,
+            'calls': self.metrics.as_dict(),
+        }
+
+
+class AsyncOllamaClient:
+    """
+    ASGI 模式下使用的异步 Ollama 客户端（httpx）
+
+    与同步客户端共享统计；httpx 只在首次使用时导入，WSGI 部署不需要安装。
+    AsyncClient 绑定创建它的事件循环，需在服务的事件循环中使用。
+    """
+
+    def __init__(self, base_url=OLLAMA_URL, pool_size=OLLAMA_ASYNC_POOL_SIZE,
+                 connect_timeout=OLLAMA_CONNECT_TIMEOUT, read_timeout=OLLAMA_READ_TIMEOUT,
+                 retries=OLLAMA_RETRIES, metrics=None):
+        self.base_url = base_url.rstrip('/')
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.metrics = metrics or OllamaMetrics()
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import httpx
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+                timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+                # httpx 的传输层重试只针对连接失败
+                transport=httpx.AsyncHTTPTransport(retries=self.retries),
+            )
+        return self._client
+
+    async def request(self, method, path, metric=None, **kwargs):
+        metric = metric or path
+        start = time.perf_counter()
+        try:
+            resp = await self.client.request(method, path, **kwargs)
+        except Exception:
+            self.metrics.record(metric, time.perf_counter() - start, error=True)
+            raise
+        self.metrics.record(metric, time.perf_counter() - start, error=resp.status_code >= 500)
+        return resp
+
+    @asynccontextmanager
+    async def stream(self, method, path, metric=None, **kwargs):
+        """Open a streaming request; latency is recorded when the headers arrive"""
+        metric = metric or path
+        start = time.perf_counter()
+        request = self.client.build_request(method, path, **kwargs)
+        try:
+            resp = await self.client.send(request, stream=True)
+        except Exception:
+            self.metrics.record(metric, time.perf_counter() - start, error=True)
+            raise
+        self.metrics.record(metric, time.perf_counter() - start, error=resp.status_code >= 500)
+        try:
+            yield resp
+        finally:
+            await resp.aclose()
+
+    async def iter_stream(self, resp, metric='generate', started=None):
+        meter = StreamMeter(self.metrics, metric, started)
+        try:
+            async for raw in resp.aiter_lines():
+                if not raw:
+                    continue
+                item = parse_stream_line(raw)
+                meter.observe(item)
+                yield item
+        finally:
+            meter.finish()
+
+    async def generate(self, model, prompt, keep_alive=OLLAMA_KEEP_ALIVE, metric='generate', **extra):
+        """Async counterpart of OllamaClient.generate"""
+        payload = generation_payload(model, prompt, keep_alive, **extra)
+        collector = GenerationCollector()
+        started = time.perf_counter()
+        async with self.stream('POST', '/api/generate', json=payload, headers=NDJSON_HEADERS, metric=metric) as resp:
+            resp.raise_for_status()
+            items = self.iter_stream(resp, metric=metric, started=started)
+            try:
+                async for item in items:
+                    if collector.feed(item):
+                        break
+            finally:
+                await items.aclose()
+        return collector.result()
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+class ModelWarmer:
+    """
+    让配置的模型常驻 Ollama 内存
+
+    后台线程按固定间隔对每个模型发送不带提示词的 /api/generate 请求，
+    Ollama 会加载模型（已加载时只刷新 keep_alive 计时），空闲后的第一次
+    对话不再需要冷启动。
+    """
+
+    def __init__(self, client, models=None, keep_alive=OLLAMA_KEEP_ALIVE, interval=OLLAMA_WARM_INTERVAL):
+        self.client = client
+        self.models = list(OLLAMA_WARM_MODELS if models is None else models)
+        self.keep_alive = keep_alive
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        # model -> {'ok', 'seconds', 'error', 'at'}
+        self._results = {}
+
+    def warm(self, model):
+        payload = {'model': model}
+        if self.keep_alive is not None:
+            payload['keep_alive'] = self.keep_alive
+        start = time.perf_counter()
+        try:
+            resp = self.client.post('/api/generate', json=payload, retries=0, metric='warmup')
+            resp.raise_for_status()
+            result = {'ok': True, 'error': None}
+        except Exception as e:
+            logger.warning(f"Warming Ollama model {model} failed: {e}")
+            result = {'ok': False, 'error': str(e)}
+        result.update({'seconds': round(time.perf_counter() - start, 3), 'at': time.time()})
+        with self._lock:
+            self._results[model] = result
+        return result['ok']
+
+    def warm_all(self):
+        for model in self.models:
+            if self._stop.is_set():
+                break
+            self.warm(model)
+
+    def start(self):
+        if not self.models or self.interval <= 0 or (self._thread and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name='chat2db-ollama-warmup', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        self.warm_all()
+        while not self._stop.wait(self.interval):
+            self.warm_all()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'models': self.models,
+                'keep_alive': self.keep_alive,
+                'interval': self.interval,
+                'running': bool(self._thread and self._thread.is_alive()),
+                'results': dict(self._results),
+            }
+
+
+# Create global Ollama client instances (sync for Flask, async for ASGI mode)
+ollama_metrics = OllamaMetrics()
+ollama_client = OllamaClient(metrics=ollama_metrics)
+async_ollama_client = AsyncOllamaClient(metrics=ollama_metrics)
+model_warmer = ModelWarmer(ollama_client)
@@ -0,0 +1,170 @@
+import base64
+import json
+import threading
+from collections import namedtuple
+from sqlalchemy import inspect
+from result_stream import json_default
+
+# 允许的排序方向
+SORT_ORDERS = ('asc', 'desc')
+
+
+def split_table_name(table_name, db_type):
+    """Split "schema.table" into (schema, table); PostgreSQL defaults to public"""
+    if '.' in table_name:
+        schema, table = table_name.split('.', 1)
+        return schema, table
+    if db_type == 'postgresql':
+        return 'public', table_name
+    return None, table_name
+
+
+def qualified_table_name(table_name, db_type):
+    # 对于PostgreSQL，如果表名不包含模式名，默认使用public模式
+    if db_type == 'postgresql' and '.' not in table_name:
+        return f"public.{table_name}"
+    return table_name
+
+
+# 表的主键列与各列是否可为 NULL（列名 -> nullable）
+TableKeys = namedtuple('TableKeys', ['primary_key', 'columns'])
+
+
+def catalog_table_keys(catalog, table_name, db_type):
+    """TableKeys from a schema catalog entry with table details; None when the table is not in it"""
+    details = (catalog or {}).get('details') or {}
+    info = details.get(table_name) or details.get(qualified_table_name(table_name, db_type))
+    if info is None:
+        return None
+    return TableKeys(list(info['primary_key']), {c['name']: c['nullable'] for c in info['columns']})
+
+
+class KeyColumnCache:
+    """
+    Primary key and column nullability per (connection, table)
+
+    Taken from the schema catalog's table details when loaded, otherwise read
+    via schema introspection. Entries are tagged with the refresh time of the
+    connection's catalog entry: a refresh or invalidation in any worker changes
+    it, and the next lookup re-reads the table.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (conn_id, table_name) -> (catalog refreshed_at, TableKeys)
+        self._keys = {}
+
+    def get(self, engine, conn_id, table_name, db_type, catalog=None):
+        keys = catalog_table_keys(catalog, table_name, db_type)
+        if keys is not None:
+            return keys
+
+        tag = catalog.get('refreshed_at') if catalog else None
+        cache_key = (conn_id, table_name)
+        with self._lock:
+            cached = self._keys.get(cache_key)
+        if cached is not None and tag is not None and cached[0] == tag:
+            return cached[1]
+
+        schema, table = split_table_name(table_name, db_type)
+        insp = inspect(engine)
+        pk = insp.get_pk_constraint(table, schema=schema) or {}
+        columns = insp.get_columns(table, schema=schema)
+        keys = TableKeys(
+            list(pk.get('constrained_columns') or []),
+            {col['name']: bool(col.get('nullable', True)) for col in columns},
+        )
+
+        with self._lock:
+            self._keys[cache_key] = (tag, keys)
+        return keys
+
+    def invalidate(self, conn_id):
+        with self._lock:
+            for key in [k for k in self._keys if k[0] == conn_id]:
+                del self._keys[key]
+
+
+key_column_cache = KeyColumnCache()
+
+
+def seek_columns(primary_key, sort_by=None):
+    """Columns that define a total order: the sort column, then the primary key"""
+    if not primary_key:
+        return []
+    if sort_by and sort_by not in primary_key:
+        return [sort_by] + list(primary_key)
+    if sort_by:
+        return [sort_by] + [c for c in primary_key if c != sort_by]
+    return list(primary_key)
+
+
+def can_seek(columns, keys):
+    """
+    keyset 分页要求排序列都不为 NULL
+
+    (c1, c2) > (:v1, :v2) 在任一列为 NULL 时结果为 NULL，这些行会被跳过；
+    可为 NULL 的排序列改用 OFFSET 分页。主键列视为 NOT NULL（SQLite 的
+    INTEGER PRIMARY KEY 在元数据中显示为可为 NULL）。
+    """
+    return bool(columns) and all(c in keys.primary_key or not keys.columns.get(c, True) for c in columns)
+
+
+def encode_cursor(columns, values, sort_order):
+    payload = {'k': columns, 'v': list(values), 'o': sort_order}
+    raw = json.dumps(payload, default=json_default, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token, columns, sort_order):
+    """Decode a continuation token and check it belongs to the current ordering"""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+    except Exception:
+        raise ValueError('invalid cursor')
+    if payload.get('k') != columns or payload.get('o') != sort_order or len(payload.get('v') or []) != len(columns):
+        raise ValueError('cursor does not match the current sort order')
+    return payload['v']
+
+
+def choose_pagination_mode(data):
+    """
+    选择分页方式
+
+    - 显式传入 mode 时以其为准；
+    - 带 cursor 的请求（上一页/下一页）使用 keyset；
+    - 跳转到指定页（page > 1）使用 OFFSET；
+    - 其余情况（第一页）使用 keyset。
+    """
+    mode = data.get('mode')
+    if mode in ('keyset', 'offset'):
+        return mode
+    if data.get('cursor'):
+        return 'keyset'
+    if int(data.get('page', 1) or 1) > 1:
+        return 'offset'
+    return 'keyset'
+
+
+def build_seek_clause(columns, values, sort_order, direction):
+    """
+    生成 (c1, c2, ...) > (:seek_0, :seek_1, ...) 形式的比较条件
+
+    direction 为 'prev' 时比较方向与排序方向相反。
+    """
+    forward = (sort_order == 'asc') == (direction != 'prev')
+    op = '>' if forward else '<'
+    params = {f'seek_{i}': v for i, v in enumerate(values)}
+    lhs = ', '.join(columns)
+    rhs = ', '.join(f':seek_{i}' for i in range(len(columns)))
+    if len(columns) == 1:
+        return f"{lhs} {op} {rhs}", params
+    return f"({lhs}) {op} ({rhs})", params
+
+
+def build_order_clause(columns, sort_order, direction='next'):
+    order = sort_order.upper()
+    if direction == 'prev':
+        order = 'DESC' if sort_order == 'asc' else 'ASC'
+    return ', '.join(f"{c} {order}" for c in columns)
@@ -0,0 +1,217 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+# 结果缓存的默认时间（秒），0 表示不缓存；可以按连接（query_cache_ttl 选项）或按请求（cacheTtl）覆盖
+QUERY_CACHE_TTL = float(os.environ.get('CHAT2DB_QUERY_CACHE_TTL', '0'))
+# 缓存的响应体总大小上限（字节），超过时按最近最少使用淘汰
+QUERY_CACHE_MAX_BYTES = int(os.environ.get('CHAT2DB_QUERY_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+# 单个结果的大小上限，过大的结果不缓存，避免挤掉其他条目
+QUERY_CACHE_MAX_ENTRY_BYTES = int(os.environ.get('CHAT2DB_QUERY_CACHE_MAX_ENTRY_BYTES', str(QUERY_CACHE_MAX_BYTES // 8)))
+
+# 只读语句的起始关键字
+READ_ONLY_KEYWORDS = ('select', 'with', 'show', 'describe', 'desc', 'explain', 'pragma')
+# 出现在语句开头（或 WITH 子句的某个 CTE 开头）说明会修改数据或依赖会话状态
+WRITE_KEYWORDS = {
+    'insert', 'update', 'delete', 'merge', 'replace', 'upsert', 'create', 'alter', 'drop', 'truncate',
+    'grant', 'revoke', 'call', 'exec', 'execute', 'copy', 'lock', 'vacuum', 'analyze', 'analyse',
+    'attach', 'detach', 'set', 'reset', 'do', 'load', 'rename', 'comment', 'refresh', 'reindex', 'cluster',
+}
+# 出现在语句任何位置都说明会写入或加锁：SELECT ... INTO、FOR UPDATE / FOR SHARE
+WRITE_PATTERN = re.compile(
+    r"\binto\b|\bfor\s+(?:no\s+key\s+)?(?:update|share|key\s+share)\b",
+    re.IGNORECASE,
+)
+# EXPLAIN 之后真正执行的语句（EXPLAIN ANALYZE 会执行它）
+EXPLAINED_KEYWORDS = {'select', 'with', 'values', 'table'} | WRITE_KEYWORDS - {'analyze', 'analyse'}
+# 非确定性函数：结果随时间或每次执行变化
+VOLATILE_PATTERN = re.compile(
+    r"\b(now|random|rand|uuid|gen_random_uuid|sysdate|current_timestamp|current_time|current_date|localtime|localtimestamp)\b",
+    re.IGNORECASE,
+)
+_IDENT = r'(?:`[^`]+`|"[^"]+"|\[[^\]]+\]|\w+)'
+TABLE_PATTERN = re.compile(rf'\b(?:from|join)\s+({_IDENT}(?:\s*\.\s*{_IDENT})*)', re.IGNORECASE)
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+# 字符串常量、注释与带引号的标识符，检查关键字前替换掉
+NON_CODE = re.compile(r"""'(?:[^']|'')*'|--[^\n]*|/\*.*?\*/|"(?:[^"]|"")*"|`[^`]*`""", re.S)
+_WORD_TOKEN = re.compile(r'\w+')
+# WITH 子句中每个 CTE 的开头：name AS [NOT] [MATERIALIZED] (
+CTE_BODY = re.compile(r'\bas\s+(?:not\s+)?(?:materialized\s+)?\(\s*(\w+)', re.IGNORECASE)
+
+
+def normalize_sql(sql):
+    """Collapse whitespace and drop the trailing semicolon so formatting differences share a key"""
+    sql = str(sql or '').strip()
+    while sql.endswith(';'):
+        sql = sql[:-1].rstrip()
+    # 字符串常量内的空白保持不变
+    parts = []
+    last = 0
+    for m in STRING_LITERAL.finditer(sql):
+        parts.append(re.sub(r'\s+', ' ', sql[last:m.start()]))
+        parts.append(m.group(0))
+        last = m.end()
+    parts.append(re.sub(r'\s+', ' ', sql[last:]))
+    return ''.join(parts)
+
+
+def sql_code(sql):
+    """The statement without string literals, comments and quoted identifiers"""
+    def replace(m):
+        text = m.group(0)
+        if text[0] == "'":
+            return "''"
+        return ' ' if text[0] in '-/' else '_'
+    # 先去掉注释再合并空白，-- 注释以换行结束
+    return normalize_sql(NON_CODE.sub(replace, str(sql or '')))
+
+
+def leading_keywords(code):
+    """First keyword of every statement and of every CTE body, lower-cased"""
+    keywords = []
+    for statement in code.split(';'):
+        words = [w.lower() for w in _WORD_TOKEN.findall(statement.replace('(', ' '))]
+        if not words:
+            continue
+        first = words[0]
+        if first == 'explain':
+            # 跳过 ANALYZE、VERBOSE、FORMAT 等选项，找到被解释的语句
+            first = next((w for w in words[1:] if w in EXPLAINED_KEYWORDS), first)
+        keywords.append(first)
+        keywords.extend(m.lower() for m in CTE_BODY.findall(statement))
+    return keywords
+
+
+def is_write(code):
+    return any(k in WRITE_KEYWORDS for k in leading_keywords(code)) or bool(WRITE_PATTERN.search(code))
+
+
+def is_cacheable(sql):
+    """
+    判断语句是否可以缓存结果
+
+    只缓存单条只读语句（SELECT / WITH / SHOW / EXPLAIN 等）；以写操作开头（包括
+    WITH 中修改数据的 CTE）、SELECT ... INTO、FOR UPDATE 或包含非确定性函数的语句直接执行。
+    """
+    # 去掉字符串常量与注释后再检查关键字，避免 WHERE name = 'drop' 之类误判
+    code = sql_code(sql)
+    if not code.strip() or ';' in code:
+        return False
+    first = code.split(None, 1)[0].lstrip('(').lower()
+    if first not in READ_ONLY_KEYWORDS:
+        return False
+    return not is_write(code) and not VOLATILE_PATTERN.search(code)
+
+
+def modifies_data(sql):
+    """True if the statement may write, so cached results for its connection are stale"""
+    return is_write(sql_code(sql))
+
+
+def referenced_tables(sql):
+    """Table names after FROM / JOIN, lower-cased and without quotes"""
+    bare = STRING_LITERAL.sub("''", normalize_sql(sql))
+    tables = set()
+    for name in TABLE_PATTERN.findall(bare):
+        name = re.sub(r'[`"\[\]\s]', '', name).lower()
+        tables.add(name)
+        # schema.table 同时按不带 schema 的表名登记
+        if '.' in name:
+            tables.add(name.rsplit('.', 1)[1])
+    return tables
+
+
+class QueryCache:
+    """
+    只读查询结果缓存
+
+    按 (连接, 规范化后的 SQL, 参数) 缓存序列化好的 JSON 响应体，命中时不再访问
+    目标数据库（二进制格式同样按原样缓存）；条目在 TTL 到期后失效，总大小超过上限时按最近最少使用淘汰。
+    """
+
+    def __init__(self, max_bytes=QUERY_CACHE_MAX_BYTES, max_entry_bytes=QUERY_CACHE_MAX_ENTRY_BYTES):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self._lock = threading.Lock()
+        # key -> (body, stored_at, expires_at, conn_id, tables, mimetype)
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._stats = {'hits': 0, 'misses': 0, 'bypasses': 0, 'stores': 0, 'evictions': 0, 'invalidations': 0}
+
+    @staticmethod
+    def make_key(conn_id, sql, params=None, variant=None):
+        raw = json.dumps([normalize_sql(sql), params or {}, variant], sort_keys=True, default=str)
+        return (conn_id, hashlib.sha1(raw.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        """Return (body, age_seconds, mimetype) or None"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            body, stored_at, expires_at, _, _, mimetype = entry
+            if expires_at <= now:
+                self._remove(key)
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return body, now - stored_at, mimetype
+
+    def put(self, key, body, ttl, tables=(), mimetype='application/json'):
+        if ttl <= 0 or len(body) > self.max_entry_bytes:
+            return False
+        now = time.time()
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (body, now, now + ttl, key[0], frozenset(t.lower() for t in tables), mimetype)
+            self._bytes += len(body)
+            self._stats['stores'] += 1
+            while self._bytes > self.max_bytes and self._entries:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self._stats['evictions'] += 1
+        return True
+
+    def record_bypass(self):
+        with self._lock:
+            self._stats['bypasses'] += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= len(entry[0])
+
+    def invalidate(self, conn_id, table=None):
+        """Drop a connection's cached results, or only those reading the given table; returns the count"""
+        table = table.lower() if table else None
+        with self._lock:
+            keys = [
+                key for key, entry in self._entries.items()
+                if entry[3] == conn_id and (table is None or table in entry[4])
+            ]
+            for key in keys:
+                self._remove(key)
+            self._stats['invalidations'] += len(keys)
+        return len(keys)
+
+    def stats(self):
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses']
+            return dict(
+                self._stats,
+                entries=len(self._entries),
+                bytes=self._bytes,
+                max_bytes=self.max_bytes,
+                hit_ratio=round(self._stats['hits'] / lookups, 3) if lookups else None,
+            )
+
+
+# Create global query result cache
+query_cache = QueryCache()
@@ -0,0 +1,430 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+from models import RunningQueryEntry
+
+logger = logging.getLogger(__name__)
+
+# 默认语句超时（秒），0 表示不限制；可以按连接（statement_timeout 选项）或按请求（timeout）设置
+STATEMENT_TIMEOUT = float(os.environ.get('CHAT2DB_STATEMENT_TIMEOUT', '0'))
+# 服务端超时没有生效时（例如 MySQL 的非 SELECT 语句），超过该宽限时间后主动取消
+CANCEL_GRACE = float(os.environ.get('CHAT2DB_CANCEL_GRACE', '1'))
+# SQLite 每执行多少条虚拟机指令检查一次超时与取消
+SQLITE_PROGRESS_STEPS = 10000
+# 其他 worker 收到的取消请求记录在应用数据库中，执行查询的 worker 每隔多少秒检查一次
+CANCEL_POLL_INTERVAL = float(os.environ.get('CHAT2DB_CANCEL_POLL_INTERVAL', '0.5'))
+# 本次启动的标识；gunicorn master 在加载应用前设置，所有 worker 相同。
+# 容器重启后进程号会被复用，启动时删除其他启动留下的记录
+BOOT_ID = os.environ.get('CHAT2DB_BOOT_ID') or uuid.uuid4().hex
+
+
+class QueryCancelled(Exception):
+    """The query was stopped by a cancel request or by its statement timeout"""
+
+    def __init__(self, reason, query_id):
+        self.reason = reason
+        self.query_id = query_id
+        if reason == 'timeout':
+            message = 'query exceeded its statement timeout'
+        else:
+            message = 'query was cancelled'
+        super().__init__(message)
+
+
+def effective_timeout(*limits):
+    """Smallest positive limit; a request can shorten the connection's timeout but not extend it"""
+    positive = [float(t) for t in limits if t is not None and float(t) > 0]
+    return min(positive) if positive else 0
+
+
+class RunningQuery:
+    def __init__(self, query_id, conn_id, db_type, sql, user_id=None, timeout=0):
+        self.id = query_id
+        self.conn_id = conn_id
+        self.db_type = db_type
+        self.sql = sql
+        self.user_id = user_id
+        self.timeout = timeout
+        self.started = time.time()
+        self.deadline = time.monotonic() + timeout if timeout else None
+        # 取消原因：'cancelled' 或 'timeout'
+        self.cancel_reason = None
+        # 服务端会话标识（pg_backend_pid / CONNECTION_ID）
+        self.backend_id = None
+        self.engine = None
+        self.dbapi_connection = None
+        # 取消命令与查询结束互斥，避免取消到已归还连接池、正在执行其他查询的会话
+        self.lock = threading.Lock()
+        self.finished = False
+        # 执行查询的 worker 进程
+        self.pid = os.getpid()
+
+    @classmethod
+    def from_entry(cls, entry):
+        """A query registered by another worker, read from the running_queries table"""
+        query = cls(entry.id, entry.connection_id, entry.db_type, entry.sql, entry.user_id, entry.timeout or 0)
+        query.started = entry.started
+        query.backend_id = entry.backend_id
+        query.cancel_reason = entry.cancel_reason
+        query.pid = entry.pid
+        return query
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'connection_id': self.conn_id,
+            'sql': self.sql,
+            'user_id': self.user_id,
+            'started': self.started,
+            'elapsed': round(time.time() - self.started, 3),
+            'timeout': self.timeout or None,
+            'cancelling': self.cancel_reason is not None,
+            'worker': self.pid,
+        }
+
+
+class QueryRegistry:
+    """
+    正在执行的目标数据库查询
+
+    每个查询在执行期间登记一个 ID，并在会话上设置语句超时：
+    PostgreSQL 使用 SET LOCAL statement_timeout，MySQL 使用 MAX_EXECUTION_TIME，
+    SQLite 使用 progress handler。取消时在另一个连接上执行 pg_cancel_backend /
+    KILL QUERY，SQLite 调用 interrupt()。
+
+    绑定应用数据库后（init_query_registry），客户端指定了 queryId 或设置了超时的查询
+    同时登记在 running_queries 表中，任何 worker 都能列出和取消：取消请求写入该表，
+    由执行查询的 worker 的后台线程发现后在本进程中执行取消，与查询结束互斥。
+    其他查询（翻页、计数）只登记在本进程内，不写应用数据库。
+    """
+
+    def __init__(self, session_factory=None, boot_id=BOOT_ID):
+        self.Session = session_factory
+        self.boot_id = boot_id
+        self._lock = threading.Lock()
+        # query_id -> RunningQuery
+        self._running = {}
+        # 本进程登记在 running_queries 表中、仍在执行的查询
+        self._shared = set()
+        # 检查取消请求的后台线程只在有这类查询时运行，且不会随 fork 复制
+        self._poller_pid = None
+
+    @contextmanager
+    def run(self, engine, conn_id, db_type, sql, timeout=0, user_id=None, query_id=None, shared=None):
+        """Check out a connection with the timeout applied and register it; yields (connection, RunningQuery)
+
+        shared: also record the query in the app database so other workers can list and cancel it;
+        by default only when the client chose the query id or the query has a timeout.
+        """
+        if shared is None:
+            shared = query_id is not None or bool(timeout)
+        query = RunningQuery(query_id or uuid.uuid4().hex, conn_id, db_type, sql, user_id, timeout)
+        query.engine = engine
+        with self._lock:
+            if query.id in self._running:
+                raise ValueError(f'query id already running: {query.id}')
+            self._running[query.id] = query
+
+        watchdog = None
+        stored = False
+        try:
+            with engine.connect() as conn:
+                query.dbapi_connection = conn.connection.dbapi_connection
+                self._prepare(conn, query)
+                stored = shared and self._store(query)
+                if timeout and db_type != 'sqlite':
+                    watchdog = threading.Timer(timeout + CANCEL_GRACE, self.cancel, (query.id, 'timeout'))
+                    watchdog.daemon = True
+                    watchdog.start()
+                try:
+                    if query.cancel_reason:
+                        # 取消请求在会话准备好之前到达，还没有可以终止的语句
+                        raise QueryCancelled(query.cancel_reason, query.id)
+                    yield conn, query
+                except QueryCancelled:
+                    raise
+                except Exception as e:
+                    if query.cancel_reason:
+                        raise QueryCancelled(query.cancel_reason, query.id) from e
+                    if timeout and is_timeout_error(e):
+                        raise QueryCancelled('timeout', query.id) from e
+                    raise
+                finally:
+                    with query.lock:
+                        query.finished = True
+                    if watchdog:
+                        watchdog.cancel()
+                    self._reset(conn, query)
+        finally:
+            with self._lock:
+                self._running.pop(query.id, None)
+                self._shared.discard(query.id)
+            if stored:
+                self._unstore(query.id)
+
+    def _prepare(self, conn, query):
+        timeout_ms = int(query.timeout * 1000)
+        if query.db_type == 'postgresql':
+            query.backend_id = conn.execute(text("SELECT pg_backend_pid()")).scalar()
+            if timeout_ms:
+                # 只在当前事务内生效，连接归还连接池时随回滚失效
+                conn.execute(text(f"SET LOCAL statement_timeout = {timeout_ms}"))
+        elif query.db_type == 'mysql':
+            query.backend_id = conn.execute(text("SELECT CONNECTION_ID()")).scalar()
+            if timeout_ms:
+                conn.execute(text(f"SET SESSION MAX_EXECUTION_TIME = {timeout_ms}"))
+        elif query.db_type == 'sqlite':
+            def progress():
+                if query.cancel_reason:
+                    return 1
+                if query.deadline and time.monotonic() > query.deadline:
+                    query.cancel_reason = 'timeout'
+                    return 1
+                return 0
+            query.dbapi_connection.set_progress_handler(progress, SQLITE_PROGRESS_STEPS)
+
+    def _reset(self, conn, query):
+        try:
+            if query.db_type == 'mysql' and query.timeout:
+                conn.execute(text("SET SESSION MAX_EXECUTION_TIME = DEFAULT"))
+            elif query.db_type == 'sqlite':
+                query.dbapi_connection.set_progress_handler(None, 0)
+        except Exception:
+            # 连接已不可用，归还时由连接池丢弃
+            conn.invalidate()
+
+    def _store(self, query):
+        """Record the query in running_queries; False when the registry is not bound or the write failed"""
+        if self.Session is None:
+            return False
+        session = self.Session()
+        try:
+            session.add(RunningQueryEntry(
+                id=query.id, user_id=query.user_id, connection_id=query.conn_id, db_type=query.db_type,
+                sql=query.sql, timeout=query.timeout, pid=query.pid, boot_id=self.boot_id,
+                backend_id=query.backend_id, started=query.started))
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+            raise ValueError(f'query id already running: {query.id}')
+        except Exception as e:
+            session.rollback()
+            # 查询照常执行，只是不能从其他 worker 取消
+            logger.warning("Failed to record running query", extra={'query_id': query.id, 'error': str(e)})
+            return False
+        finally:
+            session.close()
+        with self._lock:
+            self._shared.add(query.id)
+            if self._poller_pid != os.getpid():
+                self._poller_pid = os.getpid()
+                threading.Thread(target=self._poll_cancel_requests, name='query-cancel-poller', daemon=True).start()
+        return True
+
+    def _unstore(self, query_id):
+        session = self.Session()
+        try:
+            session.query(RunningQueryEntry).filter_by(id=query_id).delete()
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.warning("Failed to remove running query", extra={'query_id': query_id, 'error': str(e)})
+        finally:
+            session.close()
+
+    def _poll_cancel_requests(self):
+        while True:
+            time.sleep(CANCEL_POLL_INTERVAL)
+            with self._lock:
+                shared_ids = list(self._shared)
+                if not shared_ids:
+                    # 没有可被其他 worker 取消的查询，下一次登记时重新启动
+                    self._poller_pid = None
+                    return
+            session = self.Session()
+            try:
+                requested = session.query(RunningQueryEntry.id, RunningQueryEntry.cancel_reason).filter(
+                    RunningQueryEntry.id.in_(shared_ids), RunningQueryEntry.cancel_reason.isnot(None)).all()
+            except Exception:
+                # 取消请求暂时读不到，下一轮重试；超时由本进程的 watchdog / progress handler 保证
+                logger.exception("Failed to read cancel requests", extra={'query_ids': shared_ids})
+                continue
+            finally:
+                session.close()
+            for query_id, reason in requested:
+                query = self._local(query_id)
+                if query is None or query.cancel_reason is not None:
+                    continue
+                try:
+                    self._cancel_local(query, reason)
+                except Exception as e:
+                    logger.warning("Failed to cancel query", extra={'query_id': query_id, 'error': str(e)})
+
+    def _local(self, query_id):
+        with self._lock:
+            return self._running.get(query_id)
+
+    def get(self, query_id):
+        """The running query, including queries registered by other workers; None if not found"""
+        query = self._local(query_id)
+        if query is not None or self.Session is None:
+            return query
+        session = self.Session()
+        try:
+            entry = session.query(RunningQueryEntry).filter_by(id=query_id).first()
+            return RunningQuery.from_entry(entry) if entry else None
+        finally:
+            session.close()
+
+    def list(self, conn_id=None, user_id=None):
+        """Queries of this process plus those other workers recorded in running_queries"""
+        with self._lock:
+            queries = [
+                q.to_dict() for q in self._running.values()
+                if (conn_id is None or q.conn_id == conn_id) and (user_id is None or q.user_id == user_id)
+            ]
+        if self.Session is not None:
+            session = self.Session()
+            try:
+                entries = session.query(RunningQueryEntry)
+                if conn_id is not None:
+                    entries = entries.filter_by(connection_id=conn_id)
+                if user_id is not None:
+                    entries = entries.filter_by(user_id=user_id)
+                local_ids = {q['id'] for q in queries}
+                queries += [entry.to_dict() for entry in entries.all() if entry.id not in local_ids]
+            finally:
+                session.close()
+        return sorted(queries, key=lambda q: q['started'] or 0)
+
+    def forget_process(self, pid):
+        """Drop the entries of a worker process that exited"""
+        if self.Session is None:
+            return 0
+        session = self.Session()
+        try:
+            removed = session.query(RunningQueryEntry).filter_by(pid=pid, boot_id=self.boot_id).delete()
+            session.commit()
+            return removed
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def prune(self):
+        """Drop entries left behind by earlier boots and by worker processes that no longer exist"""
+        if self.Session is None:
+            return 0
+        session = self.Session()
+        try:
+            # 其他启动的进程号可能已被本次启动的进程复用，不能用 process_alive 判断
+            removed = session.query(RunningQueryEntry).filter(
+                (RunningQueryEntry.boot_id != self.boot_id) | RunningQueryEntry.boot_id.is_(None)
+            ).delete(synchronize_session=False)
+            session.commit()
+            pids = [pid for (pid,) in session.query(RunningQueryEntry.pid).distinct()]
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        return removed + sum(self.forget_process(pid) for pid in pids if not process_alive(pid))
+
+    def cancel(self, query_id, reason='cancelled'):
+        """Stop a running query on the database server; returns False if it is no longer running"""
+        query = self._local(query_id)
+        if query is None:
+            return self._request_cancel(query_id, reason)
+        return self._cancel_local(query, reason)
+
+    def _request_cancel(self, query_id, reason):
+        # 查询在其他 worker 中执行，由该 worker 检查到取消请求后执行
+        if self.Session is None:
+            return False
+        session = self.Session()
+        try:
+            entry = session.query(RunningQueryEntry).filter_by(id=query_id).first()
+            if entry is None:
+                return False
+            if entry.cancel_reason is None:
+                entry.cancel_reason = reason
+                session.commit()
+            return True
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def _cancel_local(self, query, reason):
+        with query.lock:
+            if query.finished:
+                return False
+            if query.cancel_reason is None:
+                query.cancel_reason = reason
+
+            if query.db_type == 'sqlite':
+                # progress handler 会在下一次检查时中止；interrupt() 可以跨线程调用
+                if query.dbapi_connection is not None:
+                    query.dbapi_connection.interrupt()
+                return True
+            backend_id = query.backend_id
+        if backend_id is None:
+            return True
+
+        if query.db_type == 'postgresql':
+            statement = f"SELECT pg_cancel_backend({int(backend_id)})"
+        else:
+            statement = f"KILL QUERY {int(backend_id)}"
+        # 取消命令使用不经过连接池的新连接：连接池耗尽时不必排队，也不在持有锁时等待
+        dialect = query.engine.dialect
+        cargs, cparams = dialect.create_connect_args(query.engine.url)
+        dbapi_connection = dialect.connect(*cargs, **cparams)
+        try:
+            with query.lock:
+                # 建立连接期间查询可能已结束，会话可能已归还连接池
+                if query.finished:
+                    return True
+                cursor = dbapi_connection.cursor()
+                try:
+                    cursor.execute(statement)
+                finally:
+                    cursor.close()
+        finally:
+            dbapi_connection.close()
+        return True
+
+
+def is_timeout_error(error):
+    # 服务端超时：PostgreSQL 57014（query_canceled），MySQL 3024（max_execution_time exceeded）
+    orig = getattr(error, 'orig', None) or error
+    if getattr(orig, 'pgcode', None) == '57014':
+        return True
+    args = getattr(orig, 'args', ())
+    return bool(args) and args[0] == 3024
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+# Create global query registry
+query_registry = QueryRegistry()
+
+def init_query_registry(session_factory):
+    """Share running queries across worker processes through the app database"""
+    query_registry.Session = session_factory
+    query_registry.prune()
+    return query_registry
@@ -0,0 +1,118 @@
+import logging
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# 导入本模块的时间近似为应用开始导入的时间
+_import_started = time.perf_counter()
+_last_mark = _import_started
+# [(phase, seconds)]
+_phases = []
+
+_lock = threading.Lock()
+_thread = None
+_state = {
+    'ready': False,
+    'warming': False,
+    'started_at': None,
+    'ready_at': None,
+    # step name -> seconds
+    'steps': {},
+    'error': None,
+}
+
+# 导入较慢的依赖，启动档案中报告它们是否已经加载
+HEAVY_MODULES = ('pandas', 'torch', 'transformers', 'sentence_transformers')
+
+
+def _load_embeddings():
+    from embeddings import manager as embeddings_manager
+    embeddings_manager.get_embeddings_model()
+
+
+def _load_intent_matrix():
+    # EnhancedNLP 在构造时计算意图向量矩阵
+    from nlp_enhanced import get_enhanced_nlp
+    get_enhanced_nlp()
+
+
+WARMUP_STEPS = [
+    ('embeddings_model', _load_embeddings),
+    ('intent_matrix', _load_intent_matrix),
+]
+
+
+def mark(phase):
+    """Record the time spent since the previous mark as one startup phase"""
+    global _last_mark
+    now = time.perf_counter()
+    with _lock:
+        _phases.append((phase, round(now - _last_mark, 3)))
+        _last_mark = now
+
+
+def warm_up():
+    """
+    加载模型等启动较慢的资源，完成后标记为就绪
+
+    gunicorn 预加载模式下在 master 进程 fork 之前调用，加载好的模型以写时复制
+    的方式被所有 worker 共享。重复调用时直接返回。
+    """
+    with _lock:
+        if _state['ready'] or _state['warming']:
+            return _state['ready']
+        _state['warming'] = True
+        _state['started_at'] = time.time()
+
+    error = None
+    for name, step in WARMUP_STEPS:
+        start = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            logger.exception(f"Warm-up step {name} failed")
+            error = f"{name}: {e}"
+        with _lock:
+            _state['steps'][name] = round(time.perf_counter() - start, 3)
+
+    with _lock:
+        _state['warming'] = False
+        _state['error'] = error
+        # 加载失败时各模块会回退到后备实现，服务仍然可用
+        _state['ready'] = True
+        _state['ready_at'] = time.time()
+    logger.info(f"Warm-up finished: {_state['steps']}")
+    return True
+
+
+def start_background_warm_up():
+    """Warm up in a daemon thread so the server can answer /health immediately"""
+    global _thread
+    with _lock:
+        if _state['ready'] or (_thread is not None and _thread.is_alive()):
+            return
+        _thread = threading.Thread(target=warm_up, name='chat2db-warmup', daemon=True)
+        _thread.start()
+
+
+def is_ready():
+    return _state['ready']
+
+
+def status():
+    with _lock:
+        return dict(_state, steps=dict(_state['steps']))
+
+
+def startup_profile():
+    """Import-time breakdown of app startup plus warm-up step timings"""
+    with _lock:
+        phases = [{'phase': phase, 'seconds': seconds} for phase, seconds in _phases]
+    return {
+        'import_phases': phases,
+        'import_total': round(sum(p['seconds'] for p in phases), 3),
+        'warm_up': status(),
+        'heavy_modules_loaded': {name: name in sys.modules for name in HEAVY_MODULES},
+    }
@@ -0,0 +1,201 @@
+import io
+import json
+from decimal import Decimal
+import numpy as np
+from result_stream import json_default
+
+# 查询结果的编码方式 -> Content-Type
+# records:  {"rows": [{"col": value, ...}, ...]}，兼容原有接口
+# columnar: {"columns": [...], "rows": [[value, ...], ...]}，列名只出现一次
+# arrow / parquet: 二进制列式格式，需要安装 pyarrow；其余字段写入 schema 元数据的 chat2db 键
+RESULT_FORMATS = {
+    'records': 'application/json',
+    'columnar': 'application/vnd.chat2db.columnar+json',
+    'arrow': 'application/vnd.apache.arrow.stream',
+    'parquet': 'application/vnd.apache.parquet',
+}
+BINARY_FORMATS = ('arrow', 'parquet')
+META_KEY = b'chat2db'
+
+# 不需要转换即可 JSON 序列化的值类型
+NATIVE_TYPES = {str, int, float, bool}
+# float64 可以精确表示的有效数字位数
+MAX_FLOAT_DIGITS = 15
+INT64_LIMIT = 2 ** 63
+
+
+def negotiate_result_format(data, accept_mimetypes):
+    """
+    选择结果编码：请求体的 resultFormat 优先，其次是 Accept 请求头，默认 records
+
+    不支持的 resultFormat 抛出 ValueError。
+    """
+    fmt = (data or {}).get('resultFormat')
+    if fmt:
+        if fmt not in RESULT_FORMATS:
+            raise ValueError(f'unsupported result format: {fmt}')
+        return fmt
+    # records 排在第一位，Accept: */* 或缺省时保持原有格式
+    best = accept_mimetypes.best_match(list(RESULT_FORMATS.values()), default=RESULT_FORMATS['records'])
+    for fmt, mimetype in RESULT_FORMATS.items():
+        if mimetype == best:
+            return fmt
+    return 'records'
+
+
+def plain_value(value):
+    """
+    把数据库驱动返回的对象转换为 JSON 原生类型
+
+    - Decimal: 整数值转为 int，有效数字不超过 15 位时转为 float，否则保留为字符串
+    - date / datetime / time: ISO 8601 字符串；timedelta: str()
+    - bytes: base64 字符串
+    """
+    if isinstance(value, Decimal):
+        if not value.is_finite():
+            return str(value)
+        if value == value.to_integral_value():
+            return int(value)
+        if len(value.as_tuple().digits) <= MAX_FLOAT_DIGITS:
+            return float(value)
+        return str(value)
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (str, int, float, bool)):
+        return value
+    return json_default(value)
+
+
+def _with_nulls(values, mask):
+    if mask.any():
+        for i in np.flatnonzero(mask):
+            values[i] = None
+    return values
+
+
+def column_values(series):
+    """
+    One DataFrame column as a list of JSON-native Python values, converted column-wise
+
+    NaN / NaT / NA (and infinities) become None and integral floats become int (pandas turns
+    integer columns with NULLs into float64); object columns only fall back
+    to per-value conversion when they hold Decimal, dates, bytes and the like.
+    """
+    dtype = series.dtype
+    kind = dtype.kind
+    mask = series.isna().to_numpy()
+
+    if kind in 'iub':
+        # numpy 整数 / 布尔列，以及可空的 Int64 / boolean 扩展类型
+        if not mask.any():
+            return series.to_numpy().tolist()
+        # UInt64 的值可能超过 int64 的范围
+        target = {'b': bool, 'u': np.uint64, 'i': np.int64}[kind]
+        filled = series.fillna(False if kind == 'b' else 0).to_numpy(dtype=target)
+        return _with_nulls(filled.tolist(), mask)
+
+    if kind == 'f':
+        arr = series.to_numpy(dtype=np.float64, na_value=np.nan)
+        out = arr.astype(object)
+        integral = np.isfinite(arr) & (np.floor(arr) == arr) & (np.abs(arr) < INT64_LIMIT)
+        if integral.any():
+            out[integral] = arr[integral].astype(np.int64).astype(object)
+        # NaN 与 ±Infinity 都不是合法的 JSON
+        out[~np.isfinite(arr)] = None
+        return out.tolist()
+
+    if kind == 'M':
+        if getattr(dtype, 'tz', None) is not None:
+            series = series.dt.tz_convert('UTC').dt.tz_localize(None)
+            timezone = 'UTC'
+        else:
+            timezone = 'naive'
+        arr = series.to_numpy().astype('datetime64[us]')
+        # 没有小数秒时输出到秒，与 datetime.isoformat() 一致
+        has_fraction = ((arr.view(np.int64) % 1000000) != 0) & ~mask
+        unit = 'us' if has_fraction.any() else 's'
+        strings = np.datetime_as_string(arr, unit=unit, timezone=timezone)
+        if timezone == 'UTC':
+            strings = np.char.replace(strings, 'Z', '+00:00')
+        return _with_nulls(strings.tolist(), mask)
+
+    if kind == 'm':
+        return [None if null else str(value) for value, null in zip(series.dt.to_pytimedelta(), mask)]
+
+    # object / string / category：只有包含非原生类型时才逐个转换
+    values = series.to_numpy(dtype=object)
+    if mask.any():
+        # pandas 把 Decimal('NaN') 当作缺失值，plain_value 把它保留为字符串 'NaN'
+        nulls = np.flatnonzero(mask)
+        mask = mask.copy()
+        mask[nulls[[isinstance(values[i], Decimal) for i in nulls]]] = False
+    present = values[~mask] if mask.any() else values
+    types = set(map(type, present))
+    if types <= NATIVE_TYPES:
+        return _with_nulls(values.tolist(), mask)
+    if types == {Decimal}:
+        return _decimal_values(values, mask)
+    return _with_nulls([plain_value(v) for v in values.tolist()], mask)
+
+
+def _decimal_values(values, mask):
+    """NUMERIC / DECIMAL column: the same result as plain_value, vectorized through float64"""
+    present = ~mask
+    floats = np.zeros(len(values))
+    floats[present] = values[present].astype(np.float64)
+    # 字符串不超过 16 个字符（含符号与小数点）时有效数字不超过 15 位，float 可以精确表示
+    short = np.char.str_len(values.astype(str)) <= MAX_FLOAT_DIGITS + 1
+    finite = np.isfinite(floats)
+    whole = np.floor(floats) == floats
+
+    out = floats.astype(object)
+    # 超出 int64 范围的整数值（如 1E+20）与长数字、NaN、Infinity 一样交给 plain_value
+    integral = present & short & finite & whole & (np.abs(floats) < INT64_LIMIT)
+    if integral.any():
+        out[integral] = floats[integral].astype(np.int64).astype(object)
+    fractional = short & finite & ~whole
+    for i in np.flatnonzero(present & ~integral & ~fractional):
+        out[i] = plain_value(values[i])
+    out[mask] = None
+    return out.tolist()
+
+
+def frame_columns(df):
+    """Return (column names, list of value lists) without building per-row dicts"""
+    columns = [str(c) for c in df.columns]
+    return columns, [column_values(df.iloc[:, i]) for i in range(len(columns))]
+
+
+def columns_to_rows(values):
+    """Row arrays from per-column value lists"""
+    return [list(row) for row in zip(*values)]
+
+
+def columns_to_records(columns, values):
+    return [dict(zip(columns, row)) for row in zip(*values)]
+
+
+def pyarrow_available():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def encode_binary(df, fmt, meta):
+    """Encode a DataFrame as an Arrow IPC stream or a Parquet file; meta goes into the schema metadata"""
+    import pyarrow as pa
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[META_KEY] = json.dumps(meta, default=json_default).encode('utf-8')
+    table = table.replace_schema_metadata(metadata)
+
+    sink = io.BytesIO()
+    if fmt == 'arrow':
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+    else:
+        import pyarrow.parquet as pq
+        pq.write_table(table, sink)
+    return sink.getvalue()
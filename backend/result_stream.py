@@ -0,0 +1,135 @@
+import base64
+import json
+import os
+from datetime import date, datetime, time as dt_time, timedelta
+from decimal import Decimal
+from sqlalchemy import text
+
+# 流式查询的默认参数，可通过环境变量调整
+STREAM_BATCH_SIZE = int(os.environ.get('CHAT2DB_STREAM_BATCH_SIZE', '1000'))
+STREAM_MAX_ROWS = int(os.environ.get('CHAT2DB_STREAM_MAX_ROWS', '1000000'))
+STREAM_MAX_BYTES = int(os.environ.get('CHAT2DB_STREAM_MAX_BYTES', str(256 * 1024 * 1024)))
+
+STREAM_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'json': 'application/json',
+}
+
+
+def json_default(value):
+    """JSON fallback for values returned by database drivers"""
+    if isinstance(value, (datetime, date, dt_time)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, timedelta):
+        return str(value)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return base64.b64encode(bytes(value)).decode('ascii')
+    return str(value)
+
+
+def _dumps(value):
+    return json.dumps(value, default=json_default, ensure_ascii=False)
+
+
+def _size(chunk):
+    # 响应按 UTF-8 编码发送，非 ASCII 字符占多个字节
+    return len(chunk.encode('utf-8'))
+
+
+def stream_limits(max_rows=None, max_bytes=None):
+    """Validated (max_rows, max_bytes), capped by the server limits; raises ValueError on bad input"""
+    def limit(value, name, cap):
+        if value is None:
+            return cap
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            raise ValueError(f'{name} must be an integer')
+        if value < 0:
+            raise ValueError(f'{name} must not be negative')
+        return min(value, cap)
+    return limit(max_rows, 'maxRows', STREAM_MAX_ROWS), limit(max_bytes, 'maxBytes', STREAM_MAX_BYTES)
+
+
+def iter_connection_batches(conn, sql, batch_size=STREAM_BATCH_SIZE):
+    """
+    使用服务端游标分批读取 SQLAlchemy 查询结果
+
+    第一个产出值是列名列表，之后每次产出一批行（tuple 列表）。
+    """
+    result = conn.execution_options(stream_results=True, max_row_buffer=batch_size).execute(text(sql))
+    yield list(result.keys())
+    for partition in result.partitions(batch_size):
+        yield partition
+
+
+def stream_rows(batches, fmt='ndjson', sql=None, max_rows=None, max_bytes=None):
+    """
+    把分批读取的结果编码为 NDJSON 或分块 JSON 数组
+
+    NDJSON: 第一行为 {"sql", "columns"} 对象，之后每行是一个数组形式的记录，
+    最后一行为 {"rowCount", "truncated"} 对象。
+    JSON:   {"sql", "columns", "rows": [{...}, ...], "rowCount", "truncated"}，
+    与非流式接口的返回结构一致，只是逐批写出。
+
+    超过 max_rows 或 max_bytes 时停止读取并标记 truncated。
+    """
+    max_rows, max_bytes = stream_limits(max_rows, max_bytes)
+
+    row_count = 0
+    sent_bytes = 0
+    truncated = False
+    columns = []
+    started = False
+
+    try:
+        columns = next(batches)
+        if fmt == 'json':
+            head = '{' + f'"sql": {_dumps(sql)}, "columns": {_dumps(columns)}, "rows": ['
+        else:
+            head = _dumps({'sql': sql, 'columns': columns}) + '\n'
+        sent_bytes += _size(head)
+        started = True
+        yield head
+
+        for batch in batches:
+            lines = []
+            for row in batch:
+                if row_count >= max_rows or sent_bytes >= max_bytes:
+                    truncated = True
+                    break
+                if fmt == 'json':
+                    line = _dumps(dict(zip(columns, row)))
+                    if row_count:
+                        line = ', ' + line
+                else:
+                    line = _dumps(list(row)) + '\n'
+                sent_bytes += _size(line)
+                row_count += 1
+                lines.append(line)
+            if lines:
+                yield ''.join(lines)
+            if truncated:
+                break
+
+        summary = {'rowCount': row_count, 'truncated': truncated}
+        if fmt == 'json':
+            yield f'], "rowCount": {row_count}, "truncated": {_dumps(truncated)}' + '}'
+        else:
+            yield _dumps(summary) + '\n'
+    except Exception as e:
+        # 响应头已经发出，只能在数据流中报告错误
+        if fmt == 'json':
+            if started:
+                yield f'], "rowCount": {row_count}, "error": {_dumps(str(e))}' + '}'
+            else:
+                yield _dumps({'sql': sql, 'error': str(e)})
+        else:
+            yield _dumps({'error': str(e), 'rowCount': row_count}) + '\n'
+    finally:
+        # 提前结束时关闭底层游标与连接
+        close = getattr(batches, 'close', None)
+        if close:
+            close()
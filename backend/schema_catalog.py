@@ -0,0 +1,386 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import inspect, text
+from models import SchemaCatalogSnapshot
+from pagination import split_table_name
+from result_stream import json_default
+from table_counts import estimate_all_row_counts
+
+logger = logging.getLogger(__name__)
+
+# 后台刷新间隔（秒），0 表示关闭后台刷新
+SCHEMA_REFRESH_INTERVAL = float(os.environ.get('CHAT2DB_SCHEMA_REFRESH_INTERVAL', '300'))
+# 内存中的缓存多久与应用数据库中的快照核对一次版本（秒）；其他 worker 的刷新最多延迟这么久可见
+SCHEMA_CATALOG_TTL = float(os.environ.get('CHAT2DB_SCHEMA_CATALOG_TTL', '5'))
+
+
+def _digest(value):
+    raw = json.dumps(value, sort_keys=True, default=json_default)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def table_list_query(connection):
+    if connection.type == 'sqlite':
+        return "SELECT name FROM sqlite_master WHERE type='table';"
+    elif connection.type == 'mysql':
+        return f"SELECT table_name as name FROM information_schema.tables WHERE table_schema = '{connection.database}';"
+    elif connection.type == 'postgresql':
+        # 查询所有有权限访问的模式中的表，排除系统模式
+        return """
+            SELECT CONCAT(schemaname, '.', tablename) as name
+            FROM pg_tables
+            WHERE schemaname NOT IN ('information_schema', 'pg_catalog', 'pg_toast')
+            AND schemaname NOT LIKE 'pg_temp_%'
+            AND schemaname NOT LIKE 'pg_toast_temp_%'
+            ORDER BY schemaname, tablename
+            """
+    raise ValueError(f'Unsupported database type: {connection.type}')
+
+
+def table_columns_query(connection, table_name):
+    if connection.type == 'sqlite':
+        return f"PRAGMA table_info({table_name});"
+    elif connection.type == 'mysql':
+        return f"DESCRIBE {table_name};"
+    elif connection.type == 'postgresql':
+        # 处理包含模式名的表名 (schema.table)
+        if '.' in table_name:
+            schema_name, table_name_only = table_name.split('.', 1)
+            return f"SELECT column_name, data_type FROM information_schema.columns WHERE table_name = '{table_name_only}' AND table_schema = '{schema_name}';"
+        # 如果只有表名，在所有模式中查找
+        return f"SELECT column_name, data_type FROM information_schema.columns WHERE table_name = '{table_name}' AND table_schema NOT IN ('information_schema', 'pg_catalog', 'pg_toast');"
+    raise ValueError(f'Unsupported database type: {connection.type}')
+
+
+def _fetch_dicts(engine, query):
+    with engine.connect() as conn:
+        return [dict(row) for row in conn.execute(text(query)).mappings()]
+
+
+def _type_name(column_type):
+    try:
+        return str(column_type)
+    except Exception:
+        return type(column_type).__name__
+
+
+def load_table_details(engine, db_type, tables):
+    """
+    通过 SQLAlchemy Inspector 读取列、主键、索引与注释
+
+    SQLAlchemy 2.0 的 get_multi_* 接口按模式批量读取，避免逐表查询；
+    旧版本回退为逐表读取。
+    """
+    insp = inspect(engine)
+    by_schema = {}
+    for name in tables:
+        schema, table = split_table_name(name, db_type)
+        by_schema.setdefault(schema, []).append((name, table))
+
+    details = {}
+    for schema, names in by_schema.items():
+        if hasattr(insp, 'get_multi_columns'):
+            columns = insp.get_multi_columns(schema=schema)
+            pks = insp.get_multi_pk_constraint(schema=schema)
+            indexes = insp.get_multi_indexes(schema=schema)
+            try:
+                comments = insp.get_multi_table_comment(schema=schema)
+            except NotImplementedError:
+                comments = {}
+            lookup = lambda mapping, table, default: mapping.get((schema, table), default)
+        else:
+            columns, pks, indexes, comments = {}, {}, {}, {}
+            for _, table in names:
+                columns[table] = insp.get_columns(table, schema=schema)
+                pks[table] = insp.get_pk_constraint(table, schema=schema)
+                indexes[table] = insp.get_indexes(table, schema=schema)
+                try:
+                    comments[table] = insp.get_table_comment(table, schema=schema)
+                except NotImplementedError:
+                    comments[table] = {}
+            lookup = lambda mapping, table, default: mapping.get(table, default)
+
+        for name, table in names:
+            details[name] = {
+                'columns': [
+                    {
+                        'name': col['name'],
+                        'type': _type_name(col.get('type')),
+                        'nullable': bool(col.get('nullable', True)),
+                        'comment': col.get('comment'),
+                    }
+                    for col in lookup(columns, table, [])
+                ],
+                'primary_key': list((lookup(pks, table, {}) or {}).get('constrained_columns') or []),
+                'indexes': [
+                    {'name': idx.get('name'), 'columns': list(idx.get('column_names') or []), 'unique': bool(idx.get('unique'))}
+                    for idx in lookup(indexes, table, [])
+                ],
+                'comment': (lookup(comments, table, {}) or {}).get('text'),
+            }
+    return details
+
+
+class SchemaCatalog:
+    """
+    目标数据库的模式元数据缓存
+
+    每个连接缓存表列表、各表列信息（兼容原接口的原始格式）以及规范化的
+    列/主键/索引/行数估算，持久化到应用 SQLite 数据库的 schema_catalogs 表，
+    各 worker 在内存中保留一份，每 ttl 秒与快照的版本核对一次，其他 worker
+    的刷新与清除由此生效。后台刷新按连接在快照上抢占，每个间隔只由一个 worker
+    读取目标数据库；也可以手动触发刷新。每份数据都带有 ETag。
+    """
+
+    def __init__(self, session_factory, refresh_interval=SCHEMA_REFRESH_INTERVAL, ttl=SCHEMA_CATALOG_TTL):
+        self.Session = session_factory
+        self.refresh_interval = refresh_interval
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        # conn_id -> entry dict
+        self._entries = {}
+        # conn_id -> 上次与快照核对的时间（monotonic）
+        self._checked = {}
+        self._thread = None
+        self._stop = threading.Event()
+
+    # ---- cached reads (never touch the target database) ----
+
+    def cached(self, conn_id):
+        """Return the cached entry for a connection from memory or the app DB"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(conn_id)
+            checked = self._checked.get(conn_id)
+        if entry is not None and checked is not None and now - checked < self.ttl:
+            return entry
+
+        session = self.Session()
+        try:
+            if entry is not None:
+                # 只读版本列；快照未变化时继续使用内存中的数据
+                version = session.query(SchemaCatalogSnapshot.version).filter_by(connection_id=conn_id).scalar()
+                if version is not None and version == entry.get('version'):
+                    with self._lock:
+                        self._checked[conn_id] = now
+                    return entry
+            snapshot = session.query(SchemaCatalogSnapshot).filter_by(connection_id=conn_id).first()
+            entry = json.loads(snapshot.payload) if snapshot and snapshot.payload else None
+        finally:
+            session.close()
+
+        with self._lock:
+            if entry is None:
+                # 快照已被其他 worker 清除
+                self._entries.pop(conn_id, None)
+                self._checked.pop(conn_id, None)
+                return None
+            self._entries[conn_id] = entry
+            self._checked[conn_id] = now
+        return entry
+
+    # ---- reads that load on miss ----
+
+    def get_tables(self, connection, engine):
+        """Return (tables, etag)"""
+        entry = self.cached(connection.id)
+        if entry is None or entry.get('tables') is None:
+            entry = self._load_tables(connection, engine)
+        return entry['tables'], entry['tables_etag']
+
+    def get_table_columns(self, connection, engine, table_name):
+        """Return (columns, etag) in the dialect's native shape"""
+        entry = self.cached(connection.id)
+        if entry is None or table_name not in entry.get('columns', {}):
+            entry = self._load_columns(connection, engine, table_name)
+        return entry['columns'][table_name], entry['columns_etag'][table_name]
+
+    def get_catalog(self, connection, engine):
+        """Return the full normalized catalog, loading table details if needed"""
+        entry = self.cached(connection.id)
+        if entry is None or entry.get('details') is None:
+            entry = self.refresh(connection, engine, full=True)
+        return entry
+
+    # ---- loading ----
+
+    def _new_entry(self, connection):
+        return {
+            'connection_id': connection.id,
+            'db_type': connection.type,
+            'tables': None,
+            'tables_etag': None,
+            'columns': {},
+            'columns_etag': {},
+            'details': None,
+            'version': None,
+            'refreshed_at': None,
+        }
+
+    def _store(self, entry):
+        entry['version'] = _digest([entry['tables'], entry['columns'], entry['details']])
+        entry['refreshed_at'] = time.time()
+        with self._lock:
+            self._entries[entry['connection_id']] = entry
+            self._checked[entry['connection_id']] = time.monotonic()
+
+        session = self.Session()
+        try:
+            snapshot = session.query(SchemaCatalogSnapshot).filter_by(connection_id=entry['connection_id']).first()
+            if not snapshot:
+                snapshot = SchemaCatalogSnapshot(connection_id=entry['connection_id'])
+                session.add(snapshot)
+            snapshot.version = entry['version']
+            snapshot.payload = json.dumps(entry, default=json_default)
+            snapshot.refreshed_at = datetime.utcnow()
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.warning(f"Failed to persist schema catalog for {entry['connection_id']}: {e}")
+        finally:
+            session.close()
+        return entry
+
+    def _copy_entry(self, connection):
+        entry = self.cached(connection.id)
+        if entry is None:
+            return self._new_entry(connection)
+        entry = dict(entry)
+        entry['columns'] = dict(entry.get('columns') or {})
+        entry['columns_etag'] = dict(entry.get('columns_etag') or {})
+        return entry
+
+    def _load_tables(self, connection, engine):
+        tables = [row['name'] for row in _fetch_dicts(engine, table_list_query(connection))]
+        entry = self._copy_entry(connection)
+        entry['tables'] = tables
+        entry['tables_etag'] = _digest(tables)
+        return self._store(entry)
+
+    def _load_columns(self, connection, engine, table_name):
+        columns = _fetch_dicts(engine, table_columns_query(connection, table_name))
+        entry = self._copy_entry(connection)
+        entry['columns'][table_name] = columns
+        entry['columns_etag'][table_name] = _digest(columns)
+        return self._store(entry)
+
+    def refresh(self, connection, engine, full=None):
+        """
+        重新读取连接的模式元数据
+
+        full 为 None 时，仅在已经加载过完整元数据的情况下刷新表详情。
+        已缓存过的表列信息会一并刷新，未变化的部分 ETag 保持不变。
+        """
+        previous = self.cached(connection.id)
+        if full is None:
+            full = bool(previous and previous.get('details') is not None)
+
+        entry = self._new_entry(connection)
+        entry['tables'] = [row['name'] for row in _fetch_dicts(engine, table_list_query(connection))]
+        entry['tables_etag'] = _digest(entry['tables'])
+
+        existing = set(entry['tables'])
+        for table_name in (previous or {}).get('columns', {}):
+            if table_name not in existing:
+                continue
+            columns = _fetch_dicts(engine, table_columns_query(connection, table_name))
+            entry['columns'][table_name] = columns
+            entry['columns_etag'][table_name] = _digest(columns)
+
+        if full:
+            details = load_table_details(engine, connection.type, entry['tables'])
+            estimates = estimate_all_row_counts(engine, connection.type)
+            for name, info in details.items():
+                info['row_estimate'] = estimates.get(name)
+            entry['details'] = details
+
+        return self._store(entry)
+
+    def invalidate(self, conn_id):
+        with self._lock:
+            self._entries.pop(conn_id, None)
+            self._checked.pop(conn_id, None)
+        session = self.Session()
+        try:
+            session.query(SchemaCatalogSnapshot).filter_by(connection_id=conn_id).delete()
+            session.commit()
+        except Exception:
+            session.rollback()
+        finally:
+            session.close()
+
+    # ---- background refresh ----
+
+    def start_background_refresh(self, resolve):
+        """
+        启动后台刷新线程
+
+        resolve(conn_id) 返回 (connection, engine)，连接已不存在时返回 None。
+        只刷新应用数据库中已有快照的连接；每个 worker 都运行该线程，
+        但同一个连接在一个间隔内只由抢占到快照的 worker 刷新，其余 worker
+        通过 cached() 读取新的快照。
+        """
+        if self.refresh_interval <= 0 or (self._thread and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._refresh_loop, args=(resolve,), name='chat2db-schema-refresh', daemon=True
+        )
+        self._thread.start()
+
+    def stop_background_refresh(self):
+        self._stop.set()
+
+    def _claim_refresh(self, conn_id):
+        """Mark the snapshot as being refreshed; False when another worker refreshed it within the interval"""
+        now = datetime.utcnow()
+        session = self.Session()
+        try:
+            # 条件更新是原子的：多个 worker 同时抢占时只有一个更新成功
+            claimed = session.query(SchemaCatalogSnapshot).filter(
+                SchemaCatalogSnapshot.connection_id == conn_id,
+                SchemaCatalogSnapshot.refreshed_at < now - timedelta(seconds=self.refresh_interval)
+            ).update({'refreshed_at': now}, synchronize_session=False)
+            session.commit()
+            return claimed == 1
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def _refresh_loop(self, resolve):
+        while not self._stop.wait(self.refresh_interval):
+            session = self.Session()
+            try:
+                conn_ids = [conn_id for (conn_id,) in session.query(SchemaCatalogSnapshot.connection_id)]
+            except Exception as e:
+                logger.warning(f"Failed to list schema snapshots: {e}")
+                continue
+            finally:
+                session.close()
+            for conn_id in conn_ids:
+                try:
+                    if not self._claim_refresh(conn_id):
+                        continue
+                    resolved = resolve(conn_id)
+                    if resolved is None:
+                        self.invalidate(conn_id)
+                        continue
+                    self.refresh(*resolved)
+                except Exception as e:
+                    logger.warning(f"Background schema refresh failed for {conn_id}: {e}")
+
+
+# Create global schema catalog instance
+schema_catalog = None
+
+def init_schema_catalog(session_factory):
+    global schema_catalog
+    schema_catalog = SchemaCatalog(session_factory)
+    return schema_catalog
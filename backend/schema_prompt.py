@@ -0,0 +1,208 @@
+"""
+对话提示词中的数据库模式上下文
+
+根据模式缓存（schema_catalog）为每张表编译一行紧凑的定义，按连接与模式版本
+缓存；对话时用 SchemaIndex 按问题的语义相似度排序表和列，只把排名靠前、
+在 token 预算内的表放进提示词，不会把整个模式塞给模型。
+
+对话请求只使用已缓存的模式与索引：缓存为空时在后台线程中加载（warm），
+本轮对话不带模式上下文，请求不会等待目标数据库或表/列的向量编码。
+复用 Ollama context 时，context 中已有的表不再重复发送。
+"""
+import logging
+import os
+import re
+import threading
+from chat_prompt import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# 模式上下文的 token 上限，计入对话提示词的总预算
+SCHEMA_PROMPT_BUDGET = int(os.environ.get('CHAT2DB_SCHEMA_PROMPT_BUDGET', '768'))
+# 最多放入提示词的表数
+SCHEMA_PROMPT_TOP_K = int(os.environ.get('CHAT2DB_SCHEMA_PROMPT_TOP_K', '8'))
+# 列数超过该值的表只列出主键与最相关的列
+SCHEMA_PROMPT_MAX_COLUMNS = int(os.environ.get('CHAT2DB_SCHEMA_PROMPT_MAX_COLUMNS', '12'))
+
+SCHEMA_HEADER = "Database schema ({db_type}), most relevant tables for the question:"
+_WORD = re.compile(r'[\w.]+')
+
+
+def format_column(column, primary_key):
+    part = f"{column['name']} {column.get('type') or ''}".rstrip()
+    if column['name'] in primary_key:
+        part += ' PK'
+    elif column.get('nullable') is False:
+        part += ' NOT NULL'
+    if column.get('comment'):
+        part += f" \"{column['comment']}\""
+    return part
+
+
+class TableFragment:
+    """Compiled prompt text of one table; wide tables can be rendered with a subset of columns"""
+
+    def __init__(self, name, info):
+        self.name = name
+        info = info or {}
+        primary_key = info.get('primary_key') or []
+        self.column_names = [c['name'] for c in info.get('columns') or []]
+        self.column_parts = [format_column(c, primary_key) for c in info.get('columns') or []]
+        self.primary_key = [i for i, c in enumerate(self.column_names) if c in primary_key]
+        suffix = []
+        if info.get('comment'):
+            suffix.append(info['comment'])
+        if info.get('row_estimate') is not None:
+            suffix.append(f"~{info['row_estimate']} rows")
+        self.suffix = f" -- {'; '.join(suffix)}" if suffix else ''
+        self.full = self.render(range(len(self.column_parts)))
+
+    def render(self, indexes, omitted=0):
+        columns = ', '.join(self.column_parts[i] for i in indexes)
+        if omitted:
+            columns += f", ... {omitted} more columns"
+        return f"{self.name}({columns}){self.suffix}"
+
+    @property
+    def wide(self):
+        return len(self.column_parts) > SCHEMA_PROMPT_MAX_COLUMNS
+
+    def reduced(self, ranked_columns):
+        """Primary key plus the best-ranked columns, in table order"""
+        keep = list(self.primary_key)
+        for name in ranked_columns:
+            if len(keep) >= SCHEMA_PROMPT_MAX_COLUMNS:
+                break
+            if name in self.column_names:
+                i = self.column_names.index(name)
+                if i not in keep:
+                    keep.append(i)
+        keep.sort()
+        return self.render(keep, omitted=len(self.column_parts) - len(keep))
+
+
+class SchemaContext:
+    def __init__(self, header, lines, tables, version):
+        self.header = header
+        self.lines = lines
+        self.text = "\n".join([header] + lines)
+        self.tables = tables
+        self.version = version
+        self.tokens = estimate_tokens(self.text)
+
+    def without(self, tables):
+        """Text for the tables not already in a reused context; None when there is nothing new"""
+        lines = [line for name, line in zip(self.tables, self.lines) if name not in tables]
+        return "\n".join([self.header] + lines) if lines else None
+
+    def stats(self):
+        return {'version': self.version, 'tables': self.tables, 'tokens': self.tokens}
+
+
+def context_schema_tables(schema, reused, previous=()):
+    """Tables whose schema is in the context returned for this turn"""
+    tables = list(previous or []) if reused else []
+    if schema is not None:
+        tables += [name for name in schema.tables if name not in tables]
+    return tables
+
+
+class SchemaPromptCache:
+    """Compiled table fragments per connection, rebuilt when the catalog version changes"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # conn_id -> (version, {table_name: TableFragment})
+        self._fragments = {}
+        # 正在后台加载模式与索引的连接
+        self._warming = set()
+
+    def fragments(self, conn_id, catalog):
+        version = catalog.get('version')
+        with self._lock:
+            cached = self._fragments.get(conn_id)
+            if cached is None or cached[0] != version:
+                cached = self._fragments[conn_id] = (version, {})
+            return cached[1]
+
+    def fragment(self, fragments, name, details):
+        # 按需编译，只有被选中过的表才会占用内存
+        fragment = fragments.get(name)
+        if fragment is None:
+            fragment = fragments.setdefault(name, TableFragment(name, details.get(name)))
+        return fragment
+
+    def invalidate(self, conn_id):
+        with self._lock:
+            self._fragments.pop(conn_id, None)
+
+    def warm(self, conn_id, load):
+        """Run load() in a background thread unless it is already running for the connection"""
+        with self._lock:
+            if conn_id in self._warming:
+                return False
+            self._warming.add(conn_id)
+
+        def run():
+            try:
+                load()
+            except Exception as e:
+                logger.warning("Schema context warm-up failed", extra={'connection': conn_id, 'error': str(e)})
+            finally:
+                with self._lock:
+                    self._warming.discard(conn_id)
+
+        threading.Thread(target=run, name=f'schema-prompt-warm-{conn_id}', daemon=True).start()
+        return True
+
+    def build(self, conn_id, catalog, schema_index, question, budget=SCHEMA_PROMPT_BUDGET, k=SCHEMA_PROMPT_TOP_K):
+        """Schema context for a question: top-k tables by similarity that fit in the token budget"""
+        details = catalog.get('details') or {}
+        if not details or budget <= 0:
+            return None
+        fragments = self.fragments(conn_id, catalog)
+
+        query = None
+
+        def query_vector():
+            # 表与列的检索共用一次编码
+            nonlocal query
+            if query is None:
+                query = schema_index.embeddings_model.encode(question)
+            return query
+
+        # 问题中直接提到的表排在最前面，其余按语义相似度排序
+        ranked = []
+        for word in _WORD.findall(question):
+            name = schema_index.lookup_table(word)
+            if name and name not in ranked:
+                ranked.append(name)
+        if len(ranked) < k:
+            for name, _ in schema_index.search_tables(query_vector(), k):
+                if name not in ranked:
+                    ranked.append(name)
+
+        header = SCHEMA_HEADER.format(db_type=catalog.get('db_type') or 'sql')
+        remaining = budget - estimate_tokens(header)
+        lines, tables = [], []
+        for name in ranked[:k]:
+            if name not in details:
+                continue
+            fragment = self.fragment(fragments, name, details)
+            line = fragment.full
+            if fragment.wide:
+                columns = schema_index.search_columns(query_vector(), name, SCHEMA_PROMPT_MAX_COLUMNS)
+                line = fragment.reduced([c for _, c, _ in columns])
+            cost = estimate_tokens(line)
+            if cost > remaining:
+                continue
+            lines.append(line)
+            tables.append(name)
+            remaining -= cost
+        if not lines:
+            return None
+        return SchemaContext(header, lines, tables, catalog.get('version'))
+
+
+# Create global schema prompt cache
+schema_prompts = SchemaPromptCache()
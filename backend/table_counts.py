@@ -0,0 +1,234 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from sqlalchemy import text
+from pagination import qualified_table_name, split_table_name
+from query_control import QueryCancelled, query_registry
+
+# 精确计数缓存时间（秒）、自动模式下等待精确计数的时间（秒）以及缓存条目上限
+COUNT_CACHE_TTL = float(os.environ.get('CHAT2DB_COUNT_CACHE_TTL', '60'))
+COUNT_EXACT_TIMEOUT = float(os.environ.get('CHAT2DB_COUNT_TIMEOUT', '2'))
+COUNT_CACHE_SIZE = int(os.environ.get('CHAT2DB_COUNT_CACHE_SIZE', '1024'))
+COUNT_WORKERS = int(os.environ.get('CHAT2DB_COUNT_WORKERS', '4'))
+
+COUNT_STRATEGIES = ('auto', 'exact', 'estimate')
+
+
+def estimate_row_count(engine, db_type, table_name):
+    """
+    从系统目录读取表的估算行数，失败或没有统计信息时返回 None
+
+    - PostgreSQL: pg_class.reltuples
+    - MySQL: information_schema.TABLES.TABLE_ROWS
+    - SQLite: sqlite_stat1（需要执行过 ANALYZE）
+    """
+    schema, table = split_table_name(table_name, db_type)
+    if db_type == 'postgresql':
+        query = (
+            "SELECT c.reltuples::bigint AS estimate FROM pg_class c "
+            "JOIN pg_namespace n ON n.oid = c.relnamespace "
+            "WHERE n.nspname = :schema AND c.relname = :table"
+        )
+        params = {'schema': schema, 'table': table}
+    elif db_type == 'mysql':
+        if schema:
+            query = "SELECT TABLE_ROWS AS estimate FROM information_schema.TABLES WHERE TABLE_SCHEMA = :schema AND TABLE_NAME = :table"
+            params = {'schema': schema, 'table': table}
+        else:
+            query = "SELECT TABLE_ROWS AS estimate FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table"
+            params = {'table': table}
+    elif db_type == 'sqlite':
+        query = "SELECT stat FROM sqlite_stat1 WHERE tbl = :table"
+        params = {'table': table}
+    else:
+        return None
+
+    try:
+        with engine.connect() as conn:
+            rows = conn.execute(text(query), params).fetchall()
+    except Exception:
+        return None
+    if not rows:
+        return None
+
+    if db_type == 'sqlite':
+        # stat 列的第一个整数是表（或索引）的行数
+        counts = [int(str(r[0]).split()[0]) for r in rows if r[0]]
+        return max(counts) if counts else None
+
+    value = rows[0][0]
+    # 从未 ANALYZE 过的表，PostgreSQL 14+ 返回 -1
+    if value is None or value < 0:
+        return None
+    return int(value)
+
+
+def estimate_all_row_counts(engine, db_type):
+    """Catalog row estimates for every table in one query: {table_name: estimate}"""
+    if db_type == 'postgresql':
+        query = (
+            "SELECT CONCAT(n.nspname, '.', c.relname) AS name, c.reltuples::bigint AS estimate "
+            "FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+            "WHERE c.relkind IN ('r', 'p') AND n.nspname NOT IN ('information_schema', 'pg_catalog', 'pg_toast')"
+        )
+    elif db_type == 'mysql':
+        query = "SELECT TABLE_NAME AS name, TABLE_ROWS AS estimate FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE()"
+    elif db_type == 'sqlite':
+        query = "SELECT tbl AS name, stat AS estimate FROM sqlite_stat1"
+    else:
+        return {}
+
+    try:
+        with engine.connect() as conn:
+            rows = conn.execute(text(query)).fetchall()
+    except Exception:
+        return {}
+
+    estimates = {}
+    for name, value in rows:
+        if value is None:
+            continue
+        if db_type == 'sqlite':
+            value = int(str(value).split()[0])
+            estimates[name] = max(value, estimates.get(name, 0))
+        elif value >= 0:
+            estimates[name] = int(value)
+    return estimates
+
+
+class CountJob:
+    """Handle for a count started alongside a page query"""
+
+    def __init__(self, counter, key, engine, db_type, table_name, count_sql, params, strategy='auto', cached=None, timeout=0,
+                 filtered=False):
+        self._counter = counter
+        self._key = key
+        self._engine = engine
+        self._db_type = db_type
+        self._table_name = table_name
+        self._count_sql = count_sql
+        self._params = params
+        self._strategy = strategy
+        self._cached = cached
+        self._timeout = timeout
+        # 带过滤条件的计数不能用整表的估算值代替
+        self._filtered = filtered
+        self._future = None
+        if cached is None and strategy != 'estimate':
+            self._future = self._submit()
+
+    def _submit(self):
+        return self._counter._submit_exact(self._key, self._engine, self._db_type, self._count_sql, self._params, self._timeout)
+
+    def result(self):
+        """Return (count, exact); count is None when a filtered count is not available yet"""
+        if self._cached is not None:
+            return self._cached, True
+
+        if self._strategy == 'exact':
+            return self._future.result(), True
+
+        if self._strategy == 'auto':
+            try:
+                return self._future.result(timeout=COUNT_EXACT_TIMEOUT), True
+            except FutureTimeoutError:
+                # 精确计数仍在后台执行，完成后会写入缓存供后续请求使用
+                pass
+            except QueryCancelled:
+                # 精确计数超过了语句超时，改用估算值
+                pass
+
+        if self._filtered:
+            # 系统目录只有整表的估算值，过滤后的结果可能只有几行
+            return None, False
+
+        estimate = estimate_row_count(self._engine, self._db_type, self._table_name)
+        if estimate is not None:
+            return estimate, False
+
+        # 没有可用的估算值，只能等待精确计数
+        future = self._future or self._submit()
+        return future.result(), True
+
+
+class TableCounter:
+    """
+    表记录总数的缓存与估算
+
+    精确计数按 (连接, 表, 过滤条件) 缓存 TTL 秒，并在线程池中与分页查询并发执行；
+    精确计数过慢或调用方要求估算时，返回系统目录中的估算值；带过滤条件时没有
+    可用的估算值，返回 None。
+    """
+
+    def __init__(self, ttl=COUNT_CACHE_TTL, max_entries=COUNT_CACHE_SIZE, max_workers=COUNT_WORKERS):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # key -> (count, expires_at)
+        self._cache = OrderedDict()
+        # key -> Future，避免同一计数被并发重复执行
+        self._inflight = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='chat2db-count')
+
+    def start(self, engine, conn_id, db_type, table_name, conditions=None, params=None, strategy='auto', timeout=0):
+        """Start counting rows matching the page query's filter; returns a CountJob
+
+        timeout is the statement timeout in seconds for the exact count (0 = none).
+        """
+        conditions = conditions or []
+        params = params or {}
+        count_sql = f"SELECT COUNT(*) AS count FROM {qualified_table_name(table_name, db_type)}"
+        if conditions:
+            count_sql += " WHERE " + " AND ".join(conditions)
+        key = (conn_id, table_name, count_sql, tuple(sorted(params.items())))
+
+        cached = self._get_cached(key)
+        return CountJob(self, key, engine, db_type, table_name, count_sql, params, strategy=strategy, cached=cached, timeout=timeout,
+                        filtered=bool(conditions))
+
+    def _get_cached(self, key):
+        with self._lock:
+            entry = self._cache.get(key)
+            if not entry:
+                return None
+            count, expires_at = entry
+            if expires_at < time.time():
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            return count
+
+    def _submit_exact(self, key, engine, db_type, count_sql, params, timeout=0):
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                return future
+            future = self._executor.submit(self._run_exact, key, engine, db_type, count_sql, params, timeout)
+            self._inflight[key] = future
+            return future
+
+    def _run_exact(self, key, engine, db_type, count_sql, params, timeout=0):
+        try:
+            # 登记到查询注册表，计数同样受语句超时限制并可以被取消
+            with query_registry.run(engine, key[0], db_type, count_sql, timeout) as (conn, _):
+                count = int(conn.execute(text(count_sql), params).scalar() or 0)
+            with self._lock:
+                self._cache[key] = (count, time.time() + self.ttl)
+                self._cache.move_to_end(key)
+                while len(self._cache) > self.max_entries:
+                    self._cache.popitem(last=False)
+            return count
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def invalidate(self, conn_id, table_name=None):
+        with self._lock:
+            for key in [k for k in self._cache if k[0] == conn_id and (table_name is None or k[1] == table_name)]:
+                del self._cache[key]
+
+
+# Create global table counter instance
+table_counter = TableCounter()
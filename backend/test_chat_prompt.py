@@ -0,0 +1,79 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from chat_prompt import (
+    SUMMARY_HEADER, build_chat_prompt, estimate_tokens, normalize_history, summarize_turn, valid_context,
+)
+
+
+def history(turns):
+    return [{'role': 'user' if i % 2 == 0 else 'assistant', 'text': f'turn {i} ' + 'word ' * 40} for i in range(turns)]
+
+
+def test_estimate_tokens():
+    assert estimate_tokens('') == 0
+    assert estimate_tokens('abcd') == 1
+    assert estimate_tokens('abcde') == 2
+    # 中文按每字一个 token
+    assert estimate_tokens('查询用户') == 4
+
+
+def test_short_history_is_kept_verbatim():
+    plan = build_chat_prompt('next?', history(4), budget=4000, recent_turns=6)
+    assert plan.kept == 4 and plan.summarized == 0 and plan.dropped == 0
+    assert SUMMARY_HEADER not in plan.prompt
+    assert plan.prompt.endswith('user: next?\nassistant:')
+    assert plan.context is None
+
+
+def test_older_turns_are_summarized():
+    plan = build_chat_prompt('next?', history(10), budget=4000, recent_turns=4)
+    assert plan.kept == 4 and plan.summarized == 6 and plan.dropped == 0
+    assert SUMMARY_HEADER in plan.prompt
+
+
+def test_prompt_stays_within_budget():
+    for budget in (300, 500, 800):
+        plan = build_chat_prompt('next?', history(30), budget=budget, recent_turns=6)
+        assert plan.tokens <= budget
+        assert plan.kept + plan.summarized + plan.dropped == 30
+    assert build_chat_prompt('next?', history(30), budget=300, recent_turns=6).dropped > 0
+
+
+def test_context_is_reused_when_it_fits():
+    context = list(range(100))
+    plan = build_chat_prompt('next?', history(6), context=context, budget=1000)
+    assert plan.context == context
+    assert plan.prompt == 'user: next?\nassistant:'
+    assert plan.stats()['contextReused'] and plan.stats()['contextTokens'] == 100
+
+
+def test_oversized_or_invalid_context_rebuilds_the_prompt():
+    plan = build_chat_prompt('next?', history(2), context=list(range(2000)), budget=1000)
+    assert plan.context is None and plan.kept == 2
+    assert build_chat_prompt('next?', [], context=['a', 1], budget=1000).context is None
+    assert not valid_context([1, True])
+    assert valid_context([1, 2])
+
+
+def test_schema_placement():
+    schema = 'Tables:\norders(id, amount)'
+    assert schema in build_chat_prompt('q', schema=schema).prompt
+    # 复用 context 时模式已在 context 中，只发送新增的表
+    reused = build_chat_prompt('q', context=[1, 2], schema=schema, context_schema='customers(id, name)')
+    assert reused.prompt == 'customers(id, name)\nuser: q\nassistant:'
+    assert build_chat_prompt('q', context=[1, 2], schema=schema).prompt == 'user: q\nassistant:'
+
+
+def test_normalize_history_drops_the_current_question():
+    turns = normalize_history('q2', [
+        {'role': 'user', 'text': 'q1'}, {'role': 'assistant', 'content': 'a1'}, 'junk', {'role': 'user', 'text': 'q2'},
+    ])
+    assert turns == [('user', 'q1'), ('assistant', 'a1')]
+
+
+def test_summarize_turn_keeps_the_answer():
+    reply = '[THINKING_PROCESS]long reasoning[/THINKING_PROCESS][RESPONSE_CONTENT]Use an index. Then...[/RESPONSE_CONTENT]'
+    assert summarize_turn('assistant', reply) == '- assistant: Use an index.'
+    assert summarize_turn('user', 'x' * 500).endswith('...')
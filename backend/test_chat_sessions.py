@@ -0,0 +1,104 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import threading
+
+import pytest
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import sessionmaker
+
+from chat_sessions import ChatSessionStore
+from models import create_tables
+
+
+@pytest.fixture
+def Session(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'app.sqlite'}", connect_args={'timeout': 30})
+    create_tables(engine)
+    return sessionmaker(bind=engine)
+
+
+def test_record_turn_writes_through(Session):
+    store = ChatSessionStore(Session)
+    state = store.create('u1', model='m1')
+    store.record_turn(state, 'q1', 'a1', [1, 2, 3], 'm1', context_tables=['orders'])
+    assert state.revision == 1
+    assert state.title == 'q1'
+
+    # 另一个 worker 从数据库读取到同样的内容
+    loaded = ChatSessionStore(Session).get(state.id, 'u1')
+    assert [t['text'] for t in loaded.turns] == ['q1', 'a1']
+    assert loaded.context_for('m1') == [1, 2, 3]
+    assert loaded.context_for('m2') is None
+    assert loaded.context_tables_for('m1') == ['orders']
+    assert ChatSessionStore(Session).get(state.id, 'someone else') is None
+
+
+def test_stale_copy_is_reloaded(Session):
+    worker_a, worker_b = ChatSessionStore(Session), ChatSessionStore(Session)
+    state = worker_a.create('u1')
+    assert worker_b.get(state.id, 'u1').revision == 0
+    worker_a.record_turn(worker_a.get(state.id, 'u1'), 'q1', 'a1')
+    assert worker_b.get(state.id, 'u1').revision == 1
+    assert worker_b.stats()['loads'] == 2
+
+
+def test_turn_from_another_worker_is_not_overwritten(Session):
+    worker_a, worker_b = ChatSessionStore(Session), ChatSessionStore(Session)
+    state = worker_a.create('u1')
+    copy_a = worker_a.get(state.id, 'u1')
+    copy_b = worker_b.get(state.id, 'u1')
+
+    worker_b.record_turn(copy_b, 'qb', 'ab', [9], 'm1')
+    # worker_a 的提示词基于 revision 0 构造，返回的 context 不包含 worker_b 的轮次
+    worker_a.record_turn(copy_a, 'qa', 'aa', [1, 2], 'm1', revision=0)
+
+    loaded = ChatSessionStore(Session).get(state.id, 'u1')
+    assert [t['text'] for t in loaded.turns] == ['qb', 'ab', 'qa', 'aa']
+    assert loaded.revision == 2
+    assert loaded.context is None
+
+
+def test_concurrent_turns_are_all_kept(Session):
+    stores = [ChatSessionStore(Session) for _ in range(2)]
+    state = stores[0].create('u1')
+    errors = []
+
+    def worker(store, n):
+        try:
+            for i in range(5):
+                store.record_turn(store.get(state.id, 'u1'), f'q{n}-{i}', f'a{n}-{i}')
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(stores[n % 2], n)) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors
+    loaded = ChatSessionStore(Session).get(state.id, 'u1')
+    assert len(loaded.turns) == 40
+    assert loaded.revision == 20
+
+
+def test_record_turn_gives_up_after_repeated_conflicts(Session):
+    store = ChatSessionStore(Session)
+    state = store.create('u1')
+    engine = Session.kw['bind']
+
+    # 每次 UPDATE 之前都有另一个 worker 抢先写入
+    @event.listens_for(engine, 'before_cursor_execute')
+    def bump_revision(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith('UPDATE chat_sessions'):
+            cursor.execute("UPDATE chat_sessions SET revision = revision + 1 WHERE id = ?", (state.id,))
+
+    with pytest.raises(RuntimeError):
+        store.record_turn(state, 'q', 'a')
+    event.remove(engine, 'before_cursor_execute', bump_revision)
+
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT turns FROM chat_sessions WHERE id = :id"), {'id': state.id}).scalar() == '[]'
+    # 内存中的副本已丢弃，下次从数据库重新加载
+    assert store.stats()['active'] == 0
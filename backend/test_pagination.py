@@ -0,0 +1,129 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import pytest
+from sqlalchemy import create_engine, text
+
+from pagination import (
+    KeyColumnCache, TableKeys, build_order_clause, build_seek_clause, can_seek, catalog_table_keys,
+    choose_pagination_mode, decode_cursor, encode_cursor, seek_columns,
+)
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'target.sqlite'}")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE items (id INTEGER PRIMARY KEY, score INTEGER NOT NULL, note TEXT)"))
+        conn.execute(text("INSERT INTO items VALUES (:id, :score, :note)"), [
+            {'id': i, 'score': i % 4, 'note': None if i % 3 == 0 else f'n{i}'} for i in range(1, 21)
+        ])
+    return engine
+
+
+def fetch_keyset(engine, columns, sort_order, page_size):
+    """Walk every page forward the way the table data endpoint does"""
+    rows, cursor = [], None
+    while True:
+        where, params = '', {}
+        if cursor is not None:
+            clause, params = build_seek_clause(columns, decode_cursor(cursor, columns, sort_order), sort_order, 'next')
+            where = f" WHERE {clause}"
+        sql = f"SELECT * FROM items{where} ORDER BY {build_order_clause(columns, sort_order)} LIMIT {page_size}"
+        with engine.connect() as conn:
+            page = [dict(row) for row in conn.execute(text(sql), params).mappings()]
+        if not page:
+            return rows
+        rows.extend(page)
+        cursor = encode_cursor(columns, [page[-1][c] for c in columns], sort_order)
+
+
+def test_cursor_round_trip():
+    token = encode_cursor(['score', 'id'], [3, 17], 'desc')
+    assert '=' not in token
+    assert decode_cursor(token, ['score', 'id'], 'desc') == [3, 17]
+
+
+@pytest.mark.parametrize('columns, order', [(['id'], 'desc'), (['score', 'id'], 'asc'), (['score'], 'desc')])
+def test_cursor_rejects_other_ordering(columns, order):
+    token = encode_cursor(['score', 'id'], [3, 17], 'desc')
+    with pytest.raises(ValueError):
+        decode_cursor(token, columns, order)
+
+
+def test_cursor_rejects_garbage():
+    with pytest.raises(ValueError):
+        decode_cursor('not a cursor', ['id'], 'asc')
+
+
+def test_seek_columns():
+    assert seek_columns([]) == []
+    assert seek_columns(['id']) == ['id']
+    assert seek_columns(['id'], 'score') == ['score', 'id']
+    assert seek_columns(['a', 'b'], 'b') == ['b', 'a']
+
+
+def test_seek_clause_direction():
+    clause, params = build_seek_clause(['score', 'id'], [1, 5], 'asc', 'next')
+    assert clause == "(score, id) > (:seek_0, :seek_1)"
+    assert params == {'seek_0': 1, 'seek_1': 5}
+    assert build_seek_clause(['id'], [5], 'asc', 'prev')[0] == "id < :seek_0"
+    assert build_seek_clause(['id'], [5], 'desc', 'next')[0] == "id < :seek_0"
+    assert build_order_clause(['score', 'id'], 'asc', 'prev') == "score DESC, id DESC"
+
+
+def test_choose_pagination_mode():
+    assert choose_pagination_mode({}) == 'keyset'
+    assert choose_pagination_mode({'page': 3}) == 'offset'
+    assert choose_pagination_mode({'page': 3, 'cursor': 'x'}) == 'keyset'
+    assert choose_pagination_mode({'mode': 'offset'}) == 'offset'
+
+
+def test_can_seek_requires_not_null_columns():
+    keys = TableKeys(['id'], {'id': True, 'score': False, 'note': True})
+    assert can_seek(['id'], keys)
+    assert can_seek(['score', 'id'], keys)
+    assert not can_seek(['note', 'id'], keys)
+    assert not can_seek(['missing', 'id'], keys)
+    assert not can_seek([], keys)
+
+
+def test_keyset_walk_returns_every_row(engine):
+    rows = fetch_keyset(engine, ['score', 'id'], 'asc', 3)
+    assert sorted(r['id'] for r in rows) == list(range(1, 21))
+    assert [(r['score'], r['id']) for r in rows] == sorted((r['score'], r['id']) for r in rows)
+
+
+def test_keyset_on_nullable_column_would_skip_rows(engine):
+    # 这就是可为 NULL 的排序列不能使用 keyset 的原因
+    rows = fetch_keyset(engine, ['note', 'id'], 'asc', 3)
+    assert len(rows) < 20
+    keys = KeyColumnCache().get(engine, 'c1', 'items', 'sqlite')
+    assert not can_seek(['note', 'id'], keys)
+    assert can_seek(['score', 'id'], keys)
+
+
+def test_key_column_cache_follows_catalog_refresh(engine):
+    cache = KeyColumnCache()
+    catalog = {'refreshed_at': 1.0}
+    keys = cache.get(engine, 'c1', 'items', 'sqlite', catalog)
+    assert keys.primary_key == ['id']
+    assert set(keys.columns) == {'id', 'score', 'note'}
+
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE items ADD COLUMN extra TEXT"))
+    assert 'extra' not in cache.get(engine, 'c1', 'items', 'sqlite', catalog).columns
+    # 任何 worker 刷新目录后，刷新时间变化，键列重新读取
+    assert 'extra' in cache.get(engine, 'c1', 'items', 'sqlite', {'refreshed_at': 2.0}).columns
+
+
+def test_catalog_details_are_used_directly():
+    catalog = {'details': {'public.items': {
+        'primary_key': ['id'],
+        'columns': [{'name': 'id', 'nullable': False}, {'name': 'note', 'nullable': True}],
+    }}}
+    keys = catalog_table_keys(catalog, 'items', 'postgresql')
+    assert keys == TableKeys(['id'], {'id': False, 'note': True})
+    assert catalog_table_keys(catalog, 'other', 'postgresql') is None
+    assert catalog_table_keys(None, 'items', 'sqlite') is None
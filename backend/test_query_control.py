@@ -0,0 +1,117 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import threading
+import time
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from models import RunningQueryEntry, create_tables
+from query_control import QueryCancelled, QueryRegistry, effective_timeout
+
+SLOW_SQL = ("WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c WHERE x < 300000000) "
+            "SELECT count(*) FROM c")
+
+
+@pytest.fixture
+def Session(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'app.sqlite'}", connect_args={'timeout': 30})
+    create_tables(engine)
+    return sessionmaker(bind=engine)
+
+
+@pytest.fixture
+def target(tmp_path):
+    return create_engine(f"sqlite:///{tmp_path / 'target.sqlite'}")
+
+
+def run_in_background(registry, target, **kwargs):
+    """Run SLOW_SQL in a thread; returns (thread, outcome dict)"""
+    outcome = {}
+
+    def work():
+        try:
+            with registry.run(target, 'c1', 'sqlite', SLOW_SQL, **kwargs) as (conn, query):
+                conn.exec_driver_sql(SLOW_SQL).fetchall()
+            outcome['result'] = 'finished'
+        except QueryCancelled as e:
+            outcome['result'] = e.reason
+
+    thread = threading.Thread(target=work)
+    thread.start()
+    return thread, outcome
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_effective_timeout():
+    assert effective_timeout(0, None) == 0
+    assert effective_timeout(30, 5) == 5
+    assert effective_timeout(0, 5) == 5
+    assert effective_timeout(30, 0) == 30
+
+
+def test_statement_timeout(target):
+    registry = QueryRegistry()
+    started = time.monotonic()
+    with pytest.raises(QueryCancelled) as raised:
+        with registry.run(target, 'c1', 'sqlite', SLOW_SQL, timeout=0.2) as (conn, query):
+            conn.exec_driver_sql(SLOW_SQL).fetchall()
+    assert raised.value.reason == 'timeout'
+    assert time.monotonic() - started < 5
+    assert registry.list() == []
+
+
+def test_cancel_in_the_same_worker(target):
+    registry = QueryRegistry()
+    thread, outcome = run_in_background(registry, target, query_id='q1')
+    wait_until(lambda: registry.get('q1') is not None)
+    assert registry.cancel('q1')
+    thread.join(10)
+    assert outcome['result'] == 'cancelled'
+    assert not registry.cancel('q1')
+
+
+def test_only_shared_queries_are_recorded(Session, target):
+    registry = QueryRegistry(Session)
+    with registry.run(target, 'c1', 'sqlite', 'SELECT 1') as (conn, query):
+        session = Session()
+        assert session.query(RunningQueryEntry).count() == 0
+        session.close()
+        assert [q['id'] for q in registry.list()] == [query.id]
+    with registry.run(target, 'c1', 'sqlite', 'SELECT 1', query_id='q1') as (conn, query):
+        session = Session()
+        assert session.query(RunningQueryEntry.id).scalar() == 'q1'
+        session.close()
+    assert registry.list() == []
+
+
+def test_cancel_from_another_worker(Session, target):
+    owner, other = QueryRegistry(Session), QueryRegistry(Session)
+    thread, outcome = run_in_background(owner, target, query_id='q1', user_id='u1')
+    wait_until(lambda: other.get('q1') is not None)
+    assert [q['id'] for q in other.list(user_id='u1')] == ['q1']
+    assert other.cancel('q1')
+    thread.join(10)
+    assert outcome['result'] == 'cancelled'
+    assert other.get('q1') is None
+
+
+def test_prune_removes_rows_from_other_boots(Session):
+    session = Session()
+    session.add(RunningQueryEntry(id='old', pid=os.getpid(), boot_id='previous', started=time.time()))
+    session.add(RunningQueryEntry(id='live', pid=os.getpid(), boot_id='current', started=time.time()))
+    session.commit()
+    session.close()
+
+    registry = QueryRegistry(Session, boot_id='current')
+    assert registry.prune() == 1
+    assert [q['id'] for q in registry.list()] == ['live']
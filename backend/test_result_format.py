@@ -0,0 +1,78 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import datetime
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from result_format import column_values, columns_to_records, columns_to_rows, frame_columns, plain_value
+
+
+def per_value(series):
+    """Reference result: the old cell-by-cell conversion"""
+    return [None if (not isinstance(v, Decimal) and pd.isna(v)) else plain_value(v) for v in series.tolist()]
+
+
+def test_integer_columns():
+    assert column_values(pd.Series([1, 2, 3])) == [1, 2, 3]
+    assert column_values(pd.Series([1, None, 3], dtype='Int64')) == [1, None, 3]
+    assert column_values(pd.Series([True, None], dtype='boolean')) == [True, None]
+    big = 2 ** 64 - 1
+    assert column_values(pd.Series([big, None], dtype='UInt64')) == [big, None]
+    assert all(type(v) is int for v in column_values(pd.Series([1, 2], dtype='int32')))
+
+
+def test_float_columns():
+    values = column_values(pd.Series([1.0, 2.5, np.nan, np.inf, -np.inf, 1e20]))
+    assert values == [1, 2.5, None, None, None, 100000000000000000000]
+    assert type(values[0]) is int
+    # 超出 int64 范围的整数值保持 float
+    assert type(column_values(pd.Series([1e19]))[0]) is float
+
+
+def test_datetime_columns():
+    naive = pd.Series(pd.to_datetime(['2024-01-02 03:04:05', None]))
+    assert column_values(naive) == ['2024-01-02T03:04:05', None]
+    fraction = pd.Series(pd.to_datetime(['2024-01-02 03:04:05.250000']))
+    assert column_values(fraction) == ['2024-01-02T03:04:05.250000']
+    aware = pd.Series(pd.to_datetime(['2024-01-02 03:04:05']).tz_localize('Asia/Shanghai'))
+    assert column_values(aware) == ['2024-01-01T19:04:05+00:00']
+    assert column_values(pd.Series(pd.to_timedelta(['1 day', None]))) == ['1 day, 0:00:00', None]
+
+
+def test_object_columns_match_plain_value():
+    series = pd.Series([
+        datetime.date(2024, 1, 2), b'\x00\x01', None, 'text', datetime.datetime(2024, 1, 2, 3, 4, 5),
+    ], dtype=object)
+    assert column_values(series) == per_value(series)
+
+
+@pytest.mark.parametrize('values', [
+    [Decimal('1'), Decimal('2.50'), None],
+    [Decimal('12345678901234567890.123'), Decimal('0.1')],
+    [Decimal('1E+20'), Decimal('-3')],
+    [Decimal('NaN'), Decimal('Infinity'), None],
+])
+def test_decimal_columns_match_plain_value(values):
+    series = pd.Series(values, dtype=object)
+    assert column_values(series) == per_value(series)
+
+
+def test_decimal_precision_is_kept():
+    values = column_values(pd.Series([Decimal('12345678901234567890.123'), Decimal('NaN')], dtype=object))
+    assert values == ['12345678901234567890.123', 'NaN']
+
+
+def test_frame_shapes():
+    df = pd.DataFrame({'id': [1, 2], 'name': ['a', None], 3: [0.5, 1.0]})
+    columns, values = frame_columns(df)
+    assert columns == ['id', 'name', '3']
+    assert columns_to_rows(values) == [[1, 'a', 0.5], [2, None, 1]]
+    assert columns_to_records(columns, values) == [
+        {'id': 1, 'name': 'a', '3': 0.5},
+        {'id': 2, 'name': None, '3': 1},
+    ]
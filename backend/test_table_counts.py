@@ -0,0 +1,67 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import pytest
+from sqlalchemy import create_engine, text
+
+from table_counts import TableCounter, estimate_row_count
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'target.sqlite'}")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE items (id INTEGER PRIMARY KEY, kind TEXT)"))
+        conn.execute(text("CREATE INDEX items_kind ON items (kind)"))
+        conn.execute(text("INSERT INTO items (kind) VALUES (:kind)"), [{'kind': 'a' if i % 4 else 'b'} for i in range(100)])
+    return engine
+
+
+def add_rows(engine, n):
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO items (kind) VALUES ('a')"), [{}] * n)
+
+
+def test_exact_count_is_cached_until_invalidated(engine):
+    counter = TableCounter(ttl=60)
+    assert counter.start(engine, 'c1', 'sqlite', 'items', strategy='exact').result() == (100, True)
+
+    add_rows(engine, 5)
+    assert counter.start(engine, 'c1', 'sqlite', 'items', strategy='exact').result() == (100, True)
+
+    counter.invalidate('c1', 'items')
+    assert counter.start(engine, 'c1', 'sqlite', 'items', strategy='exact').result() == (105, True)
+
+
+def test_cache_expires_after_ttl(engine):
+    counter = TableCounter(ttl=0)
+    assert counter.start(engine, 'c1', 'sqlite', 'items').result() == (100, True)
+    add_rows(engine, 1)
+    assert counter.start(engine, 'c1', 'sqlite', 'items').result() == (101, True)
+
+
+def test_filtered_counts_are_cached_per_parameter(engine):
+    counter = TableCounter(ttl=60)
+
+    def count(kind, strategy='auto'):
+        return counter.start(engine, 'c1', 'sqlite', 'items', ['kind = :kind'], {'kind': kind}, strategy).result()
+
+    assert count('a') == (75, True)
+    assert count('b') == (25, True)
+    # 整表的估算值不能代替过滤后的计数
+    assert count('c', strategy='estimate') == (None, False)
+
+
+def test_estimate_from_catalog(engine):
+    counter = TableCounter(ttl=60)
+    # 没有统计信息时只能精确计数
+    assert estimate_row_count(engine, 'sqlite', 'items') is None
+    assert counter.start(engine, 'c1', 'sqlite', 'items', strategy='estimate').result() == (100, True)
+
+    with engine.begin() as conn:
+        conn.execute(text("ANALYZE"))
+    counter.invalidate('c1')
+    add_rows(engine, 10)
+    # 估算值来自 ANALYZE 时的统计信息
+    assert counter.start(engine, 'c1', 'sqlite', 'items', strategy='estimate').result() == (100, False)
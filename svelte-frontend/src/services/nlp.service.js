@@ -45,10 +45,11 @@ export async function nlToSql(nlQuery) {
 }
 
 // Chat with AI model
-export async function chatWithAI(message, history = [], model) {
+export async function chatWithAI(message, history = [], model, context = null) {
   try {
     const payload = { message, history };
     if (model) payload.model = model;
+    if (context) payload.context = context;
     
     const result = await apiRequest('/chat', {
       method: 'POST',